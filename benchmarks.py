@@ -0,0 +1,608 @@
+import os
+import os.path
+import re
+import io
+import sys
+import json
+import time
+import random
+import timeit
+import fnmatch
+import functools
+import hashlib
+import inspect
+import logging
+import argparse
+import tempfile
+import subprocess
+import resource
+import threading
+import http.server
+import multiprocessing
+import urllib.parse
+import urllib.request
+
+from concurrent.futures import ProcessPoolExecutor
+import dateutil.parser
+from PIL import Image, ImageDraw
+
+import troptumps.pdf as pdf
+import troptumps.fetch as fetch
+import troptumps.images as images
+import troptumps.deckfile as deckfile
+import troptumps.options as options
+from troptumps.cache import normalise_query
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_fixtures')
+SPARQL_FIXTURES = os.path.join(FIXTURES_DIR, 'sparql.json')
+BASELINE_FILE = os.path.join(FIXTURES_DIR, 'baseline.json')
+IMAGES_PLACEHOLDER = '{images}'
+NUM_DISTINCT_IMAGES = 20
+FIXTURE_IMAGE_SIZE = 400, 300
+RANDOM_SEED = 0
+# allowed increase over the baseline before a metric counts as a regression, with an absolute floor for noise
+TOLERANCES = {
+    'wall': (0.25, 0.005),
+    'peak_mb': (0.15, 5.0),
+    'pdf_kb': (0.05, 1.0),
+    'import_ms': (0.25, 5.0),
+}
+
+CJK_RANGE = 0x4e00, 0x9fff
+DEVANAGARI_RANGE = 0x0900, 0x097f
+GREEK_RANGE = 0x03b1, 0x03c9
+LATIN_RANGE = ord('a'), ord('z')
+SCRIPTS = {
+    'latin': [[LATIN_RANGE]],
+    'mixed': [[LATIN_RANGE], [GREEK_RANGE], [DEVANAGARI_RANGE]],
+    'cjk': [[CJK_RANGE]],
+}
+
+
+def random_word(rnd, ranges, length):
+    return ''.join(chr(rnd.randint(*rnd.choice(ranges))) for i in range(length))
+
+
+def random_text(rnd, kind, minwords, maxwords):
+    scripts = SCRIPTS[kind]
+    return ' '.join(random_word(rnd, rnd.choice(scripts), rnd.randint(2, 8))
+                    for j in range(rnd.randint(minwords, maxwords)))
+
+
+def sample_texts(kind, count=200, seed=RANDOM_SEED):
+    rnd = random.Random(seed)
+    texts = [random_text(rnd, kind, 3, 20) for i in range(count)]
+    # card text repeats a lot, e.g. stat names on every card
+    return texts + texts[:count//2]
+
+
+def make_image(rnd, path, size=FIXTURE_IMAGE_SIZE):
+    img = Image.new('RGB', size, tuple(rnd.randint(0, 255) for i in range(3)))
+    draw = ImageDraw.Draw(img)
+    for i in range(8):
+        x, y = rnd.randint(0, size[0]), rnd.randint(0, size[1])
+        r = rnd.randint(10, size[1]//2)
+        draw.ellipse((x-r, y-r, x+r, y+r), fill=tuple(rnd.randint(0, 255) for i in range(3)))
+    img.save(path, 'PNG')
+
+
+def make_deck(directory, count, kind, with_images, seed=RANDOM_SEED):
+    # Writes a synthetic deck of the given size and script, returning its directory
+    rnd = random.Random(seed)
+    name = 'deck_{}_{}{}'.format(kind, count, '_images' if with_images else '')
+    deck_dir = os.path.join(directory, name)
+    os.mkdir(deck_dir)
+    imagenames = []
+    if with_images:
+        for i in range(NUM_DISTINCT_IMAGES):
+            imagenames.append('card{:02d}.png'.format(i))
+            make_image(rnd, os.path.join(deck_dir, imagenames[-1]))
+    header = {
+        'name': random_text(rnd, kind, 1, 3),
+        'description': random_text(rnd, kind, 10, 25),
+        'stats': [random_text(rnd, kind, 1, 2) for i in range(fetch.MAX_NUM_STATS)],
+    }
+    cards = ({
+        'name': random_text(rnd, kind, 1, 3),
+        'description': random_text(rnd, kind, 10, 25),
+        'image': rnd.choice(imagenames) if imagenames else None,
+        'stats': [fetch.format_stat(None, str(rnd.uniform(0, 10000))) for i in range(fetch.MAX_NUM_STATS)],
+    } for i in range(count))
+    deckfile.write_deck(os.path.join(deck_dir, '{}.jsonl'.format(name)), header, cards)
+    return deck_dir
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    # Replays recorded SPARQL responses, or records them from an upstream endpoint, and serves synthetic images
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        params = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        q = normalise_query(params['query'][0])
+        server = self.server
+        if server.upstream is not None:
+            req = urllib.request.Request(server.upstream, urllib.parse.urlencode(
+                { k: v[0] for k, v in params.items() }).encode('utf-8'), headers={ 'User-Agent': fetch.USER_AGENT })
+            with urllib.request.urlopen(req, timeout=fetch.QUERY_TIMEOUT) as res:
+                response = json.load(res)
+            server.fixtures[q] = response
+        elif q in server.fixtures:
+            response = self.substitute(server.fixtures[q])
+        else:
+            # empty results make fetch move on to another category rather than retrying forever
+            server.missing.append(q)
+            response = { 'results': { 'bindings': [] } }
+        self.send_body('application/json', json.dumps(response).encode('utf-8'))
+
+    def do_GET(self):
+        index = int(hashlib.sha1(self.path.encode('utf-8')).hexdigest(), 16) % NUM_DISTINCT_IMAGES
+        self.send_body('image/png', self.server.images[index])
+
+    def substitute(self, response):
+        base = 'http://{}:{}'.format(*self.server.server_address)
+        return json.loads(json.dumps(response).replace(IMAGES_PLACEHOLDER, base))
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fixture_server(fixtures, upstream=None):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.upstream = upstream
+    server.missing = []
+    rnd = random.Random(RANDOM_SEED)
+    server.images = []
+    for i in range(NUM_DISTINCT_IMAGES):
+        buff = io.BytesIO()
+        make_image(rnd, buff)
+        server.images.append(buff.getvalue())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_fixtures():
+    with open(SPARQL_FIXTURES, 'r') as f:
+        return { r['query']: r['response'] for r in json.load(f) }
+
+
+def save_fixtures(fixtures):
+    # image urls are swapped for the replay server's own
+    def strip_images(response):
+        for binding in response['results']['bindings']:
+            for name, info in binding.items():
+                if name == 'image':
+                    info['value'] = '|'.join('{}/{}'.format(IMAGES_PLACEHOLDER, hashlib.sha1(u.encode('utf-8'))
+                                             .hexdigest()[:12]) for u in info['value'].split('|') if u)
+        return response
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    with open(SPARQL_FIXTURES, 'w') as f:
+        json.dump([{ 'query': q, 'response': strip_images(r) } for q, r in sorted(fixtures.items())], f, indent=1)
+
+
+def timed_stages(targets):
+    # Wraps module functions to total up the time spent in each
+    stages = {}
+
+    def add(name, secs):
+        stage = stages.setdefault(name, [0.0, 0])
+        stage[0] += secs
+        stage[1] += 1
+
+    def wrap(module, name, func):
+        # keeping the name lets pickle find the wrapper, for functions handed to worker processes
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            starttime = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add(name, time.perf_counter()-starttime)
+
+        # generators are timed while they run, not while their consumer does
+        @functools.wraps(func)
+        def gen_wrapper(*args, **kwargs):
+            gen = func(*args, **kwargs)
+            secs = 0.0
+            try:
+                while True:
+                    starttime = time.perf_counter()
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        secs += time.perf_counter()-starttime
+                    yield item
+            finally:
+                gen.close()
+                add(name, secs)
+
+        setattr(module, name, gen_wrapper if inspect.isgeneratorfunction(func) else wrapper)
+
+    for module, name in targets:
+        wrap(module, name, getattr(module, name))
+    return stages
+
+
+def peak_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_render_case(count, kind, with_images, renderjobs):
+    logging.basicConfig(level=logging.ERROR)
+    stages = timed_stages([(pdf, 'page_config'), (images, 'dedupe_images'), (pdf, 'render_cards'),
+                           (pdf, 'render_chunks')])
+    with tempfile.TemporaryDirectory(prefix='troptumps-bench-') as tempdir:
+        deck_dir = make_deck(tempdir, count, kind, with_images)
+        pdf.register_fonts()
+        args = argparse.Namespace(color=None, seccolor=None, pagesize=options.DEFAULT_PAGE_SIZE,
+                                  pagemargin=options.DEFAULT_PAGE_MARGIN_MM,
+                                  bleedmargin=options.DEFAULT_BLEED_MARGIN_MM, sqcorners=False,
+                                  backs=options.DEFAULT_BACKS_TYPE, imagedpi=None, renderjobs=renderjobs)
+        random.seed(RANDOM_SEED)
+        starttime = time.perf_counter()
+        pdf.create_pdf(args, deck_dir)
+        wall = time.perf_counter()-starttime
+        pdf_kb = os.path.getsize(os.path.join(deck_dir, '{}.pdf'.format(os.path.basename(deck_dir)))) / 1024
+    return { 'wall': wall, 'peak_mb': peak_mb(), 'pdf_kb': pdf_kb }, stages
+
+
+def run_rerender_case(count, kind, edit):
+    # Times re-rendering a deck that's been rendered incrementally before, after changing one card's name or nothing
+    logging.basicConfig(level=logging.ERROR)
+    with tempfile.TemporaryDirectory(prefix='troptumps-bench-') as tempdir:
+        deck_dir = make_deck(tempdir, count, kind, True)
+        pdf.register_fonts()
+        args = argparse.Namespace(color=None, seccolor=None, pagesize=options.DEFAULT_PAGE_SIZE,
+                                  pagemargin=options.DEFAULT_PAGE_MARGIN_MM,
+                                  bleedmargin=options.DEFAULT_BLEED_MARGIN_MM, sqcorners=False,
+                                  backs=options.DEFAULT_BACKS_TYPE, imagedpi=None, renderjobs=1)
+        random.seed(RANDOM_SEED)
+        pdf.create_pdf(args, deck_dir, incremental=True)
+        if edit:
+            path = deckfile.deck_file(deck_dir)
+            header = deckfile.read_header(path)
+            cards = list(deckfile.read_cards(path))
+            cards[count//2]['name'] += ' edited'
+            deckfile.write_deck(path, header, cards)
+        stages = timed_stages([(pdf, 'render_cards'), (pdf, 'merge_parts')])
+        starttime = time.perf_counter()
+        pdf.create_pdf(args, deck_dir, incremental=True)
+        wall = time.perf_counter()-starttime
+        pdf_kb = os.path.getsize(os.path.join(deck_dir, '{}.pdf'.format(os.path.basename(deck_dir)))) / 1024
+    return { 'wall': wall, 'peak_mb': peak_mb(), 'pdf_kb': pdf_kb }, stages
+
+
+def fetch_args(offline=False):
+    return argparse.Namespace(downloadworkers=options.DEFAULT_DOWNLOAD_WORKERS, offline=offline,
+                              candidates=options.DEFAULT_CANDIDATES, dump=None)
+
+
+def use_endpoint(server, cache_dir):
+    fetch.SPARQL_ENDPOINT = 'http://{}:{}/sparql'.format(*server.server_address)
+    fetch.CACHE_FILE = os.path.join(cache_dir, 'troptumps')
+    fetch.QUERY_CACHE_DIR = fetch.CACHE_FILE + '-queries'
+    fetch.CATEGORY_DB = fetch.CACHE_FILE + '.sqlite'
+
+
+def run_fetch_case(warm):
+    logging.basicConfig(level=logging.ERROR)
+    server = start_fixture_server(load_fixtures())
+    with tempfile.TemporaryDirectory(prefix='troptumps-bench-') as tempdir:
+        os.chdir(tempdir)
+        use_endpoint(server, os.path.join(tempdir, 'cache'))
+        if warm:
+            # a first run fills the query cache, then the same categories are drawn again
+            random.seed(RANDOM_SEED)
+            deck_dir = fetch.fetch_deck(fetch_args(), None)
+            os.remove(fetch.CATEGORY_DB)
+            for name in os.listdir(deck_dir):
+                os.remove(os.path.join(deck_dir, name))
+            os.rmdir(deck_dir)
+        stages = timed_stages([(fetch, 'query'), (fetch, 'choose_category'), (deckfile, 'write_deck')])
+        random.seed(RANDOM_SEED)
+        starttime = time.perf_counter()
+        fetch.fetch_deck(fetch_args(), None)
+        wall = time.perf_counter()-starttime
+    if server.missing:
+        raise Exception("{} queries missing from {} - re-record with --record".format(
+            len(server.missing), SPARQL_FIXTURES))
+    return { 'wall': wall, 'peak_mb': peak_mb() }, stages
+
+
+def record_fixtures(upstream):
+    # Runs a fetch against a real endpoint, keeping every response for later replay
+    server = start_fixture_server({}, upstream)
+    with tempfile.TemporaryDirectory(prefix='troptumps-record-') as tempdir:
+        os.chdir(tempdir)
+        use_endpoint(server, os.path.join(tempdir, 'cache'))
+        random.seed(RANDOM_SEED)
+        fetch.fetch_deck(fetch_args(), None)
+    save_fixtures(server.fixtures)
+    logging.info("Recorded {} queries to {}".format(len(server.fixtures), SPARQL_FIXTURES))
+
+
+def run_isolated(func, *args):
+    # Each case gets a fresh interpreter so that peak memory is its own
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+
+def bench_render():
+    cases = [
+        (30, 'latin', True, 1),
+        (500, 'latin', True, 1),
+        (5000, 'latin', True, 1),
+        (5000, 'latin', False, 1),
+        (500, 'mixed', True, 1),
+        (500, 'cjk', False, 1),
+        (5000, 'latin', True, 4),
+    ]
+    for count, kind, with_images, renderjobs in cases:
+        name = 'render[{}-{}{}{}]'.format(kind, count, '-images' if with_images else '',
+                                          '-j{}'.format(renderjobs) if renderjobs > 1 else '')
+        yield name, lambda c=(count, kind, with_images, renderjobs): run_isolated(run_render_case, *c)
+
+
+def bench_rerender():
+    for count, kind in ((500, 'latin'), (5000, 'latin')):
+        for edit in (False, True):
+            name = 'rerender[{}-{}-images-{}]'.format(kind, count, 'one-card' if edit else 'unchanged')
+            yield name, lambda c=(count, kind, edit): run_isolated(run_rerender_case, *c)
+
+
+def bench_fetch():
+    yield 'fetch[cold]', lambda: run_isolated(run_fetch_case, False)
+    yield 'fetch[warm]', lambda: run_isolated(run_fetch_case, True)
+
+
+def legacy_tag_font_fallbacks(text):
+    # the original implementation, for comparison
+    def repl(match):
+        out = ""
+        prev = None
+        fnum = 0
+        for c in match.group(0):
+            while fnum < len(pdf.FONT_FALLBACK_ORDER):
+                fontfam = pdf.FONT_FALLBACK_ORDER[fnum]
+                if pdf.register_font_family(fontfam) and ord(c) in pdf.pdfmetrics.getFont(fontfam).face.charWidths:
+                    if fnum != prev:
+                        if prev is not None:
+                            out += '</font>'
+                        out += '<font face="{}">'.format(pdf.FONT_FALLBACK_ORDER[fnum])
+                        prev = fnum
+                    out += c
+                    break
+                fnum += 1
+            else:
+                out += c
+                fnum = 0
+        if prev is not None:
+            out += '</font>'
+        return out
+    return re.sub(pdf.FONT_FALLBACK_REGEX, repl, text)
+
+
+def time_call(func, repeat=5):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_tag_font_fallbacks():
+    for kind in ('latin', 'mixed', 'cjk'):
+        texts = sample_texts(kind)
+
+        def legacy(texts=texts):
+            for t in texts:
+                legacy_tag_font_fallbacks(t)
+
+        def cold(texts=texts):
+            pdf.tag_font_fallbacks.cache_clear()
+            for t in texts:
+                pdf.tag_font_fallbacks(t)
+
+        def warm(texts=texts):
+            for t in texts:
+                pdf.tag_font_fallbacks(t)
+
+        for label, func in (('legacy', legacy), ('indexed', cold), ('memoised', warm)):
+            yield 'tag_font_fallbacks[{}-{}]'.format(kind, label), lambda func=func: ({ 'wall': time_call(func) }, {})
+
+
+def legacy_format_stat(datatype, value):
+    # the original per-value implementation, for comparison
+    if value is None or value == "":
+        return "Unknown"
+    try:
+        if datatype == 'http://www.w3.org/2001/XMLSchema#date':
+            return dateutil.parser.parse(value).strftime('%d %b, %Y')
+        elif datatype == 'http://www.w3.org/2001/XMLSchema#datetime':
+            return dateutil.parser.parse(value).strftime('%I:%M%p on %d %b, %Y')
+        else:
+            return format(float(value), 'n')
+    except ValueError:
+        return str(value)
+
+
+def bench_format_stat():
+    rnd = random.Random(RANDOM_SEED)
+    values = {
+        'double': (None, [str(rnd.uniform(-1e6, 1e6)) for i in range(2000)]),
+        'date': ('http://www.w3.org/2001/XMLSchema#date',
+                 ['{:04d}-{:02d}-{:02d}'.format(rnd.randint(1000, 2020), rnd.randint(1, 12), rnd.randint(1, 28))
+                  for i in range(2000)]),
+        'datetime': ('http://www.w3.org/2001/XMLSchema#datetime',
+                     ['{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:00'.format(rnd.randint(1000, 2020), rnd.randint(1, 12),
+                                                                     rnd.randint(1, 28), rnd.randint(0, 23),
+                                                                     rnd.randint(0, 59))
+                      for i in range(2000)]),
+    }
+    for kind, (datatype, vals) in values.items():
+        def legacy(datatype=datatype, vals=vals):
+            for v in vals:
+                legacy_format_stat(datatype, v)
+
+        def columnar(datatype=datatype, vals=vals):
+            fetch.format_stat_column(datatype, vals)
+
+        for label, func in (('legacy', legacy), ('columnar', columnar)):
+            yield 'format_stat[{}-{}]'.format(kind, label), lambda func=func: ({ 'wall': time_call(func) }, {})
+
+
+def make_results(path, count, seed=RANDOM_SEED):
+    # Writes a SPARQL JSON response the shape of the category list, as dbpedia formats it
+    rnd = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('\n{ "head": { "link": [], "vars": ["c", "n"] },\n'
+                '  "results": { "distinct": false, "ordered": true, "bindings": [')
+        for i in range(count):
+            f.write('{}\n    {{ "c": {{ "type": "uri", "value": "http://dbpedia.org/ontology/{}" }}, '
+                    '"n": {{ "type": "typed-literal", "datatype": "http://www.w3.org/2001/XMLSchema#integer", '
+                    '"value": "{}" }}}}'.format(',' if i else '', random_word(rnd, [LATIN_RANGE], 12),
+                                             rnd.randint(fetch.MIN_DECK_SIZE, 100000)))
+        f.write(' ] } }')
+
+
+def legacy_read_bindings(res):
+    # the original implementation, for comparison
+    data = json.load(io.TextIOWrapper(res, 'utf-8'))
+    results = []
+    for binding in data['results']['bindings']:
+        results.append({})
+        for name, info in binding.items():
+            results[-1][name] = info['value']
+    return results
+
+
+def run_parse_case(count, legacy):
+    with tempfile.TemporaryDirectory(prefix='troptumps-bench-') as tempdir:
+        path = os.path.join(tempdir, 'results.json')
+        make_results(path, count)
+        baseline_mb = peak_mb()
+        with open(path, 'rb') as f:
+            starttime = time.perf_counter()
+            if legacy:
+                rows = sum(1 for r in legacy_read_bindings(f))
+            else:
+                rows = sum(1 for r in fetch.read_bindings(f))
+            wall = time.perf_counter()-starttime
+    if rows != count:
+        raise Exception("Parsed {} of {} rows".format(rows, count))
+    return { 'wall': wall, 'peak_mb': peak_mb()-baseline_mb }, {}
+
+
+def bench_parse():
+    for count in (1000, 200000):
+        for label, legacy in (('legacy', True), ('streaming', False)):
+            yield 'read_bindings[{}-{}]'.format(count, label), \
+                lambda c=(count, legacy): run_isolated(run_parse_case, *c)
+
+
+def run_startup_case(args, repeat=5):
+    # Best of several launches, with the time -X importtime puts on the imports alone
+    cmd = [sys.executable, '-X', 'importtime', '-m', 'troptumps'] + args
+    walls, imports = [], []
+    for i in range(repeat):
+        starttime = time.perf_counter()
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        walls.append(time.perf_counter()-starttime)
+        imports.append(sum(int(line.split('|')[0].split(':')[1]) for line in proc.stderr.splitlines()
+                           if re.match(r'import time:\s+\d', line)) / 1000)
+    return { 'wall': min(walls), 'import_ms': min(imports) }, {}
+
+
+def bench_startup():
+    for label, args in (('version', ['--version']), ('bad-argument', ['--pagesize', 'nosuchsize'])):
+        yield 'startup[{}]'.format(label), lambda args=args: run_startup_case(args)
+
+
+BENCHMARKS = [
+    bench_startup,
+    bench_tag_font_fallbacks,
+    bench_parse,
+    bench_format_stat,
+    bench_fetch,
+    bench_render,
+    bench_rerender,
+]
+
+
+def format_metrics(metrics):
+    units = { 'wall': '{:.3f}s', 'peak_mb': '{:.1f}MB', 'pdf_kb': '{:.1f}KB', 'import_ms': '{:.1f}ms' }
+    return '  '.join('{} {}'.format(k, units[k].format(v)) for k, v in sorted(metrics.items()))
+
+
+def format_stages(stages):
+    return '  '.join('{} {:.3f}s/{}'.format(name, secs, calls) for name, (secs, calls) in stages.items())
+
+
+def regressions(results, baseline):
+    found = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            if name not in baseline or metric not in baseline[name]:
+                continue
+            expected = baseline[name][metric]
+            ratio, floor = TOLERANCES[metric]
+            if value > expected * (1+ratio) and value - expected > floor:
+                found.append('{} {}: {:.3f} against baseline {:.3f}'.format(name, metric, value, expected))
+    return found
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Times the fetch and render entry points on synthetic decks and '
+                                             'recorded queries')
+    ap.add_argument('-k', '--filter', default='*', help="Only run benchmarks whose names match this glob pattern")
+    ap.add_argument('--save', action='store_true', help="Store the results as the new baseline")
+    ap.add_argument('--check', action='store_true',
+                    help="Exit with an error if any result is a regression against the stored baseline")
+    ap.add_argument('--record', metavar='ENDPOINT',
+                    help="Re-record the SPARQL fixtures from this endpoint, e.g. {}".format(fetch.SPARQL_ENDPOINT))
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.record:
+        logging.getLogger().setLevel(logging.INFO)
+        record_fixtures(args.record)
+        return
+
+    pdf.register_fonts()
+    results = {}
+    for bench in BENCHMARKS:
+        for name, run in bench():
+            if not fnmatch.fnmatch(name, args.filter):
+                continue
+            metrics, stages = run()
+            results[name] = metrics
+            print('{:<36} {}'.format(name, format_metrics(metrics)))
+            if stages:
+                print('{:<36} {}'.format('', format_stages(stages)))
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r') as f:
+            baseline = json.load(f)
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+    if args.check:
+        found = regressions(results, baseline)
+        for r in found:
+            print('REGRESSION {}'.format(r))
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,10 @@ setuptools.setup(
         'reportlab>=3.4.0',
         'pillow>=1.1.7',
     ],
-    python_requires='>=3.6',
+    extras_require={
+        'parallel': ['pypdf>=4.3.0'],
+    },
+    python_requires='>=3.7',
     entry_points={ 
         'console_scripts': [ 
             'troptumps = troptumps.__main__:main' 
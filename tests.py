@@ -1,6 +1,177 @@
+import os
+import os.path
+import io
+import re
+import gzip
+import sys
+import json
+import time
+import random
+import timeit
+import tempfile
+import logging
+import subprocess
+import collections
+import threading
+import http.client
+import http.server
+import importlib.util
 import unittest
+import unittest.mock
+import urllib.parse
+import email.message
+import email.utils
+import warnings
+
+from urllib.error import HTTPError
+from PIL import Image
 
 import troptumps.fetch as fetch
+import troptumps.store as store
+import troptumps.deckfile as deckfile
+import troptumps.dump as dump
+import troptumps.trace as trace
+import troptumps.cache as cache
+import troptumps.net as net
+import troptumps.options as options
+import troptumps.serve as serve
+import troptumps.batch as batch
+import troptumps.pdf as pdf
+import troptumps.images as images
+import troptumps.__main__ as cli
+
+
+def legacy_first_sentence(para):
+    # the regex first_sentence used to be, which the fuzz test holds it to
+    return re.match(r""" 
+        # content
+        (
+            ".*?"     # quote-delimited
+            | \(.*?\) # round-delimited
+            | \[.*?\] # square-delimited            
+            | \b(     # initial / abbreviation
+                [A-Z] 
+                | [Aa].[Bb] | [Aa]bbr | [Aa]cad | [Aa].[Dd] | [Aa]l | [Aa]lt | [Aa].[Mm] | [Aa]ssn | [Aa]ug | [Aa]ve 
+                | [Bb].[Aa] | [Bb].[Cc] | [Bb].[Pp] | [Bb].[Ss] | [Cc] | [Cc]al | [Cc]apt | [Cc]ent | [Cc]o | [Cc]ol 
+                | [Cc]omdr | [Cc]orp | [Cc]pl | [Cc]u | [Dd] | [Dd].[Cc] | [Dd]ec | [Dd]ept | [Dd]ist | [Dd]iv 
+                | [Dd]r | [Ee]d | [Ee].[Gg] | [Ee]st | [Ff]eb | [Ff]l | [Gg]al | [Gg]en | [Gg]ov | [Gg]rad | [Hh]on 
+                | [Ii].e | [Ii]n | [Ii]nc | [Ii]nst | [Jj]an | [Jj]r | [Ll]at | [Ll]b | [Ll]ib | [Ll]ong | [Ll]t 
+                | [Ll]td | [Mm].[Dd] | [Mm]r | [Mm]rs | [Mm]s | [Mm]sgr | [Mm]t | [Mm]ts | [Mm]us | [Nn]o | [Nn]ov 
+                | [Oo]ct | [Oo]p | [Pp]l | [Pp]op | [Pp]seud | [Pp]t | [Pp]ub | [Rr]ev | [Rr].[Nn] | [Ss]ept | [Ss]er 
+                | [Ss]gt | [Ss]r | [Ss]t | [Uu]ninc | [Uu]niv | [Uu].[Ss] | [Vv]ol | [Vv]s | [Vv] | [Ww]t
+              )\.
+            | .       # anything
+        )*?
+        # ending
+        (
+            # end symbols
+            (
+                # period, not prefixed with another period
+                (?<! \. ) \.                                    
+                # or one or more question/exclamation marks
+                | [!?]+                  
+            ) 
+            # suffixed by:
+            (?=(
+                \s+[^a-z]  # whitespace and non-lower
+                |\s*$      # or optional whitespace then EOI
+            ))
+            # alternatively just EOI
+            | $ 
+        )
+        """
+        , para, re.VERBOSE).group(0)
+
+
+def legacy_tag_font_fallbacks(text):
+    # the per-character font search tag_font_fallbacks used to do, which the equivalence test holds it to
+    def repl(match):
+        out = ""
+        prev = None
+        fnum = 0
+        for c in match.group(0):
+            while fnum < len(pdf.FONT_FALLBACK_ORDER):
+                fontfam = pdf.FONT_FALLBACK_ORDER[fnum]
+                if pdf.register_font_family(fontfam) and ord(c) in pdf.pdfmetrics.getFont(fontfam).face.charWidths:
+                    if fnum != prev:
+                        if prev is not None:
+                            out += '</font>'
+                        out += '<font face="{}">'.format(pdf.FONT_FALLBACK_ORDER[fnum])
+                        prev = fnum
+                    out += c
+                    break
+                fnum += 1
+            else:
+                out += c
+                fnum = 0
+        if prev is not None:
+            out += '</font>'
+        return out
+    return re.sub(pdf.FONT_FALLBACK_REGEX, repl, text)
+
+
+def pdf_matrix_product(m, n):
+    # the product of two pdf matrices, m applied first
+    return (m[0]*n[0] + m[1]*n[2], m[0]*n[1] + m[1]*n[3], m[2]*n[0] + m[3]*n[2], m[2]*n[1] + m[3]*n[3],
+            m[4]*n[0] + m[5]*n[2] + n[4], m[4]*n[1] + m[5]*n[3] + n[5])
+
+
+def page_drawing(reader, page):
+    # What a page paints, with forms drawn in place: each path in page coordinates along with the colours and line
+    # width it's painted with, and each string with its position and font
+    import pypdf
+    events = []
+    def walk(operations, resources, ctm, state):
+        stack = []
+        path = []
+        tm = tlm = (1, 0, 0, 1, 0, 0)
+        leading = 0
+        for operands, op in operations:
+            op = op.decode('latin-1')
+            if op == 'q':
+                stack.append((ctm, dict(state)))
+            elif op == 'Q':
+                ctm, state = stack.pop()
+            elif op == 'cm':
+                ctm = pdf_matrix_product(tuple(map(float, operands)), ctm)
+            elif op == 'Do':
+                xobj = resources['/XObject'][operands[0]].get_object()
+                matrix = tuple(map(float, xobj.get('/Matrix', (1, 0, 0, 1, 0, 0))))
+                walk(pypdf.generic.ContentStream(xobj, reader).operations, xobj.get('/Resources', resources),
+                     pdf_matrix_product(matrix, ctm), dict(state))
+            elif op in ('rg', 'RG', 'g', 'G', 'w', 'Tf'):
+                state[op.lower() if op in ('g', 'G') else op] = tuple(round(float(a), 3) if not str(a).startswith('/')
+                                                                        else str(a) for a in operands)
+            elif op in ('re', 'm', 'l', 'c', 'v', 'y', 'h'):
+                nums = list(map(float, operands))
+                if op == 're':
+                    nums = [nums[0], nums[1], nums[0]+nums[2], nums[1]+nums[3]]
+                points = []
+                for i in range(0, len(nums), 2):
+                    m = pdf_matrix_product((1, 0, 0, 1, nums[i], nums[i+1]), ctm)
+                    points.append((round(m[4], 2), round(m[5], 2)))
+                path.append((op, tuple(points)))
+            elif op in ('f', 'F', 'f*', 'S', 's', 'B', 'B*', 'b', 'b*', 'n'):
+                events.append((op, tuple(path), state.get('rg'), state.get('RG'), state.get('w')))
+                path = []
+            elif op == 'BT':
+                tm = tlm = (1, 0, 0, 1, 0, 0)
+            elif op == 'Tm':
+                tm = tlm = tuple(map(float, operands))
+            elif op in ('Td', 'TD'):
+                tm = tlm = pdf_matrix_product((1, 0, 0, 1, float(operands[0]), float(operands[1])), tlm)
+                if op == 'TD':
+                    leading = -float(operands[1])
+            elif op == 'TL':
+                leading = float(operands[0])
+            elif op == 'T*':
+                tm = tlm = pdf_matrix_product((1, 0, 0, 1, 0, -leading), tlm)
+            elif op in ('Tj', 'TJ'):
+                m = pdf_matrix_product(tm, ctm)
+                events.append((op, repr(operands[0]), round(m[4], 2), round(m[5], 2), state.get('Tf'),
+                               state.get('rg')))
+    walk(page.get_contents().operations, page['/Resources'], (1, 0, 0, 1, 0, 0), {})
+    return events
 
 
 class FirstSentenceTests(unittest.TestCase):
@@ -58,10 +229,1301 @@ class FirstSentenceTests(unittest.TestCase):
         ("An e.g. Mr Bond. Second sentence.", "An e.g. Mr Bond."),
         ("A t.e.s.t. Mr Bond. Second sentence.", "A t.e.s.t."), #
         ("A p.e.g. Mr Bond. Second sentence.", "A p.e.g. Mr Bond."), #
+        
+        ("He served in World War I.\nLater he retired.", "He served in World War I."),
+        ("An abbr. Mr Bond.\nSecond line.", "An abbr. Mr Bond."),
+        ("(Period in. Bracket\nacross). Second sentence.", "(Period in."),
+        ("Trailing line break.\n", "Trailing line break."),
+        ("No end on first line\nSecond line.", "No end on first line"),
     ]
     
     def test_first_sentence(self):
         for text, expected in self.CASES:
             with self.subTest(text=text):
                 self.assertEqual(expected, fetch.first_sentence(text))
+
+    # fragments likely to trip up sentence ends: abbreviations, end symbols, delimiters and word boundaries
+    FUZZ_TOKENS = ['A', 'a', 'M', 'Mr', 'mr', 'e', 'g', 'e.g', 'i.e', 'I.E', 'Inc', 'U.S', 'Co', 'x', 'Msgr', 'no',
+                   'v', ' ', '  ', '\t', '.', '..', '...', '!', '?', '!!', '?!', '"', '(', ')', '[', ']', 'é', 'É',
+                   '_', '1', "'", ',', '\n']
+
+    def test_matches_legacy_regex(self):
+        rnd = random.Random(1)
+        for i in range(20000):
+            text = ''.join(rnd.choice(self.FUZZ_TOKENS) for j in range(rnd.randint(0, 30)))
+            if rnd.random() < 0.1:
+                text += '\n'
+            try:
+                expected = legacy_first_sentence(text)
+            except AttributeError:
+                # the regex found no end before a line break and failed outright; the first line is taken instead
+                expected = text[:text.index('\n')]
+            self.assertEqual(expected, fetch.first_sentence(text), repr(text))
+
+    def test_linear_time(self):
+        # inputs the regex took quadratic time over, which it took seconds to get through at this length
+        adversarial = {
+            'unclosed': '( [ "a ',
+            'marks': '!',
+            'ellipses': 'Wait... No e.g. x. y ',
+            'abbreviations': 'U.S. Inc. (x.) ',
+        }
+        for name, unit in adversarial.items():
+            with self.subTest(name):
+                text = unit * (40000 // len(unit)) + 'a'
+                self.assertLess(min(timeit.repeat(lambda: fetch.first_sentence(text), number=1, repeat=3)), 0.5)
+
+
+class FormatStatTests(unittest.TestCase):
+
+    XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+    def test_matches_dateutil_formatting(self):
+        # the fast paths have to print the same as the dateutil parse they replace
+        import dateutil.parser
+        cases = [
+            ('date', ['1990-01-05', '0900-12-31', '2020-02-29'], '%d %b, %Y'),
+            ('time', ['00:00:00', '13:45:10', '23:59'], '%I:%M%p'),
+            ('datetime', ['1990-01-05T13:45:00', '2001-09-11T08:46:00+00:00'], '%I:%M%p on %d %b, %Y'),
+        ]
+        for kind, values, fmt in cases:
+            with self.subTest(kind=kind):
+                strings, numbers = fetch.format_stat_column(self.XSD+kind, values)
+                self.assertEqual([dateutil.parser.parse(v).strftime(fmt) for v in values], strings)
+
+    def test_numbers(self):
+        strings, numbers = fetch.format_stat_column(self.XSD+'double', ['1.5', '1e21', '-0.000123', '42'])
+        self.assertEqual([format(float(v), 'n') for v in ['1.5', '1e21', '-0.000123', '42']], strings)
+        self.assertEqual([1.5, 1e21, -0.000123, 42.0], list(numbers))
+
+    def test_raw_values(self):
+        strings, numbers = fetch.format_stat_column(self.XSD+'date', ['1970-01-02', '', None, 'not a date'])
+        self.assertEqual(['02 Jan, 1970', 'Unknown', 'Unknown', 'not a date'], strings)
+        self.assertEqual(86400.0, numbers[0])
+        self.assertTrue(all(n != n for n in numbers[1:]))
+        strings, numbers = fetch.format_stat_column(self.XSD+'time', ['01:00:30'])
+        self.assertEqual([3630.0], list(numbers))
+        strings, numbers = fetch.format_stat_column(self.XSD+'datetime', ['1970-01-01T01:00:00+01:00'])
+        self.assertEqual([0.0], list(numbers))
+
+    def test_non_iso_falls_back(self):
+        strings, numbers = fetch.format_stat_column(self.XSD+'date', ['5 January 1990'])
+        self.assertEqual(['05 Jan, 1990'], strings)
+
+    def test_booleans(self):
+        strings, numbers = fetch.format_stat_column(self.XSD+'boolean', ['true', 'false', '1', '0', ' TRUE', 'False '])
+        self.assertEqual(['Yes', 'No', 'Yes', 'No', 'Yes', 'No'], strings)
+        self.assertEqual([1.0, 0.0, 1.0, 0.0, 1.0, 0.0], list(numbers))
+        strings, numbers = fetch.format_stat_column(self.XSD+'boolean', ['', None])
+        self.assertEqual(['Unknown', 'Unknown'], strings)
+
+    def test_member_cards_by_column(self):
+        statistics = [{ 'type': self.XSD+'double' }, { 'type': self.XSD+'date' }]
+        results = [
+            { 'o': 'http://dbpedia.org/resource/A_thing', 'name': None, 'description': None, 'image': None,
+              'stat0': '3|4', 'stat1': '2000-01-01' },
+            { 'o': 'http://dbpedia.org/resource/B', 'name': 'b', 'description': 'B is. Yes.', 'image': 'b.png',
+              'stat1': None },
+        ]
+        cards = fetch.member_cards(statistics, results)
+        self.assertEqual(['3', '01 Jan, 2000'], cards[0]['stats'])
+        self.assertEqual([3.0, 946684800.0], cards[0]['values'])
+        self.assertEqual(['Unknown', 'Unknown'], cards[1]['stats'])
+        self.assertEqual([None, None], cards[1]['values'])
+        self.assertEqual('B', cards[1]['name'])
+
+
+class CategoryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = store.CategoryStore(os.path.join(self.tempdir.name, 'categories.sqlite'))
+        
+    def tearDown(self):
+        self.tempdir.cleanup()
+        
+    def test_draws_each_category_once(self):
+        self.store.populate([('a', 30), ('b', 40), ('c', 50)])
+        drawn = [self.store.draw() for i in range(4)]
+        self.assertEqual({'a', 'b', 'c'}, set(drawn[:3]))
+        self.assertIsNone(drawn[3])
+        
+    def test_put_back_is_drawn_next(self):
+        self.store.populate([('a', 30), ('b', 40), ('c', 50)])
+        cat = self.store.draw()
+        self.store.put_back(cat)
+        self.assertEqual(cat, self.store.draw())
+        
+    def test_rejected_not_put_back(self):
+        self.store.populate([('a', 30)])
+        self.store.record_screening(self.store.draw(), store.Verdict.INSUFFICIENT_STATS, 2)
+        self.assertEqual(0, self.store.count_available())
+        
+    def test_migrates_json_cache_file(self):
+        cache_file = os.path.join(self.tempdir.name, 'troptumps')
+        with open(cache_file, 'w') as f:
+            json.dump(['b', 'a', 'c'], f)
+        self.store.migrate(cache_file)
+        self.assertFalse(os.path.exists(cache_file))
+        self.assertTrue(self.store.is_populated())
+        self.assertEqual(['b', 'a', 'c'], [self.store.draw() for i in range(3)])
+
+    def test_refresh_resumes_and_completes(self):
+        self.assertEqual((None, set()), self.store.refresh_progress())
+        self.store.begin_refresh(3)
+        self.assertFalse(self.store.add_page(2, [('c', 50)]))
+        self.assertFalse(self.store.add_page(0, [('a', 30), ('b', 40)]))
+        self.assertEqual((3, {0, 2}), self.store.refresh_progress())
+        self.assertFalse(self.store.is_populated())
+        self.assertEqual(3, self.store.count_available())
+        self.assertTrue(self.store.add_page(1, []))
+        self.assertTrue(self.store.is_populated())
+        self.assertEqual((None, set()), self.store.refresh_progress())
+
+    def test_stopped_refresh_leaves_pages(self):
+        config = { fetch.FetchVars.CATEGORY_STORE: self.store, fetch.FetchVars.DUMP: None,
+                   fetch.FetchVars.CATEGORY_REFRESH: None, fetch.FetchVars.REFRESH_STOP: threading.Event() }
+        def query_page(config, page):
+            # only the first page comes back before the run ends
+            if page > 0:
+                config[fetch.FetchVars.REFRESH_STOP].wait(10)
+            return [ { 'c': 'cat{}'.format(page), 'n': '40' } ]
+        numclasses = [ { 'n': str(fetch.CATEGORY_PAGE_SIZE * 10) } ]
+        with unittest.mock.patch.object(fetch, 'query_class_count', lambda config: numclasses), \
+                unittest.mock.patch.object(fetch, 'query_category_page', query_page):
+            self.assertEqual('cat0', fetch.get_category(config))
+            refresh = config[fetch.FetchVars.CATEGORY_REFRESH]
+            fetch.stop_refresh(config)
+        self.assertTrue(refresh.done())
+        self.assertIsNone(config[fetch.FetchVars.CATEGORY_REFRESH])
+        numpages, done = self.store.refresh_progress()
+        self.assertEqual(10, numpages)
+        self.assertIn(0, done)
+        self.assertLess(len(done), 10)
+
+
+
+class ScreeningTests(unittest.TestCase):
+
+    DBO = 'http://dbpedia.org/ontology/'
+    DBP = 'http://dbpedia.org/property/'
+    XSD_DOUBLE = 'http://www.w3.org/2001/XMLSchema#double'
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = store.CategoryStore(os.path.join(self.tempdir.name, 'categories.sqlite'))
+        self.store.populate([(self.DBO+'Widget', 40)])
+        self.config = { fetch.FetchVars.CATEGORY_STORE: self.store, fetch.FetchVars.DUMP: None }
+        self.members = [ { 'o': 'http://dbpedia.org/resource/Widget_{}'.format(i), 'mn': '5' } for i in range(40) ]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def stat(self, uri, datatype=XSD_DOUBLE):
+        return { 'p': uri, 'sn': '40', 't': datatype }
+
+    def test_skips_duplicate_and_untyped_stats(self):
+        stats = [ self.stat(self.DBO+'height'), self.stat(self.DBP+'height'), self.stat(self.DBO+'untyped', '') ] \
+                + [ self.stat(self.DBO+'stat{}'.format(i)) for i in range(7) ]
+        with unittest.mock.patch.object(fetch, 'query_stats', return_value=stats), \
+                unittest.mock.patch.object(fetch, 'query_members', return_value=self.members), \
+                unittest.mock.patch.object(self.store, 'record_screening', wraps=self.store.record_screening) as rec:
+            category, statistics, members, prefix_lookup = fetch.screen_category(self.config, self.DBO+'Widget')
+        self.assertEqual([self.DBO+'height'] + [ self.DBO+'stat{}'.format(i) for i in range(7) ],
+                         [ s['name'] for s in statistics ])
+        self.assertEqual(40, len(members))
+        rec.assert_called_once_with(self.DBO+'Widget', store.Verdict.VIABLE, 8, 40)
+
+    def test_members_ranked_on_deduped_stats(self):
+        stats = [ self.stat(self.DBO+'height'), self.stat(self.DBP+'height') ] \
+                + [ self.stat(self.DBO+'stat{}'.format(i)) for i in range(10) ]
+        with unittest.mock.patch.object(fetch, 'query_stats', return_value=stats), \
+                unittest.mock.patch.object(fetch, 'query_members', return_value=self.members) as query_members:
+            category, statistics, members, prefix_lookup = fetch.screen_category(self.config, self.DBO+'Widget')
+        self.assertEqual([self.DBO+'height'] + [ self.DBO+'stat{}'.format(i) for i in range(9) ],
+                         [ s['name'] for s in query_members.call_args[0][3] ])
+        self.assertEqual(statistics, query_members.call_args[0][3])
+
+    def test_members_not_queried_without_stats(self):
+        stats = [ self.stat(self.DBO+'height'), self.stat(self.DBP+'height') ]
+        with unittest.mock.patch.object(fetch, 'query_stats', return_value=stats), \
+                unittest.mock.patch.object(fetch, 'query_members') as query_members:
+            self.assertIsNone(fetch.screen_category(self.config, self.DBO+'Widget'))
+        query_members.assert_not_called()
+
+
+class OfflineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        cachefile = os.path.join(self.tempdir.name, 'cache')
+        patchers = [ unittest.mock.patch.object(fetch, name, value) for name, value in (
+            ('CACHE_FILE', cachefile), ('QUERY_CACHE_DIR', cachefile+'-queries'),
+            ('CATEGORY_DB', cachefile+'.sqlite')) ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = store.CategoryStore(fetch.CATEGORY_DB)
+        self.store.populate([('http://dbpedia.org/ontology/Widget', 40), ('http://dbpedia.org/ontology/Gadget', 40)])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_uncached_categories_left_drawable(self):
+        args = cli.arg_parser().parse_args(['--offline', '--candidates', '1'])
+        with self.assertRaisesRegex(Exception, 'No more categories'):
+            fetch.fetch_deck(args, None)
+        self.assertEqual(2, self.store.count_available())
+
+    def test_new_deck_doesnt_overwrite_existing(self):
+        cwd = os.getcwd()
+        os.chdir(self.tempdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name in ('deck_widgets', 'deck_widgets_2'):
+            os.mkdir(name)
+            with open(os.path.join(name, name+'.jsonl'), 'w') as f:
+                f.write('finished\n')
+        state = {
+            'category': { 'name': 'http://dbpedia.org/ontology/Widget', 'friendly': None, 'description': None,
+                          'image': None },
+            'statistics': [{ 'name': 'http://dbpedia.org/ontology/height', 'type': fetch.XSD+'double',
+                             'friendly': None }],
+            'members': [],
+            'prefix_lookup': {},
+        }
+        config = { fetch.FetchVars.OFFLINE: True }
+        with unittest.mock.patch.object(fetch, 'query_deck_details', return_value=(None, [])), \
+                unittest.mock.patch.object(fetch, 'query_member_details', return_value=[]), \
+                self.assertLogs(level='WARN') as logs:
+            output_dir = fetch.build_deck(config, state)
+        self.assertEqual(os.path.join(self.tempdir.name, 'deck_widgets_3'), os.path.realpath(output_dir))
+        self.assertTrue(os.path.exists(os.path.join(output_dir, 'deck_widgets_3.jsonl')))
+        self.assertIn('already exists', logs.output[0])
+        for name in ('deck_widgets', 'deck_widgets_2'):
+            self.assertEqual([name+'.jsonl'], os.listdir(name))
+            with open(os.path.join(name, name+'.jsonl')) as f:
+                self.assertEqual('finished\n', f.read())
+
+    def test_finished_deck_leaves_caches_alone(self):
+        with open(fetch.CACHE_FILE, 'w') as f:
+            json.dump(['http://dbpedia.org/ontology/Gizmo'], f)
+        args = cli.arg_parser().parse_args(['--datadir', self.tempdir.name])
+        with unittest.mock.patch.object(fetch, 'CategoryStore') as category_store:
+            self.assertEqual(self.tempdir.name, fetch.fetch_deck(args, self.tempdir.name))
+        category_store.assert_not_called()
+        self.assertTrue(os.path.exists(fetch.CACHE_FILE))
+        self.assertFalse(os.path.exists(fetch.QUERY_CACHE_DIR))
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def fake_fetch(self, args, input_dir):
+        # the first deck to get here takes its worker process down with it
+        try:
+            os.close(os.open(os.path.join(self.tempdir.name, 'crashed'), os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return tempfile.mkdtemp(prefix='deck_', dir=self.tempdir.name)
+        os._exit(1)
+
+    def test_worker_crash_leaves_batch_intact(self):
+        args = cli.arg_parser().parse_args(['--count', '4', '--jobs', '2', '-l', 'error'])
+        with unittest.mock.patch.object(fetch, 'fetch_deck', self.fake_fetch), \
+                unittest.mock.patch.object(pdf, 'create_pdf'), \
+                self.assertLogs(level='INFO') as logs:
+            failures = batch.run_batch(args)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir.name, 'crashed')))
+        self.assertEqual(0, failures)
+        self.assertEqual(['Deck {} of 4 done'.format(i) for i in range(1, 5)], 
+                         sorted(r.getMessage().split(':')[0] for r in logs.records if ' done: ' in r.getMessage()))
+
+
+class DeckFileTests(unittest.TestCase):
+
+    HEADER = { 'name': 'Widgets', 'description': None, 'stats': ['Height', 'Weight'] }
+    CARDS = [
+        { 'name': 'Widget {}'.format(i), 'description': None, 'image': None, 'stats': [str(i), '2'] } 
+        for i in range(3)
+    ]
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.deck_dir = os.path.join(self.tempdir.name, 'deck_widgets')
+        os.mkdir(self.deck_dir)
+        
+    def tearDown(self):
+        self.tempdir.cleanup()
+        
+    def test_round_trip(self):
+        path = os.path.join(self.deck_dir, 'deck_widgets.jsonl')
+        deckfile.write_deck(path, self.HEADER, iter(self.CARDS))
+        self.assertEqual(path, deckfile.deck_file(self.deck_dir))
+        self.assertEqual(self.HEADER, deckfile.read_header(path))
+        self.assertEqual(self.CARDS, list(deckfile.read_cards(path)))
+        
+    def test_failed_write_leaves_no_file(self):
+        def failing():
+            yield self.CARDS[0]
+            raise ValueError()
+        path = os.path.join(self.deck_dir, 'deck_widgets.jsonl')
+        with self.assertRaises(ValueError):
+            deckfile.write_deck(path, self.HEADER, failing())
+        self.assertEqual([], os.listdir(self.deck_dir))
+        
+    def test_reads_json_deck(self):
+        path = os.path.join(self.deck_dir, 'deck_widgets.json')
+        with open(path, 'w') as f:
+            json.dump(dict(self.HEADER, cards=self.CARDS), f, indent=2)
+        self.assertEqual(path, deckfile.deck_file(self.deck_dir))
+        self.assertEqual(self.HEADER, deckfile.read_header(path))
+        self.assertEqual(self.CARDS, list(deckfile.read_cards(path)))
+
+
+class DumpStoreTests(unittest.TestCase):
+
+    TRIPLES = [
+        '<http://dbpedia.org/ontology/Widget> <{}> <{}> .'.format(dump.RDF_TYPE, dump.OWL_CLASS),
+        '<http://dbpedia.org/ontology/Widget> <{}> "widget"@en .'.format(dump.RDFS_LABEL),
+        '<http://dbpedia.org/resource/W1> <{}> <http://dbpedia.org/ontology/Widget> .'.format(dump.RDF_TYPE),
+        '<http://dbpedia.org/resource/W1> <{}> "Caf\\u00E9 \\"one\\""@en-GB .'.format(dump.RDFS_LABEL),
+        '<http://dbpedia.org/resource/W1> <{}> "Widget un"@fr .'.format(dump.RDFS_LABEL),
+        '<http://dbpedia.org/resource/W1> <{}> <http://example.org/w1.png> .'.format(dump.DBO_THUMBNAIL),
+        '<http://dbpedia.org/resource/W1> <http://dbpedia.org/ontology/height> "1.5"^^<{}double> .'.format(dump.XSD),
+        '<http://dbpedia.org/resource/W1> <http://dbpedia.org/ontology/built> "1990-01-01"^^<{}date> .'.format(dump.XSD),
+        '<http://dbpedia.org/resource/W1> <http://dbpedia.org/ontology/name> "Bob" .',
+        '<http://dbpedia.org/resource/W1> <http://dbpedia.org/ontology/wikiPageID> "12"^^<{}integer> .'.format(dump.XSD),
+        'not a triple',
+    ]
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.store = dump.DumpStore(os.path.join(self.tempdir.name, 'dump.sqlite'))
+        
+    def tearDown(self):
+        self.tempdir.cleanup()
+        
+    def test_parses_only_needed_triples(self):
+        rows = list(dump.parse_triples(self.TRIPLES))
+        self.assertIn(('labels', ('http://dbpedia.org/resource/W1', 'Caf\u00e9 "one"')), rows)
+        self.assertEqual({'types', 'labels', 'thumbnails', 'stats'}, { t for t, r in rows })
+        self.assertEqual({'http://dbpedia.org/ontology/height', 'http://dbpedia.org/ontology/built'}, 
+                         { r[1] for t, r in rows if t == 'stats' })
+        
+    def test_answers_deck_queries(self):
+        self.store.ingest(self.TRIPLES)
+        self.assertEqual([{ 'c': 'http://dbpedia.org/ontology/Widget', 'n': '1' }], self.store.categories(1, 10))
+        stats = self.store.top_stats('http://dbpedia.org/ontology/Widget', 10)
+        self.assertEqual(2, len(stats))
+        members = self.store.top_members('http://dbpedia.org/ontology/Widget', [s['p'] for s in stats], 2, 10)
+        self.assertEqual([{ 'o': 'http://dbpedia.org/resource/W1' }], members)
+        details = self.store.member_details([members[0]['o']], ['http://dbpedia.org/ontology/height'])
+        self.assertEqual('http://example.org/w1.png', details[0]['image'])
+        self.assertEqual('1.5', details[0]['stat0'])
+
+    def test_screening_and_details_queries(self):
+        self.store.ingest(self.TRIPLES)
+        config = { fetch.FetchVars.DUMP: self.store }
+        category = { 'name': 'http://dbpedia.org/ontology/Widget' }
+        stats = fetch.query_stats(config, {}, category)
+        self.assertEqual(2, len(stats))
+        statistics = [{ 'name': s['p'] } for s in stats]
+        with unittest.mock.patch.object(fetch, 'MIN_NUM_STATS', 2):
+            members = fetch.query_members(config, {}, category, statistics)
+        self.assertEqual(['http://dbpedia.org/resource/W1'], [m['o'] for m in members])
+        details, labels = fetch.query_deck_details(config, {}, category, statistics)
+        self.assertEqual('widget', details['name'])
+        self.assertEqual([], labels)
+
+
+class ChunkedReader:
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        
+    def read(self, size=-1):
+        chunk, self.data = self.data[:self.size], self.data[self.size:]
+        return chunk
+
+
+class QueryResultsTests(unittest.TestCase):
+
+    RESULTS = { 
+        'head': { 'link': [], 'vars': ['c', 'n'] },
+        'results': { 'distinct': False, 'ordered': True, 'bindings': [
+            { 'c': { 'type': 'uri', 'value': 'http://dbpedia.org/ontology/Caf\u00e9' }, 
+              'n': { 'type': 'typed-literal', 'datatype': 'http://www.w3.org/2001/XMLSchema#integer', 'value': '31' } },
+            { 'c': { 'type': 'uri', 'value': 'http://dbpedia.org/ontology/Widget' }, 
+              'n': { 'type': 'typed-literal', 'datatype': 'http://www.w3.org/2001/XMLSchema#integer', 'value': '40' } },
+        ]},
+    }
+    ROWS = [{ 'c': 'http://dbpedia.org/ontology/Caf\u00e9', 'n': '31' }, 
+            { 'c': 'http://dbpedia.org/ontology/Widget', 'n': '40' }]
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_reads_bindings_across_chunks(self):
+        data = json.dumps(self.RESULTS, indent=1, ensure_ascii=False).encode('utf-8')
+        for size in (1, 3, 7, len(data)):
+            with self.subTest(size=size):
+                self.assertEqual(self.ROWS, list(fetch.read_bindings(ChunkedReader(data, size))))
+                
+    def test_empty_and_truncated_results(self):
+        self.assertEqual([], list(fetch.read_bindings(ChunkedReader(b'{"results": {"bindings": []}}', 5))))
+        data = json.dumps(self.RESULTS).encode('utf-8')
+        with self.assertRaises(ValueError):
+            list(fetch.read_bindings(ChunkedReader(data[:len(data)//2], 5)))
             
+    def test_cache_keeps_rows_not_consumed(self):
+        qc = cache.QueryCache(self.tempdir.name)
+        rows = qc.put_rows('dataset', 'SELECT ?c', iter(self.ROWS))
+        self.assertEqual(self.ROWS[0], next(rows))
+        rows.close()
+        self.assertEqual(self.ROWS, qc.get('dataset', 'SELECT ?c'))
+        
+    def test_cache_discards_failed_results(self):
+        def failing():
+            yield self.ROWS[0]
+            raise ValueError()
+        qc = cache.QueryCache(self.tempdir.name)
+        with self.assertRaises(ValueError):
+            list(qc.put_rows('dataset', 'SELECT ?c', failing()))
+        self.assertIsNone(qc.get('dataset', 'SELECT ?c'))
+        self.assertEqual([], os.listdir(self.tempdir.name))
+
+    def test_cache_streams_rows(self):
+        # each row is passed on as it's read, and the entry only appears once they've all been read
+        pulled = []
+        def source():
+            for row in self.ROWS:
+                pulled.append(row)
+                yield row
+        qc = cache.QueryCache(self.tempdir.name)
+        rows = qc.put_rows('dataset', 'SELECT ?c', source())
+        self.assertEqual(self.ROWS[0], next(rows))
+        self.assertEqual(1, len(pulled))
+        self.assertIsNone(qc.get('dataset', 'SELECT ?c'))
+        self.assertEqual(self.ROWS[1:], list(rows))
+        self.assertEqual(self.ROWS, qc.get('dataset', 'SELECT ?c'))
+
+    def test_cache_expires_entries(self):
+        qc = cache.QueryCache(self.tempdir.name)
+        qc.put('dataset', 'SELECT ?c', self.ROWS, ttl=-1)
+        qc.put('dataset', 'SELECT ?n', self.ROWS)
+        # offline, stale results are better than none
+        offline = cache.QueryCache(self.tempdir.name, offline=True)
+        self.assertEqual(self.ROWS, offline.get('dataset', 'SELECT ?c'))
+        self.assertIsNone(qc.get('dataset', 'SELECT ?c'))
+        self.assertEqual(1, len(os.listdir(self.tempdir.name)))
+        self.assertEqual(self.ROWS, qc.get('dataset', 'SELECT ?n'))
+        with self.assertRaises(cache.CacheMiss):
+            offline.get('dataset', 'SELECT ?c')
+
+    def test_cache_evicts_least_recently_used(self):
+        qc = cache.QueryCache(self.tempdir.name)
+        queries = [ 'SELECT ?{}'.format(n) for n in 'abc' ]
+        for i, q in enumerate(queries):
+            qc.put('dataset', q, self.ROWS)
+            path = os.path.join(self.tempdir.name, cache.query_key('dataset', q) + cache.ENTRY_SUFFIX)
+            os.utime(path, (1000+i, 1000+i))
+        # using the oldest entry makes the second the least recently used
+        qc.get('dataset', queries[0])
+        entry_size = os.path.getsize(path)
+        qc = cache.QueryCache(self.tempdir.name, max_size=entry_size*3.5)
+        qc.put('dataset', 'SELECT ?d', self.ROWS)
+        self.assertIsNone(qc.get('dataset', queries[1]))
+        for q in (queries[0], queries[2], 'SELECT ?d'):
+            self.assertEqual(self.ROWS, qc.get('dataset', q))
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # Serves canned responses over keep-alive connections for the connection pool tests
+    protocol_version = 'HTTP/1.1'
+    BODY = b'widget ' * 1000
+
+    def do_GET(self):
+        if self.path == '/plain':
+            self.reply(200, self.BODY)
+        elif self.path == '/gzip':
+            self.reply(200, gzip.compress(self.BODY), { 'Content-Encoding': 'gzip' })
+        elif self.path == '/redirect':
+            self.reply(302, b'', { 'Location': '/plain' })
+        else:
+            self.reply(404, b'no such thing')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.reply(303, b'', { 'Location': '/plain' })
+
+    def reply(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+        cls.base = 'http://{}:{}'.format(*cls.httpd.server_address[:2])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self):
+        self.pool = net.ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def get(self, path, method='GET', body=None):
+        with self.pool.request(method, self.base+path, body, timeout=10) as res:
+            return res, res.read()
+
+    def test_reuses_connections(self):
+        for i in range(3):
+            res, body = self.get('/plain')
+            self.assertEqual(StubHandler.BODY, body)
+        stats = self.pool.stats()
+        self.assertEqual((3, 1, 2), (stats['requests'], stats['connections_opened'], stats['connections_reused']))
+
+    def test_decodes_gzip(self):
+        res, body = self.get('/gzip')
+        self.assertEqual(StubHandler.BODY, body)
+        self.assertLess(res.bytes_received, len(body))
+        self.assertEqual(len(body)-res.bytes_received, self.pool.stats()['bytes_saved'])
+
+    def test_follows_redirects(self):
+        res, body = self.get('/redirect')
+        self.assertEqual((200, self.base+'/plain'), (res.status, res.url))
+        self.assertEqual(StubHandler.BODY, body)
+        # a POST answered with 303 is followed with a GET
+        res, body = self.get('/form', 'POST', b'a=1')
+        self.assertEqual((200, self.base+'/plain'), (res.status, res.url))
+
+    def test_not_found(self):
+        with self.assertRaises(HTTPError) as cm:
+            self.get('/missing')
+        self.assertEqual(404, cm.exception.code)
+        self.assertEqual(b'no such thing', cm.exception.read())
+        # the connection is still good for the next request
+        self.get('/plain')
+        self.assertEqual(1, self.pool.stats()['connections_opened'])
+
+
+class ImageStubHandler(http.server.BaseHTTPRequestHandler):
+    # Serves fake card images, counting the requests for each, for the image download tests
+    protocol_version = 'HTTP/1.1'
+    requests = collections.Counter()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        with self.lock:
+            self.requests[path] += 1
+            attempt = self.requests[path]
+        params = urllib.parse.parse_qs(query)
+        time.sleep(float(params.get('delay', ['0'])[0]))
+        kind, _, name = path[1:].partition('/')
+        if kind == 'png':
+            self.reply(200, 'image {}'.format(name).encode('utf-8'), 'image/png')
+        elif kind == 'jpg':
+            self.reply(200, 'image {}'.format(name).encode('utf-8'), 'image/jpeg')
+        elif kind == 'flaky':
+            # fails the first time it's asked for
+            if attempt == 1:
+                self.reply(500, b'try again', 'text/plain')
+            else:
+                self.reply(200, 'image {}'.format(name).encode('utf-8'), 'image/png')
+        elif kind == 'page':
+            self.reply(200, b'<html></html>', 'text/html')
+        elif kind == 'stall':
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            self.wfile.write(b'x' * 10)
+            self.wfile.flush()
+            time.sleep(2)
+        else:
+            self.reply(404, b'no such thing', 'text/plain')
+
+    def reply(self, status, body, contenttype):
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageStubHandler)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+        cls.base = 'http://{}:{}'.format(*cls.httpd.server_address[:2])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.config = { fetch.FetchVars.OFFLINE: False, fetch.FetchVars.DOWNLOAD_WORKERS: 4 }
+        ImageStubHandler.requests.clear()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def cards(self, *paths):
+        return [ { 'name': 'Card {}'.format(i), 'image': self.base+p if p else None } for i, p in enumerate(paths) ]
+
+    def download(self, cards):
+        return list(fetch.download_images(self.config, cards, self.tempdir.name))
+
+    def test_downloads_in_card_order(self):
+        # the earlier cards' images take longest to arrive
+        paths = [ '/png/{}?delay={}'.format(i, 0.05*(5-i)) for i in range(5) ] + [ '/jpg/5', None ]
+        with self.assertLogs(level='INFO') as logs:
+            cards = self.download(self.cards(*paths))
+        self.assertEqual([ 'Card {}'.format(i) for i in range(7) ], [ c['name'] for c in cards ])
+        self.assertEqual([ 'card{:02d}.png'.format(i) for i in range(5) ] + ['card05.jpg', None],
+                         [ c['image'] for c in cards ])
+        for i in range(6):
+            with open(os.path.join(self.tempdir.name, cards[i]['image']), 'rb') as f:
+                self.assertEqual('image {}'.format(i).encode('utf-8'), f.read())
+        self.assertTrue(any(re.search(r'Downloaded 6 images \(0\.0 KB, 0 duplicates\) in [\d.]+s: [\d.]+ images/s',
+                                      line) for line in logs.output), logs.output)
+
+    def test_skips_missing_and_non_images(self):
+        cards = self.download(self.cards('/missing', '/page/1', '/png/2'))
+        self.assertEqual([None, None, 'card02.png'], [ c['image'] for c in cards ])
+        self.assertEqual(sorted(['card02.png', fetch.IMAGES_CHECKPOINT_FILE]), sorted(os.listdir(self.tempdir.name)))
+
+    def test_gives_up_on_stalled_download(self):
+        with unittest.mock.patch.object(fetch, 'DOWNLOAD_TIMEOUT', 0.3):
+            starttime = time.monotonic()
+            cards = self.download(self.cards('/stall/0', '/png/1'))
+        self.assertLess(time.monotonic()-starttime, 1.5)
+        self.assertEqual([None, 'card01.png'], [ c['image'] for c in cards ])
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, 'card00.png.part')))
+
+    def test_duplicates_share_first_file(self):
+        paths = '/png/0', '/png/1', '/png/0', '/jpg/0?delay=0', None
+        with self.assertLogs(level='INFO') as logs:
+            cards = self.download(self.cards(*paths))
+        self.assertEqual(['card00.png', 'card01.png', 'card00.png', 'card00.png', None], [ c['image'] for c in cards ])
+        self.assertEqual(sorted(['card00.png', 'card01.png', fetch.IMAGES_CHECKPOINT_FILE]),
+                         sorted(os.listdir(self.tempdir.name)))
+        self.assertTrue(any('2 duplicates' in line for line in logs.output), logs.output)
+
+    def test_resumes_after_failure(self):
+        # the flaky image has the same content as the first, which a resumed attempt still spots
+        cards = self.cards('/png/0', '/png/1', '/flaky/0', '/png/3?delay=0.1')
+        with self.assertRaises(HTTPError):
+            self.download(cards)
+        self.assertEqual([0, 1, 3], sorted(fetch.read_image_progress(self.tempdir.name)))
+        resumed = self.download(cards)
+        self.assertEqual(['card00.png', 'card01.png', 'card00.png', 'card03.png'], [ c['image'] for c in resumed ])
+        self.assertEqual({ '/png/0': 1, '/png/1': 1, '/flaky/0': 2, '/png/3': 1 }, dict(ImageStubHandler.requests))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name, 'card02.png')))
+
+    def test_resumes_after_interruption(self):
+        cards = self.cards(*[ '/png/{}'.format(i) for i in range(6) ])
+        self.config[fetch.FetchVars.DOWNLOAD_WORKERS] = 1
+        downloads = fetch.download_images(self.config, cards, self.tempdir.name)
+        self.assertEqual(['card00.png', 'card01.png'], [ next(downloads)['image'] for i in range(2) ])
+        downloads.close()
+        done = fetch.read_image_progress(self.tempdir.name)
+        self.assertIn(0, done)
+        self.assertIn(1, done)
+        resumed = self.download(cards)
+        self.assertEqual([ 'card{:02d}.png'.format(i) for i in range(6) ], [ c['image'] for c in resumed ])
+        for i in done:
+            self.assertEqual(1, ImageStubHandler.requests['/png/{}'.format(i)])
+
+    def test_offline_downloads_nothing(self):
+        self.config[fetch.FetchVars.OFFLINE] = True
+        with self.assertLogs(level='WARN'):
+            cards = self.download(self.cards('/png/0'))
+        self.assertEqual([None], [ c['image'] for c in cards ])
+        self.assertEqual(0, sum(ImageStubHandler.requests.values()))
+
+
+class RetryTests(unittest.TestCase):
+
+    def error(self, retry_after):
+        headers = email.message.Message()
+        headers['Retry-After'] = retry_after
+        return HTTPError('http://example.org', 503, 'Service Unavailable', headers, None)
+
+    def test_retry_after(self):
+        self.assertEqual(120, net.retry_after(self.error('120')))
+        self.assertAlmostEqual(60, net.retry_after(self.error(email.utils.formatdate(time.time()+60, usegmt=True))), 
+                               delta=2)
+        self.assertEqual(0, net.retry_after(self.error('Wed, 21 Oct 2015 07:28:00 GMT')))
+        self.assertIsNone(net.retry_after(self.error('soon')))
+        self.assertIsNone(net.retry_after(ValueError()))
+        
+    def test_backoff_grows_and_honours_server(self):
+        for attempt in range(10):
+            delay = fetch.retry_delay(attempt, ValueError())
+            self.assertTrue(0 <= delay <= min(fetch.MAX_RETRY_DELAY, fetch.ERROR_PAUSE_TIME * 2**attempt))
+        self.assertGreaterEqual(fetch.retry_delay(0, self.error('30')), 30)
+
+
+class TraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, 'trace.json')
+        
+    def tearDown(self):
+        trace.finish(self.filename)
+        self.tempdir.cleanup()
+        
+    def test_off_by_default(self):
+        self.assertFalse(trace.enabled())
+        with trace.span('stage', x=1) as span:
+            span.set(y=2)
+        trace.finish(self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+        
+    def test_writes_chrome_trace(self):
+        trace.start('inner', 'cprofile')
+        with trace.span('outer'):
+            for i in range(2):
+                with trace.span('inner', i=i) as span:
+                    span.set(done=True)
+        trace.finish(self.filename)
+        with open(self.filename) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(['inner', 'inner', 'outer'], [e['name'] for e in events])
+        self.assertEqual({ 'i': 1, 'done': True }, events[1]['args'])
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 for e in events))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir.name, 'trace.prof')))
+
+    def test_threads_nest_separately(self):
+        # the first thread's occurrence of the stage ends while the second's is still open
+        trace.start('stage', 'cprofile')
+        steps = [ threading.Event() for i in range(3) ]
+        profilers, tids = {}, {}
+        def in_first():
+            steps[0].set()
+            steps[1].wait(10)
+        def in_second():
+            steps[1].set()
+            steps[2].wait(10)
+        def first():
+            tids['first'] = threading.get_ident()
+            with trace.span('stage', thread='first'):
+                in_first()
+            profilers['first'] = sys.getprofile()
+            steps[2].set()
+        def second():
+            tids['second'] = threading.get_ident()
+            steps[0].wait(10)
+            with trace.span('stage', thread='second'):
+                with trace.span('inner', thread='second'):
+                    in_second()
+            profilers['second'] = sys.getprofile()
+        threads = [ threading.Thread(target=first), threading.Thread(target=second) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        trace.finish(self.filename)
+        self.assertEqual({ 'first': None, 'second': None }, profilers)
+        with open(self.filename) as f:
+            events = json.load(f)['traceEvents']
+        self.assertEqual(3, len(events))
+        for e in events:
+            self.assertEqual(tids[e['args']['thread']], e['tid'])
+        # both threads' occurrences are in the profile
+        with open(os.path.join(self.tempdir.name, 'trace.prof.txt')) as f:
+            profile = f.read()
+        self.assertIn('(in_first)', profile)
+        self.assertIn('(in_second)', profile)
+
+    def test_adds_up_allocations(self):
+        trace.start('stage', 'tracemalloc')
+        kept, lines = [], []
+        for i in range(2):
+            with trace.span('stage'):
+                lines.append(sys._getframe().f_lineno + 1)
+                kept.append([ object() for j in range(1000) ] if i == 0 else [ object() for j in range(2000) ])
+        trace.finish(self.filename)
+        with open(os.path.join(self.tempdir.name, 'trace.tracemalloc.txt')) as f:
+            allocations = f.read()
+        # the same line in both occurrences, counted once for each
+        self.assertEqual(lines[0], lines[1])
+        counts = re.findall(r'tests\.py:{}: size=[\d.]+ KiB, count=(\d+)'.format(lines[0]), allocations)
+        self.assertEqual(1, len(counts), allocations)
+        self.assertGreaterEqual(int(counts[0]), 3000)
+
+
+class StartupTests(unittest.TestCase):
+
+    # modules that printing the version or an argument error mustn't wait on
+    HEAVY_MODULES = 'reportlab', 'pypdf', 'dateutil', 'PIL', 'troptumps.pdf', 'troptumps.fetch'
+
+    def import_times(self, *args):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'troptumps'] + list(args),
+                              capture_output=True, text=True)
+        times = {}
+        for line in proc.stderr.splitlines():
+            fields = line.split('|')
+            if line.startswith('import time:') and fields[0].split(':')[1].strip().isdigit():
+                times[fields[2].strip()] = int(fields[0].split(':')[1]) / 1000
+        return times
+
+    def test_version_and_errors_skip_heavy_imports(self):
+        for args in (['--version'], ['--pagesize', 'nosuchsize']):
+            with self.subTest(args=args):
+                times = self.import_times(*args)
+                self.assertIn('troptumps.options', times)
+                heavy = [ n for n in times if n.split('.')[0] in self.HEAVY_MODULES or n in self.HEAVY_MODULES ]
+                self.assertEqual([], heavy)
+
+    def test_parsing_skips_heavy_imports(self):
+        code = 'import sys, json, troptumps.__main__ as m; m.arg_parser().parse_args([]); ' \
+               'print(json.dumps(list(sys.modules)))'
+        proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        modules = json.loads(proc.stdout)
+        self.assertIn('troptumps.options', modules)
+        self.assertEqual([], [ n for n in modules if n.split('.')[0] in self.HEAVY_MODULES or n in self.HEAVY_MODULES ])
+
+    def test_page_sizes_match_reportlab(self):
+        from reportlab.lib import pagesizes
+        self.assertEqual(sorted(s.lower() for s in dir(pagesizes) if re.match(r'[A-Z]', s)),
+                         sorted(options.PAGE_SIZES))
+
+    def test_named_colour(self):
+        self.assertEqual((0.0, 1.0, 0.5), cli.colour_string('Red'))
+        with self.assertRaises(ValueError):
+            cli.colour_string('nosuchcolour')
+
+
+class ServeTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.TemporaryDirectory()
+        cachefile = os.path.join(cls.tempdir.name, 'cache')
+        cls.patchers = [ unittest.mock.patch.object(fetch, name, value) for name, value in (
+            ('CACHE_FILE', cachefile), ('QUERY_CACHE_DIR', cachefile+'-queries'),
+            ('CATEGORY_DB', cachefile+'.sqlite')) ]
+        for patcher in cls.patchers:
+            patcher.start()
+        deck_dir = os.path.join(cls.tempdir.name, 'deck_tests')
+        os.makedirs(deck_dir)
+        deckfile.write_deck(os.path.join(deck_dir, 'deck_tests.jsonl'),
+                            { 'name': 'Tests', 'description': 'Some tests.', 'stats': ['Height', 'Weight'] },
+                            [ { 'name': 'Test {}'.format(i), 'description': None, 'image': None,
+                                'stats': [str(i), 'Unknown'] } for i in range(3) ])
+        args = cli.arg_parser().parse_args(['--serve', '127.0.0.1:0', '--offline', '--queue', '0', '-l', 'error'])
+        cls.httpd = serve.start_server(args, cli.arg_parser(exit_on_error=False), cls.tempdir.name)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        cls.httpd.deck_server.close()
+        for patcher in cls.patchers:
+            patcher.stop()
+        cls.tempdir.cleanup()
+
+    def post(self, options):
+        conn = http.client.HTTPConnection(*self.httpd.server_address[:2], timeout=60)
+        try:
+            conn.request('POST', '/decks', json.dumps(options))
+            res = conn.getresponse()
+            return res, res.read()
+        finally:
+            conn.close()
+
+    def test_renders_then_serves_from_cache(self):
+        res, first = self.post({ 'deck': 'deck_tests', 'color': 'red' })
+        self.assertEqual(200, res.status)
+        self.assertTrue(first.startswith(b'%PDF'))
+        self.assertEqual(('deck_tests', 'miss'), (res.getheader('X-Deck'), res.getheader('X-Cache')))
+        res, second = self.post({ 'deck': 'deck_tests', 'color': 'red' })
+        self.assertEqual('hit', res.getheader('X-Cache'))
+        self.assertEqual(first, second)
+        res, body = self.post({ 'deck': 'deck_tests', 'color': 'red', 'sqcorners': True })
+        self.assertEqual('miss', res.getheader('X-Cache'))
+
+    def test_rejects_bad_jobs(self):
+        cases = [
+            ({ 'deck': 'deck_tests', 'pagesize': 'nosuchsize' }, 400),
+            ({ 'deck': 'deck_tests', 'color': 'nosuchcolour' }, 400),
+            ({ 'loglevel': 'debug' }, 400),
+            ({ 'deck': '../deck_tests' }, 404),
+            ({ 'deck': 'deck_nosuch' }, 404),
+        ]
+        for job, status in cases:
+            with self.subTest(job=job):
+                res, body = self.post(job)
+                self.assertEqual(status, res.status)
+                self.assertIn('error', json.loads(body))
+
+    def test_job_errors_dont_exit(self):
+        parser = cli.arg_parser(exit_on_error=False)
+        server_args = parser.parse_args([])
+        for job in ({ 'pagesize': 'nosuchsize' }, { 'pagemargin': 'wide' }, { 'color': 'nosuchcolour' }):
+            with self.subTest(job=job):
+                with self.assertRaises(serve.JobError) as cm:
+                    serve.job_args(parser, server_args, job)
+                self.assertEqual(400, cm.exception.status)
+                self.assertIn(next(iter(job)), str(cm.exception))
+
+    def test_turns_jobs_away_when_full(self):
+        # the one worker is taken and there's no queue
+        slots = self.httpd.deck_server.slots
+        self.assertTrue(slots.acquire(blocking=False))
+        try:
+            res, body = self.post({ 'deck': 'deck_tests', 'pagesize': 'letter' })
+        finally:
+            slots.release()
+        self.assertEqual(503, res.status)
+        self.assertEqual(str(serve.RETRY_AFTER), res.getheader('Retry-After'))
+
+
+class NormaliseImageTests(unittest.TestCase):
+
+    # a box an inch across, which is 100 pixels at 100dpi
+    BOX = 72, 72
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def save(self, name, size, mode='RGB', **kwargs):
+        Image.new(mode, size, (200, 100, 50, 128)[:len(mode)]).save(os.path.join(self.dir, name), **kwargs)
+        return name
+
+    def open(self, name):
+        with Image.open(os.path.join(self.dir, name)) as img:
+            return img.format, img.size
+
+    def test_shrinks_to_box(self):
+        name = images.normalise_image(self.dir, self.save('card00.png', (400, 300)), self.BOX, 100)
+        self.assertEqual('card00-100dpi.jpg', name)
+        self.assertEqual(('JPEG', (100, 75)), self.open(name))
+
+    def test_keeps_transparency_as_png(self):
+        name = images.normalise_image(self.dir, self.save('card00.png', (300, 400), 'RGBA'), self.BOX, 100)
+        self.assertEqual('card00-100dpi.png', name)
+        self.assertEqual(('PNG', (75, 100)), self.open(name))
+        img = Image.new('P', (300, 300))
+        img.save(os.path.join(self.dir, 'card01.gif'), transparency=0)
+        self.assertEqual('card01-100dpi.png', images.normalise_image(self.dir, 'card01.gif', self.BOX, 100))
+
+    def test_small_enough_left_alone(self):
+        self.assertEqual('card00.jpg', images.normalise_image(self.dir, self.save('card00.jpg', (100, 50)),
+                                                               self.BOX, 100))
+        self.assertEqual('card01.png', images.normalise_image(self.dir, self.save('card01.png', (50, 50), 'RGBA'),
+                                                               self.BOX, 100))
+        self.assertEqual(['card00.jpg', 'card01.png'], sorted(os.listdir(self.dir)))
+        # small, but not stored the way it would be
+        self.assertEqual('card02-100dpi.jpg', images.normalise_image(self.dir, self.save('card02.png', (50, 50)),
+                                                                     self.BOX, 100))
+
+    def test_reuses_until_original_changes(self):
+        names = [ self.save('card{:02d}.png'.format(i), (400, 400)) for i in range(2) ]
+        lookup = images.normalise_images(self.dir, names, self.BOX, 100, workers=2)
+        self.assertEqual({ n: n.replace('.png', '-100dpi.jpg') for n in names }, lookup)
+        with unittest.mock.patch.object(images, 'normalise_worker') as worker:
+            self.assertEqual(lookup, images.normalise_images(self.dir, names, self.BOX, 100))
+        worker.assert_not_called()
+        # a different resolution isn't the same image
+        self.assertEqual('card00-50dpi.jpg', images.normalise_images(self.dir, names[:1], self.BOX, 50)['card00.png'])
+        later = os.path.getmtime(os.path.join(self.dir, lookup['card01.png'])) + 10
+        os.utime(os.path.join(self.dir, 'card01.png'), (later, later))
+        with unittest.mock.patch.object(images, 'normalise_worker', return_value='card01-100dpi.jpg') as worker:
+            images.normalise_images(self.dir, names, self.BOX, 100)
+        worker.assert_called_once_with(self.dir, 'card01.png', self.BOX, 100)
+
+    def test_oversized_image_falls_back_to_original(self):
+        names = [ self.save('card00.png', (400, 400)), self.save('card01.png', (30, 30)) ]
+        with unittest.mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            lookup = images.normalise_images(self.dir, names, self.BOX, 100, workers=2)
+        self.assertEqual({ 'card00.png': 'card00.png', 'card01.png': 'card01-100dpi.jpg' }, lookup)
+        # and when warnings about merely large images are turned into errors
+        self.save('card02.png', (40, 40))
+        with unittest.mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000), warnings.catch_warnings(), \
+                self.assertLogs(level='WARN'):
+            warnings.simplefilter('error', Image.DecompressionBombWarning)
+            self.assertEqual('card02.png', images.normalise_worker(self.dir, 'card02.png', self.BOX, 100))
+
+
+class FontFallbackTests(unittest.TestCase):
+
+    def setUp(self):
+        pdf.register_fonts()
+        pdf.tag_font_fallbacks.cache_clear()
+
+    def codepoints(self, fontfam):
+        pdf.register_font_family(fontfam)
+        return set(pdf.pdfmetrics.getFont(fontfam).face.charWidths)
+
+    def test_matches_legacy_search(self):
+        pdf.preload_fonts()
+        coverage = pdf.font_coverage()
+        # either side of where the covering fonts change, and of the range left untagged
+        edges = { cp + d for start, end in zip(coverage.starts, coverage.ends) for cp in (start, end)
+                  for d in (-1, 0, 1) if 0x20 <= cp + d < 0x110000 and not 0xd800 <= cp + d < 0xe000 }
+        edges |= { 0x1ff, 0x200 }
+        samples = sorted(edges) + [ ord(c) for c in 'aé ẞΩЖשع∀⌘★漢字かな😀\U0010fffd' ]
+        rnd = random.Random(1)
+        for i in range(3000):
+            text = ''.join(chr(rnd.choice(samples)) for j in range(rnd.randint(1, 12)))
+            self.assertEqual(legacy_tag_font_fallbacks(text), pdf.tag_font_fallbacks(text), repr(text))
+
+    def only_serif(self):
+        # a character FreeSerif has and DejaVuSans doesn't
+        return chr(min(self.codepoints('FreeSerif') - self.codepoints('DejaVuSans') - set(range(0x200))))
+
+    def test_mixed_scripts(self):
+        self.assertEqual('Widget <font face="DejaVuSans">Ωмега</font>',
+                         pdf.tag_font_fallbacks('Widget Ωмега'))
+        # a run stays on a fallback font for as long as it has the characters, even past ones no font has
+        serif = self.only_serif()
+        with self.assertLogs(level='WARN') as logs:
+            self.assertEqual('<font face="DejaVuSans">Ω</font><font face="FreeSerif">{}Ω漢</font>'
+                             '<font face="DejaVuSans">Ω</font>'.format(serif),
+                             pdf.tag_font_fallbacks('Ω{}Ω漢Ω'.format(serif)))
+        self.assertIn('0x6f22', logs.output[0])
+
+    def test_font_set_change_forgets_tags(self):
+        text = 'x' + self.only_serif()
+        self.assertEqual('x<font face="FreeSerif">{}</font>'.format(text[1]), pdf.tag_font_fallbacks(text))
+        self.addCleanup(pdf.register_fonts)
+        with unittest.mock.patch.object(pdf, 'FONT_FALLBACK_ORDER', ['DejaVuSans']):
+            pdf.register_fonts()
+            with self.assertLogs(level='WARN'):
+                self.assertEqual(text, pdf.tag_font_fallbacks(text))
+
+
+class FontCacheTests(unittest.TestCase):
+
+    FONT = 'DejaVuSans-Oblique'
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        patcher = unittest.mock.patch.object(pdf, 'FONT_CACHE_DIR', self.tempdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.font_file = os.path.join(pdf.FONT_DIR, self.FONT+'.ttf')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def load(self):
+        # returns the font and whether the font file had to be parsed
+        init = pdf.ttfonts.TTFontFace.__init__
+        with unittest.mock.patch.object(pdf.ttfonts.TTFontFace, '__init__', autospec=True, side_effect=init) as parse:
+            font = pdf.load_font(self.FONT, self.font_file)
+        return font, parse.called
+
+    def assertUsable(self, font):
+        self.assertAlmostEqual(pdf.ttfonts.TTFont(self.FONT, self.font_file).stringWidth('Widget', 10),
+                               font.stringWidth('Widget', 10))
+        pdf.pdfmetrics.registerFont(font)
+        canv = pdf.canvas.Canvas(io.BytesIO())
+        canv.setFont(self.FONT, 10)
+        canv.drawString(0, 0, 'Widget \u0101')
+        canv.save()
+
+    def test_parses_once(self):
+        font, parsed = self.load()
+        self.assertTrue(parsed)
+        self.assertEqual(1, len(os.listdir(self.tempdir.name)))
+        font, parsed = self.load()
+        self.assertFalse(parsed)
+        self.assertUsable(font)
+
+    def test_stale_entry_ignored(self):
+        self.load()
+        with unittest.mock.patch.object(pdf, 'FONT_CACHE_VERSION', pdf.FONT_CACHE_VERSION+1):
+            font, parsed = self.load()
+            self.assertTrue(parsed)
+            self.assertFalse(self.load()[1])
+        self.assertEqual(2, len(os.listdir(self.tempdir.name)))
+
+    def test_corrupt_entry_replaced(self):
+        self.load()
+        cache_file = os.path.join(self.tempdir.name, os.listdir(self.tempdir.name)[0])
+        with open(cache_file, 'wb') as f:
+            f.write(b'not a pickle')
+        font, parsed = self.load()
+        self.assertTrue(parsed)
+        self.assertUsable(font)
+        self.assertFalse(self.load()[1])
+
+
+@unittest.skipUnless(importlib.util.find_spec('pypdf'), "needs pypdf")
+class ParallelRenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.deck_dir = os.path.join(self.tempdir.name, 'deck_tests')
+        os.mkdir(self.deck_dir)
+        deckfile.write_deck(os.path.join(self.deck_dir, 'deck_tests.jsonl'),
+                            { 'name': 'Tests', 'description': 'Some tests.', 'stats': ['Height', 'Weight'] },
+                            [ { 'name': 'Test {}'.format(i), 'description': 'Test number {}.'.format(i), 
+                                'image': None, 'stats': [str(i), 'Unknown'] } for i in range(30) ])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_matches_serial_render(self):
+        import pypdf
+        texts = []
+        for jobs in (1, 3):
+            args = cli.arg_parser().parse_args(['-d', self.deck_dir, '-c', 'red', '-u', str(jobs), '-l', 'error'])
+            output_file = os.path.join(self.tempdir.name, 'jobs{}.pdf'.format(jobs))
+            pdf.create_pdf(args, self.deck_dir, output_file)
+            texts.append([ page.extract_text() for page in pypdf.PdfReader(output_file).pages ])
+        # four sheets of fronts and backs
+        self.assertEqual(8, len(texts[0]))
+        self.assertEqual(texts[0], texts[1])
+
+
+@unittest.skipUnless(importlib.util.find_spec('pypdf'), "needs pypdf")
+class FormRenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.deck_dir = os.path.join(self.tempdir.name, 'deck_tests')
+        os.mkdir(self.deck_dir)
+        deckfile.write_deck(os.path.join(self.deck_dir, 'deck_tests.jsonl'),
+                            { 'name': 'Tests', 'description': 'Some tests.', 'stats': ['Height', 'Weight'] },
+                            [ { 'name': 'Test {}'.format(i), 'description': 'Test number {}.'.format(i), 
+                                'image': None, 'stats': [str(i), 'Unknown'] } for i in range(30) ])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def render(self, name):
+        import pypdf
+        args = cli.arg_parser().parse_args(['-d', self.deck_dir, '-c', 'red', '-l', 'error'])
+        output_file = os.path.join(self.tempdir.name, name)
+        pdf.create_pdf(args, self.deck_dir, output_file)
+        return pypdf.PdfReader(output_file)
+
+    def test_forms_defined_once(self):
+        reader = self.render('forms.pdf')
+        forms = collections.defaultdict(set)
+        def find_forms(resources):
+            for name, ref in resources.get('/XObject', {}).items():
+                xobj = ref.get_object()
+                if xobj['/Subtype'] == '/Form':
+                    forms[name].add(ref.idnum)
+                    find_forms(xobj.get('/Resources', {}))
+        for page in reader.pages:
+            find_forms(page['/Resources'])
+        self.assertEqual({ '/FormXob.card-frame': 1, '/FormXob.card-back': 1, '/FormXob.backs-page': 1 },
+                         { name: len(ids) for name, ids in forms.items() })
+
+    def test_pages_in_order(self):
+        reader = self.render('forms.pdf')
+        # four sheets of eight cards, fronts then backs, the first front being the deck's
+        texts = [ page.extract_text() for page in reader.pages ]
+        self.assertEqual(8, len(texts))
+        fronts = [ [ int(n) for n in re.findall(r'Test (\d+)\n', t) ] for t in texts[0::2] ]
+        self.assertEqual([ list(range(0, 7)), list(range(7, 15)), list(range(15, 23)), list(range(23, 30)) ], fronts)
+        self.assertEqual([8, 8, 8, 7], [ t.count('Trop Tumps') for t in texts[1::2] ])
+
+    def test_matches_drawing_without_forms(self):
+        def draw_inline(c, name, bbox, draw):
+            c.saveState()
+            draw()
+            c.restoreState()
+        reader = self.render('forms.pdf')
+        with unittest.mock.patch.object(pdf, 'card_form', draw_inline):
+            inline = self.render('inline.pdf')
+        self.assertEqual([ page_drawing(inline, page) for page in inline.pages ],
+                         [ page_drawing(reader, page) for page in reader.pages ])
+
+
+@unittest.skipUnless(importlib.util.find_spec('pypdf'), "needs pypdf")
+class IncrementalRenderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.deck_dir = os.path.join(self.tempdir.name, 'deck_tests')
+        os.mkdir(self.deck_dir)
+        self.path = os.path.join(self.deck_dir, 'deck_tests.jsonl')
+        self.cards = [ { 'name': 'Test {}'.format(i), 'description': 'Test number {}.'.format(i), 'image': None,
+                         'stats': [str(i), 'Unknown'] } for i in range(20) ]
+        self.write_deck()
+        # eight cards to an a4 sheet, so three sheets with the title card
+        self.args = cli.arg_parser().parse_args(['-d', self.deck_dir, '-l', 'error'])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write_deck(self):
+        deckfile.write_deck(self.path, { 'name': 'Tests', 'description': None, 'stats': ['Height', 'Weight'] },
+                            self.cards)
+
+    def render(self, output_file=None):
+        # returns the card ranges drawn
+        with unittest.mock.patch.object(pdf, 'render_cards', wraps=pdf.render_cards) as render_cards:
+            pdf.create_pdf(self.args, self.deck_dir, output_file, incremental=True)
+        return [ call.args[6:8] for call in render_cards.call_args_list ]
+
+    def page_texts(self, path):
+        import pypdf
+        return [ page.extract_text() for page in pypdf.PdfReader(path).pages ]
+
+    def test_redraws_changed_sheets(self):
+        self.assertEqual([(0, 24)], self.render())
+        self.assertEqual([], self.render())
+        self.cards[12]['name'] = 'Changed'
+        self.write_deck()
+        self.assertEqual([(8, 16)], self.render())
+        # the same as drawing it all afresh, in the same colours
+        full_file = os.path.join(self.tempdir.name, 'full.pdf')
+        self.args.color, self.args.seccolor = pdf.load_manifest(self.deck_dir)['colours']
+        pdf.create_pdf(self.args, self.deck_dir, full_file)
+        self.assertEqual(self.page_texts(full_file), self.page_texts(
+            os.path.join(self.deck_dir, 'deck_tests.pdf')))
+
+    def test_missing_output_and_new_options(self):
+        self.render()
+        os.remove(os.path.join(self.deck_dir, 'deck_tests.pdf'))
+        self.assertEqual([], self.render())
+        self.assertTrue(os.path.exists(os.path.join(self.deck_dir, 'deck_tests.pdf')))
+        self.args.sqcorners = True
+        self.assertEqual([(0, 24)], self.render())
+        self.assertEqual(2, len(os.listdir(os.path.join(self.deck_dir, pdf.SHEET_CACHE_DIR))))
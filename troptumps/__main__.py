@@ -6,17 +6,24 @@ import sys
 import logging
 import argparse
 import colorsys
+import functools
 
-from reportlab.lib import pagesizes
-
-from . import pdf
-from . import fetch
+from . import options
+from . import trace
 from . import VERSION
 
 
 DEFAULT_LOG_LEVEL = 'info'
 
 
+@functools.lru_cache(maxsize=None)
+def named_colours():
+    # reportlab's colours are only loaded if a colour is given by name
+    from reportlab.lib import colors
+    return { n: getattr(colors,n).rgb() for n in dir(colors)
+             if isinstance(getattr(colors,n),colors.Color) and re.match(r'^[a-z]+$',n) }
+
+
 def colour_string(string):
     m = re.match(r'^#([0-9a-f]{2})([0-9a-f]{2})([0-9a-f]{2})$', string, re.IGNORECASE)    
     if m:
@@ -30,34 +37,49 @@ def colour_string(string):
         h,l,s = colorsys.rgb_to_hls(r,g,b)
         return h,s,l
         
-    named_colours = { n: getattr(colors,n) for n in dir(colors) 
-                      if isinstance(getattr(colors,n),colors.Color) and re.match(r'^[a-z]+$',n) }
     name = string.replace(' ','').lower()
-    if name in named_colours:
-        r,g,b = named_colours[name].rgb()
+    if name in named_colours():
+        r,g,b = named_colours()[name]
         h,l,s = colorsys.rgb_to_hls(r,g,b)
         return h,s,l
         
     raise ValueError()
 
+
+def address_string(string):
+    # [HOST:]PORT, on localhost unless a host is given
+    host, sep, port = string.rpartition(':')
+    return host or options.DEFAULT_SERVE_HOST, int(port)
+
                
-def main():    
+def raise_argument_error(message):
+    raise argparse.ArgumentError(None, message)
+
+
+def arg_parser(exit_on_error=True):
     
     ap = argparse.ArgumentParser(description='Finds a suitable category from wikipedia and generates a PDF of playing '
                                              'cards from it, in the current directory.')
+    # ArgumentParser's own exit_on_error needs Python 3.9, and still exits for some errors
+    if not exit_on_error:
+        ap.error = raise_argument_error
     ap.add_argument('-d','--datadir',
-                    help="Re-generate PDF from this existing directory rather than starting from scratch.")
+                    help="Re-generate PDF from this existing directory rather than starting from scratch. A deck "
+                         "whose fetching was interrupted is finished first. With pypdf installed, only the pages "
+                         "whose cards, images or options have changed since the last re-generation are redrawn.")
     ap.add_argument('-l','--loglevel',choices=('debug','info','warn','error','fatal'),default=DEFAULT_LOG_LEVEL,
                     help="Verbosity of output. Defaults to {}.".format(DEFAULT_LOG_LEVEL))
-    ap.add_argument('-p','--pagesize',choices=[s.lower() for s in dir(pagesizes) if re.match(r'[A-Z]',s)], 
-                    default=pdf.DEFAULT_PAGE_SIZE,
-                    help="Paper size to output. Defaults to {}.".format(pdf.DEFAULT_PAGE_SIZE))
-    ap.add_argument('-m','--pagemargin',type=float,default=pdf.DEFAULT_PAGE_MARGIN_MM,
-                    help="Page margin in mm. Defaults to {}.".format(pdf.DEFAULT_PAGE_MARGIN_MM))
-    ap.add_argument('-b','--bleedmargin',type=float,default=pdf.DEFAULT_BLEED_MARGIN_MM,
-                    help="Bleed area to leave around cards, in mm. Defaults to {}.".format(pdf.DEFAULT_BLEED_MARGIN_MM))
-    ap.add_argument('-k','--backs', choices=([b.name.lower() for b in pdf.BacksType]), default=pdf.DEFAULT_BACKS_TYPE,
-                    help="Method to orient odd pages for card backs. Defaults to {}".format(pdf.DEFAULT_BACKS_TYPE))
+    ap.add_argument('-p','--pagesize',choices=options.PAGE_SIZES,default=options.DEFAULT_PAGE_SIZE,
+                    help="Paper size to output. Defaults to {}.".format(options.DEFAULT_PAGE_SIZE))
+    ap.add_argument('-m','--pagemargin',type=float,default=options.DEFAULT_PAGE_MARGIN_MM,
+                    help="Page margin in mm. Defaults to {}.".format(options.DEFAULT_PAGE_MARGIN_MM))
+    ap.add_argument('-b','--bleedmargin',type=float,default=options.DEFAULT_BLEED_MARGIN_MM,
+                    help="Bleed area to leave around cards, in mm. Defaults to {}.".format(
+                        options.DEFAULT_BLEED_MARGIN_MM))
+    ap.add_argument('-k','--backs', choices=([b.name.lower() for b in options.BacksType]),
+                    default=options.DEFAULT_BACKS_TYPE,
+                    help="Method to orient odd pages for card backs. Defaults to {}".format(
+                        options.DEFAULT_BACKS_TYPE))
     ap.add_argument('-c','--color',type=colour_string,default=None,
                     help="Force primary color. Takes an HTML color name or hex code.")
     ap.add_argument('-s','--seccolor',type=colour_string,default=None,
@@ -65,21 +87,114 @@ def main():
                          "of primary color.")
     ap.add_argument('-q','--sqcorners',action='store_true',
                     help="Print square card corners instead of round.")
+    ap.add_argument('-r','--imagedpi',type=int,default=None,
+                    help="Downscale card images to this resolution before embedding them, to keep the PDF small. "
+                         "By default images are embedded as downloaded.")
+    ap.add_argument('-u','--renderjobs',type=int,default=1,
+                    help="Number of processes to render the PDF with, each drawing a run of pages. Needs pypdf to "
+                         "merge the results. Defaults to 1.")
+    ap.add_argument('-w','--downloadworkers',type=int,default=options.DEFAULT_DOWNLOAD_WORKERS,
+                    help="Number of card images to download concurrently. Defaults to {}.".format(
+                        options.DEFAULT_DOWNLOAD_WORKERS))
+    ap.add_argument('-a','--candidates',type=int,default=options.DEFAULT_CANDIDATES,
+                    help="Number of candidate categories to screen concurrently. The first suitable one is used and "
+                         "the rest are kept for later runs. Defaults to {}.".format(options.DEFAULT_CANDIDATES))
+    ap.add_argument('-o','--offline',action='store_true',
+                    help="Only use cached query results, never contacting dbpedia. Categories with uncached "
+                         "queries are skipped and card images are not downloaded.")
+    ap.add_argument('-x','--dump',nargs='?',const=options.DUMP_DB,default=None,
+                    help="Generate decks from a local DBpedia extract loaded with --ingest, rather than querying "
+                         "dbpedia. Takes the path of the store, defaulting to {}. Combine with --offline to skip "
+                         "downloading card images too.".format(options.DUMP_DB))
+    ap.add_argument('-i','--ingest',nargs='+',metavar='FILE',
+                    help="Load these N-Triples files (optionally .gz or .bz2 compressed) into the local store "
+                         "used by --dump, then exit.")
+    ap.add_argument('--profile',metavar='FILE',default=None,
+                    help="Write a timeline of the run's stages to this file, in Chrome trace format. Open it in "
+                         "chrome://tracing or Perfetto. Decks generated in batch and render worker processes "
+                         "are not traced.")
+    ap.add_argument('--profile-stage',metavar='NAME',default=None,
+                    help="Also profile every occurrence of this stage of the run in the main process (e.g. query, "
+                         "screen_category, download_images, render_cards, draw), adding them together and writing "
+                         "the results next to the --profile file.")
+    ap.add_argument('--profile-with',choices=trace.PROFILERS,default=trace.PROFILERS[0],
+                    help="Profiler to use for --profile-stage: function timings, or the memory allocations still "
+                         "held when the stage finishes. "
+                         "Defaults to {}.".format(trace.PROFILERS[0]))
+    ap.add_argument('-n','--count',type=int,default=1,
+                    help="Number of decks to generate. Defaults to 1.")
+    ap.add_argument('-j','--jobs',type=int,default=1,
+                    help="Number of decks to generate in parallel when generating more than one, or of worker "
+                         "processes for --serve. Defaults to 1.")
+    ap.add_argument('--serve',metavar='[HOST:]PORT',type=address_string,default=None,
+                    help="Serve decks over HTTP on this port, on localhost unless a host is given, instead of "
+                         "generating one. The other options are the defaults for the jobs it is sent.")
+    ap.add_argument('--queue',type=int,default=options.DEFAULT_SERVE_QUEUE,
+                    help="Number of jobs --serve holds waiting for a worker before turning more away. Defaults to "
+                         "{}.".format(options.DEFAULT_SERVE_QUEUE))
     ap.add_argument('-v','--version',action='store_true',
                     help="Output version number and exit")
-                    
+    return ap
+
+
+def main():    
+    
+    ap = arg_parser()
     args = ap.parse_args()
     
     if args.version:
         sys.exit("Trop Tumps v{} by Mark Frimston".format(VERSION))
         
+    if args.count < 1 or args.jobs < 1 or args.renderjobs < 1:
+        ap.error("count, jobs and renderjobs must be at least 1")
+    if args.count > 1 and args.datadir:
+        ap.error("count can't be used with datadir")
+    if args.profile_stage and not args.profile:
+        ap.error("profile-stage needs profile")
+    if args.serve and (args.count > 1 or args.datadir or args.ingest or args.profile):
+        ap.error("serve can't be used with count, datadir, ingest or profile")
+    if args.queue < 0:
+        ap.error("queue can't be negative")
+    
     logging.basicConfig(level=getattr(logging,args.loglevel.upper()))
+    
+    # load a local extract for later use
+    if args.ingest:
+        from . import dump
+        dump.ingest_files(args.dump or options.DUMP_DB, args.ingest)
+        return
+
+    # generate decks on request, in worker processes kept ready
+    if args.serve:
+        from . import serve
+        serve.serve(args, arg_parser(exit_on_error=False))
+        return
+
+    # generate several decks in worker processes
+    if args.count > 1:
+        from . import batch
+        failures = batch.run_batch(args)
+        if failures > 0:
+            sys.exit("{} of {} decks failed".format(failures, args.count))
+        return
 
-    # fetch deck data if necessary
-    input_dir = fetch.fetch_deck(args.datadir)
+    # the stages' modules, and reportlab with them, are only imported here so that printing the version or
+    # reporting a bad argument doesn't wait on them
+    from . import fetch
+    from . import pdf
+    if args.profile:
+        trace.start(args.profile_stage, args.profile_with)
+    try:
+        # fetch deck data if necessary
+        with trace.span('fetch_deck'):
+            input_dir = fetch.fetch_deck(args, args.datadir)
 
-    # create pdf
-    pdf.create_pdf(args, input_dir)
+        # create pdf
+        with trace.span('create_pdf'):
+            pdf.create_pdf(args, input_dir, incremental=args.datadir is not None)
+    finally:
+        if args.profile:
+            trace.finish(args.profile)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,71 @@
+import os.path
+import time
+import random
+import logging
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from . import pdf
+from . import fetch
+
+
+MAX_ATTEMPTS = 2
+
+
+def init_worker(loglevel):
+    logging.basicConfig(level=getattr(logging, loglevel.upper()))
+    # forked workers inherit the parent's random state, which would give every deck the same colours
+    random.seed()
+    pdf.register_fonts()
+
+
+def generate_deck(args):
+    starttime = time.monotonic()
+    input_dir = fetch.fetch_deck(args, None)
+    fetchtime = time.monotonic()
+    pdf.create_pdf(args, input_dir)
+    return input_dir, fetchtime-starttime, time.monotonic()-fetchtime
+
+
+def log_summary(results):
+    logging.info('{:>4}  {:<6}  {:>8}  {:>8}  {:>8}  {}'.format('Deck', 'Status', 'Fetch', 'Render', 'Total',
+                                                                 'Output'))
+    for i, result in enumerate(results):
+        if result['error'] is None:
+            logging.info('{:>4}  {:<6}  {:>7.1f}s  {:>7.1f}s  {:>7.1f}s  {}'.format(
+                i+1, 'ok', result['fetch'], result['render'], result['fetch']+result['render'],
+                os.path.basename(result['output'])))
+        else:
+            logging.info('{:>4}  {:<6}  {:>8}  {:>8}  {:>8}  {}'.format(i+1, 'failed', '-', '-', '-', result['error']))
+
+
+def run_batch(args):
+    results = [None] * args.count
+    attempts = [0] * args.count
+    pending = list(range(args.count))
+
+    while len(pending) > 0:
+        retry = []
+        with ProcessPoolExecutor(args.jobs, initializer=init_worker, initargs=(args.loglevel,)) as executor:
+            futures = { executor.submit(generate_deck, args): i for i in pending }
+            for future in as_completed(futures):
+                i = futures[future]
+                attempts[i] += 1
+                try:
+                    output, fetchtime, rendertime = future.result()
+                    results[i] = { 'output': output, 'fetch': fetchtime, 'render': rendertime, 'error': None }
+                    logging.info('Deck {} of {} done: {}'.format(i+1, args.count, output))
+                except BrokenProcessPool:
+                    # a worker died outright - every deck still in the pool is lost, so give them another go
+                    if attempts[i] < MAX_ATTEMPTS:
+                        retry.append(i)
+                    else:
+                        results[i] = { 'error': 'Worker process died' }
+                except Exception as e:
+                    logging.error('Deck {} of {} failed: {!r}'.format(i+1, args.count, e))
+                    results[i] = { 'error': repr(e) }
+        pending = retry
+
+    log_summary(results)
+    return sum(1 for r in results if r['error'] is not None)
@@ -0,0 +1,153 @@
+import os
+import os.path
+import re
+import json
+import time
+import hashlib
+import contextlib
+import logging
+import threading
+
+
+DEFAULT_TTL = 7*24*60*60
+DEFAULT_MAX_SIZE = 256*1024*1024
+EVICT_TO_FRACTION = 0.9
+ENTRY_SUFFIX = '.json'
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def normalise_query(q):
+    return re.sub(r'\s+', ' ', q).strip()
+
+
+def query_key(dataset, q):
+    return hashlib.sha256('{}\n{}'.format(dataset, normalise_query(q)).encode('utf-8')).hexdigest()
+
+
+class QueryCache:
+
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def get(self, dataset, q):
+        path = self._path(query_key(dataset, q))
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entry = None
+        if entry is not None and entry['expires'] < time.time() and not self.offline:
+            logging.debug('Expired cache entry {}'.format(path))
+            self._remove(path)
+            entry = None
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            if self.offline:
+                raise CacheMiss('Query not cached: {}'.format(normalise_query(q)))
+            return None
+        # touch the entry so that eviction is least-recently-used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return entry['results']
+
+    def put(self, dataset, q, results, ttl=None):
+        for row in self.put_rows(dataset, q, results, ttl):
+            pass
+
+    def put_rows(self, dataset, q, rows, ttl=None):
+        # Yields the rows back while writing them to a new entry, which is only added once they run out. If the
+        # consumer stops early, the remaining rows are read and stored without being yielded.
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(query_key(dataset, q))
+        tmppath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmppath, 'w') as f:
+                header = json.dumps({
+                    'dataset': dataset,
+                    'query': normalise_query(q),
+                    'expires': time.time() + (self.ttl if ttl is None else ttl),
+                })
+                # the results list goes last, written a row at a time
+                f.write(header[:-1] + ', "results": [')
+                separator = ''
+                try:
+                    for row in rows:
+                        f.write(separator + json.dumps(row))
+                        separator = ', '
+                        yield row
+                except GeneratorExit:
+                    for row in rows:
+                        f.write(separator + json.dumps(row))
+                        separator = ', '
+                f.write(']}')
+            os.replace(tmppath, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmppath)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(path)
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def _evict(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(e[1] for e in self._entries())
+            if self._size <= self.max_size:
+                return
+            entries = sorted(self._entries())
+            self._size = sum(e[1] for e in entries)
+            target = self.max_size * EVICT_TO_FRACTION
+            while entries and self._size > target:
+                mtime, size, name = entries.pop(0)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+                logging.debug('Evicted cache entry {}'.format(name))
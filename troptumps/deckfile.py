@@ -0,0 +1,54 @@
+import os
+import os.path
+import json
+
+
+HEADER_FIELDS = 'name', 'description', 'stats'
+
+
+def deck_file(input_dir):
+    # Prefers the line-based format, falling back to the older single JSON document
+    input_name = os.path.basename(os.path.normpath(input_dir))
+    path = os.path.join(input_dir, '{}.jsonl'.format(input_name))
+    if os.path.exists(path):
+        return path
+    return os.path.join(input_dir, '{}.json'.format(input_name))
+
+
+def write_deck(path, header, cards):
+    # Header record on the first line, then one card per line. Cards can be any iterable and are written as they
+    # arrive. The file only replaces any existing one once complete.
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmppath, 'w') as f:
+            f.write(json.dumps({ k: header[k] for k in HEADER_FIELDS })+'\n')
+            for card in cards:
+                f.write(json.dumps(card)+'\n')
+    except BaseException:
+        os.remove(tmppath)
+        raise
+    os.replace(tmppath, path)
+
+
+def is_jsonl(path):
+    return path.endswith('.jsonl')
+
+
+def read_header(path):
+    with open(path, 'r') as f:
+        if is_jsonl(path):
+            return json.loads(f.readline())
+        deck = json.load(f)
+    return { k: deck[k] for k in HEADER_FIELDS }
+
+
+def read_cards(path):
+    # Yields the deck's cards one at a time. The old JSON format has to be read in full.
+    with open(path, 'r') as f:
+        if not is_jsonl(path):
+            yield from json.load(f)['cards']
+            return
+        f.readline()
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,241 @@
+import os
+import os.path
+import re
+import bz2
+import gzip
+import time
+import logging
+import sqlite3
+import contextlib
+
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDF_LANGSTRING = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#langString'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+RDFS_COMMENT = 'http://www.w3.org/2000/01/rdf-schema#comment'
+OWL_CLASS = 'http://www.w3.org/2002/07/owl#Class'
+DBO_THUMBNAIL = 'http://dbpedia.org/ontology/thumbnail'
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+# literal types accepted as statistics as well as anything that reads as a number, as in fetch.NUMERIC_VAL_CLAUSE
+STAT_DATATYPES = { XSD+'date', XSD+'time', XSD+'datetime', XSD+'boolean' }
+IGNORED_PROPERTIES = { 'http://dbpedia.org/ontology/wikiPageID', 'http://dbpedia.org/ontology/wikiPageRevisionID' }
+BATCH_SIZE = 10000
+LOCK_TIMEOUT = 30
+TRIPLE_RE = re.compile(r"""
+    ^\s*
+    (?: <(?P<s>[^>]*)> | _:\S+ ) \s+
+    <(?P<p>[^>]*)> \s+
+    (?: <(?P<o>[^>]*)>
+        | _:\S+
+        | "(?P<lit>(?:[^"\\]|\\.)*)" (?: @(?P<lang>[a-zA-Z]+(?:-[a-zA-Z0-9]+)*) | \^\^<(?P<dt>[^>]*)> )?
+    ) \s*
+    \.\s*(?:\#.*)?$
+    """, re.VERBOSE)
+ESCAPE_RE = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+ECHARS = { 't': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\' }
+DOUBLE_RE = re.compile(r'^\s*[+-]?(?:(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?|INF)\s*$|^\s*NaN\s*$')
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS types (
+        class TEXT NOT NULL,
+        instance TEXT NOT NULL,
+        PRIMARY KEY (class, instance)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS stats (
+        instance TEXT NOT NULL,
+        property TEXT NOT NULL,
+        value TEXT NOT NULL,
+        datatype TEXT NOT NULL,
+        PRIMARY KEY (instance, property, value)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS labels (
+        subject TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (subject, value)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS comments (
+        subject TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (subject, value)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS thumbnails (
+        subject TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (subject, value)
+    ) WITHOUT ROWID;
+"""
+
+
+def unescape(text):
+    if '\\' not in text:
+        return text
+    return ESCAPE_RE.sub(lambda m: chr(int(m.group(1) or m.group(2), 16)) if m.group(3) is None
+                                   else ECHARS.get(m.group(3), m.group(3)), text)
+
+
+def is_english(lang):
+    return lang is None or lang.lower() == 'en' or lang.lower().startswith('en-')
+
+
+def is_stat(value, datatype):
+    return datatype in STAT_DATATYPES or DOUBLE_RE.match(value) is not None
+
+
+def open_dump(filename):
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt', encoding='utf-8')
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+def parse_triples(lines):
+    # Yields (table, row) for the triples that the deck queries need, skipping everything else. Handles N-Triples,
+    # and Turtle files written one triple per line without prefixes, as the DBpedia dumps are.
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        m = TRIPLE_RE.match(line)
+        if m is None:
+            logging.debug('Skipping unparseable line {}: {}'.format(lineno, line.strip()))
+            continue
+        subject, predicate = m.group('s'), m.group('p')
+        if subject is None:
+            continue
+        subject = unescape(subject)
+        obj, lit = m.group('o'), m.group('lit')
+        if obj is not None:
+            if predicate == RDF_TYPE:
+                yield 'types', (unescape(obj), subject)
+            elif predicate == DBO_THUMBNAIL:
+                yield 'thumbnails', (subject, unescape(obj))
+        elif lit is not None:
+            lang = m.group('lang')
+            value = unescape(lit)
+            if predicate == RDFS_LABEL:
+                if is_english(lang):
+                    yield 'labels', (subject, value)
+            elif predicate == RDFS_COMMENT:
+                if is_english(lang):
+                    yield 'comments', (subject, value)
+            elif predicate not in IGNORED_PROPERTIES:
+                datatype = m.group('dt') or (RDF_LANGSTRING if lang else XSD+'string')
+                if is_stat(value, datatype):
+                    yield 'stats', (subject, predicate, value, datatype)
+
+
+class DumpStore:
+
+    INSERTS = {
+        'types': 'INSERT OR IGNORE INTO types (class, instance) VALUES (?, ?)',
+        'stats': 'INSERT OR IGNORE INTO stats (instance, property, value, datatype) VALUES (?, ?, ?, ?)',
+        'labels': 'INSERT OR IGNORE INTO labels (subject, value) VALUES (?, ?)',
+        'comments': 'INSERT OR IGNORE INTO comments (subject, value) VALUES (?, ?)',
+        'thumbnails': 'INSERT OR IGNORE INTO thumbnails (subject, value) VALUES (?, ?)',
+    }
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def ingest(self, lines):
+        counts = { t: 0 for t in self.INSERTS }
+        batches = { t: [] for t in self.INSERTS }
+        with self._connect() as db:
+            db.execute('PRAGMA synchronous = OFF')
+            for table, row in parse_triples(lines):
+                batch = batches[table]
+                batch.append(row)
+                if len(batch) >= BATCH_SIZE:
+                    db.executemany(self.INSERTS[table], batch)
+                    counts[table] += len(batch)
+                    batch.clear()
+            for table, batch in batches.items():
+                db.executemany(self.INSERTS[table], batch)
+                counts[table] += len(batch)
+            # the category list has to be drawn up again from the new data
+            tables = { r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'") }
+            if 'categories' in tables:
+                db.execute('DELETE FROM categories')
+                db.execute("DELETE FROM meta WHERE key IN ('populated', 'refresh_pages')")
+            if 'refresh_pages' in tables:
+                db.execute('DELETE FROM refresh_pages')
+        return counts
+
+    def categories(self, min_size, max_size):
+        with self._connect() as db:
+            return [ { 'c': c, 'n': str(n) } for c, n in db.execute(
+                'SELECT class, COUNT(*) FROM types '
+                'WHERE class IN (SELECT instance FROM types WHERE class = ?) '
+                'GROUP BY class HAVING COUNT(*) >= ? AND COUNT(*) < ?', (OWL_CLASS, min_size, max_size)) ]
+
+    def top_stats(self, category, limit):
+        with self._connect() as db:
+            return [ { 'p': p, 't': '|'.join(sorted(set(t.split(',')))) } for p, n, t in db.execute(
+                'SELECT s.property, COUNT(DISTINCT s.instance) AS n, GROUP_CONCAT(DISTINCT s.datatype) '
+                'FROM types t JOIN stats s ON s.instance = t.instance WHERE t.class = ? '
+                'GROUP BY s.property ORDER BY n DESC, s.property LIMIT ?', (category, limit)) ]
+
+    def top_members(self, category, properties, min_stats, limit):
+        with self._connect() as db:
+            return [ { 'o': o } for o, n in db.execute(
+                'SELECT t.instance, COUNT(DISTINCT s.property) AS n '
+                'FROM types t JOIN stats s ON s.instance = t.instance '
+                'WHERE t.class = ? AND s.property IN ({}) '
+                'GROUP BY t.instance HAVING n >= ? ORDER BY n DESC, t.instance LIMIT ?'.format(
+                    ','.join('?'*len(properties))), (category, *properties, min_stats, limit)) ]
+
+    def _values(self, db, table, subject):
+        return '|'.join(r[0] for r in db.execute('SELECT value FROM {} WHERE subject = ?'.format(table), (subject,)))
+
+    def details(self, subject):
+        with self._connect() as db:
+            return [{
+                'name': self._values(db, 'labels', subject),
+                'description': self._values(db, 'comments', subject),
+                'image': self._values(db, 'thumbnails', subject),
+            }]
+
+    def labels(self, subjects):
+        with self._connect() as db:
+            results = [ { 'p': s, 'name': self._values(db, 'labels', s) } for s in subjects ]
+        return [ r for r in results if r['name'] ]
+
+    def member_details(self, members, properties):
+        results = []
+        with self._connect() as db:
+            for member in members:
+                result = {
+                    'o': member,
+                    'name': self._values(db, 'labels', member),
+                    'description': self._values(db, 'comments', member),
+                    'image': self._values(db, 'thumbnails', member),
+                }
+                for i, p in enumerate(properties):
+                    result['stat{}'.format(i)] = '|'.join(r[0] for r in db.execute(
+                        'SELECT value FROM stats WHERE instance = ? AND property = ?', (member, p)))
+                results.append(result)
+        return results
+
+
+def ingest_files(path, filenames):
+    store = DumpStore(path)
+    for filename in filenames:
+        starttime = time.monotonic()
+        with open_dump(filename) as f:
+            counts = store.ingest(f)
+        logging.info('Loaded {} in {:.1f}s: {}'.format(filename, time.monotonic()-starttime,
+                                                      ', '.join('{} {}'.format(n, t) for t, n in counts.items())))
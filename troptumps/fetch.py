@@ -1,4 +1,9 @@
+import math
+import array
+import locale
 import random
+import string
+import itertools
 import codecs
 import re
 import logging
@@ -6,13 +11,39 @@ import json
 import time
 import os
 import os.path
-import dateutil.parser
+import enum
+import socket
+import hashlib
+import collections
+import contextlib
+import threading
 
-from datetime import datetime
-from urllib.request import urlopen, Request, HTTPError, URLError, URLopener
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from urllib.request import HTTPError, URLError, URLopener
 from urllib.parse import urlencode
 
+from . import net
+from . import trace
+from . import deckfile
 from . import VERSION
+from .cache import QueryCache, CacheMiss
+from .store import CategoryStore, Verdict
+from .dump import DumpStore
+from .options import CACHE_FILE
+
+
+class FetchVars(enum.Enum):
+    DOWNLOAD_WORKERS = enum.auto()
+    QUERY_CACHE = enum.auto()
+    OFFLINE = enum.auto()
+    CANDIDATES = enum.auto()
+    CATEGORY_STORE = enum.auto()
+    DUMP = enum.auto()
+    CATEGORY_REFRESH = enum.auto()
+    REFRESH_STOP = enum.auto()
+    ROUND_TRIPS = enum.auto()
+    CACHE_MISSES = enum.auto()
 
 
 USER_AGENT = 'TropTumps/{} (https://github.com/Frimkron/troptumps) {}'.format(
@@ -25,7 +56,20 @@ MAX_DECK_SIZE = 50
 MIN_NUM_STATS = 4
 MAX_NUM_STATS = 10
 ERROR_PAUSE_TIME = 5
-CACHE_FILE = os.path.expanduser(os.path.join('~', '.cache', 'troptumps'))
+MAX_RETRY_DELAY = 120
+MAX_ATTEMPTS = 5
+CATEGORY_PAGE_SIZE = 100
+REFRESH_WORKERS = 4
+REFRESH_POLL_TIME = 0.5
+DOWNLOAD_TIMEOUT = 30
+QUERY_TIMEOUT = 60
+DOWNLOAD_BUFFER_SIZE = 64*1024
+QUERY_CACHE_DIR = CACHE_FILE + '-queries'
+CATEGORY_DB = CACHE_FILE + '.sqlite'
+CHECKPOINT_FILE = '.checkpoint.json'
+IMAGES_CHECKPOINT_FILE = '.images.jsonl'
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
 IMAGE_TYPES = {
     'image/png': 'png',
     'image/jpeg': 'jpg',
@@ -36,35 +80,112 @@ NUMERIC_VAL_CLAUSE = "( isNumeric(xsd:double(str({0}))) " \
                        "|| datatype({0}) = xsd:time " \
                        "|| datatype({0}) = xsd:datetime " \
                        "|| datatype({0}) = xsd:boolean ) "
+STAT_VAL_CLAUSE = NUMERIC_VAL_CLAUSE.format('?v') + \
+                  "&& ?p != dbo:wikiPageID " \
+                  "&& ?p != dbo:wikiPageRevisionID "
+BINDINGS_START_RE = re.compile(r'"bindings"\s*:\s*\[')
+BINDINGS_SEP_RE = re.compile(r'[\s,]*')
+# Abbreviations a full stop doesn't end a sentence after, highest precedence first. A bracket matches either of its
+# letters, and a '.' any one character.
+ABBREVIATION_PATTERNS = '''
+    [A-Z]
+    [Aa].[Bb] [Aa]bbr [Aa]cad [Aa].[Dd] [Aa]l [Aa]lt [Aa].[Mm] [Aa]ssn [Aa]ug [Aa]ve
+    [Bb].[Aa] [Bb].[Cc] [Bb].[Pp] [Bb].[Ss] [Cc] [Cc]al [Cc]apt [Cc]ent [Cc]o [Cc]ol
+    [Cc]omdr [Cc]orp [Cc]pl [Cc]u [Dd] [Dd].[Cc] [Dd]ec [Dd]ept [Dd]ist [Dd]iv
+    [Dd]r [Ee]d [Ee].[Gg] [Ee]st [Ff]eb [Ff]l [Gg]al [Gg]en [Gg]ov [Gg]rad [Hh]on
+    [Ii].e [Ii]n [Ii]nc [Ii]nst [Jj]an [Jj]r [Ll]at [Ll]b [Ll]ib [Ll]ong [Ll]t
+    [Ll]td [Mm].[Dd] [Mm]r [Mm]rs [Mm]s [Mm]sgr [Mm]t [Mm]ts [Mm]us [Nn]o [Nn]ov
+    [Oo]ct [Oo]p [Pp]l [Pp]op [Pp]seud [Pp]t [Pp]ub [Rr]ev [Rr].[Nn] [Ss]ept [Ss]er
+    [Ss]gt [Ss]r [Ss]t [Uu]ninc [Uu]niv [Uu].[Ss] [Vv]ol [Vv]s [Vv] [Ww]t
+    '''.split()
+SENTENCE_DELIMITERS = { '"': '"', '(': ')', '[': ']' }
+# the characters a sentence can end or be skipped at: end symbols, delimiters and the starts of words
+SENTENCE_TOKEN_RE = re.compile(r'[!?]+|[."(\[]|\b[A-Za-z]')
 IMPLICIT_PREFIXES = {
     'http://dbpedia.org/ontology/': 'dbo',
     'http://dbpedia.org/property/': 'dbp',
     'http://dbpedia.org/resource/': 'dbr',
 }
 
+_round_trips_lock = threading.Lock()
+
+
+def read_bindings(res):
+    # Yields the rows of a SPARQL JSON result as they arrive, decoding one binding at a time rather than the whole
+    # document
+    decoder = json.JSONDecoder()
+    textdecoder = codecs.getincrementaldecoder('utf-8')()
+    buff, pos, eof = '', None, False
+    while True:
+        if pos is None:
+            m = BINDINGS_START_RE.search(buff)
+            if m is not None:
+                pos = m.end()
+        while pos is not None:
+            pos = BINDINGS_SEP_RE.match(buff, pos).end()
+            if pos < len(buff) and buff[pos] == ']':
+                return
+            try:
+                binding, pos = decoder.raw_decode(buff, pos)
+            except ValueError:
+                # incomplete - wait for more of it
+                break
+            yield { name: info['value'] for name, info in binding.items() }
+        if eof:
+            raise ValueError('Truncated SPARQL results')
+        chunk = res.read(net.READ_SIZE)
+        eof = not chunk
+        if pos is not None:
+            buff, pos = buff[pos:], 0
+        buff += textdecoder.decode(chunk, final=eof)
+
 
-def query(q):
+def query(config, q, label=None):
+    # Yields result rows as they are parsed from the response, writing them through to the cache
     q = re.sub(r'\n\s+', '\n', q)
-    url = SPARQL_ENDPOINT
-    postdata = urlencode({
-        'timeout': '30000',
-        'default-graph-uri': DEFAULT_DATASET,
-        'query': q,
-        'format': 'json',    
-    }).encode('utf-8')
-    headers = {
-        'User-Agent': USER_AGENT,
-        'Content-Type': 'application/x-www-form-urlencoded', 
-        'Accept': 'application/json, text/json, */*', 
-    }
-    logging.debug('Requesting {}, [{}]'.format(url, postdata))
-    data = json.load(codecs.getreader('utf-8')(urlopen(Request(url, postdata, headers))))
-    results = []
-    for binding in data['results']['bindings']:
-        results.append({})
-        for name, info in binding.items():
-            val = info['value']
-            results[-1][name] = val
+    with trace.span('query', label=label) as span:
+        cache = config[FetchVars.QUERY_CACHE]
+        if cache is not None:
+            results = cache.get(DEFAULT_DATASET, q)
+            if results is not None:
+                logging.debug('Cached result for [{}]'.format(q))
+                span.set(rows=len(results), cached=True)
+                yield from results
+                return
+        url = SPARQL_ENDPOINT
+        postdata = urlencode({
+            'timeout': '30000',
+            'default-graph-uri': DEFAULT_DATASET,
+            'query': q,
+            'format': 'json',    
+        }).encode('utf-8')
+        headers = {
+            'User-Agent': USER_AGENT,
+            'Content-Type': 'application/x-www-form-urlencoded', 
+            'Accept': 'application/json, text/json, */*', 
+        }
+        logging.debug('Requesting {}, [{}]'.format(url, postdata))
+        with _round_trips_lock:
+            config[FetchVars.ROUND_TRIPS][label] += 1
+        numrows = 0
+        with net.request('POST', url, postdata, headers, QUERY_TIMEOUT) as res:
+            rows = read_bindings(res)
+            if cache is not None:
+                rows = cache.put_rows(DEFAULT_DATASET, q, rows)
+            # closed before the response is, so that rows left unread still make it into the cache
+            try:
+                with contextlib.closing(rows):
+                    for row in rows:
+                        numrows += 1
+                        yield row
+            finally:
+                span.set(bytes=res.bytes_received, rows=numrows, cached=False)
+
+
+def query_dump(label, func, *args):
+    with trace.span('query', label=label, backend='dump') as span:
+        results = func(*args)
+        span.set(rows=len(results))
     return results
 
 
@@ -87,59 +208,169 @@ def friendly_to_filename(name):
     return safe
     
     
-def format_stat(datatype, value):
-    if value is None or value == "":
-        return "Unknown"
+def parse_temporal(fromisoformat, value):
+    # ISO values take the fast path, anything else is left to dateutil, which is only imported if needed
     try:
-        if datatype == 'http://www.w3.org/2001/XMLSchema#date':
-            return dateutil.parser.parse(value).strftime('%d %b, %Y')
-        elif datatype == 'http://www.w3.org/2001/XMLSchema#time':
-            return dateutil.parser.parse(value).strftime('%I:%M%p')
-        elif datatype == 'http://www.w3.org/2001/XMLSchema#datetime':
-            return dateutil.parser.parse(value).strftime('%I:%M%p on %d %b, %Y')
-        elif datatype == 'http://www.w3.org/2001/XMLSchema#boolean':
-            return 'Yes' if bool(value) else 'No'
-        else:
-            return format(float(value), 'n')
-    except ValueError as e:
-        logging.warn("Failed to parse \"{}\" as {}".format(value, datatype))
-        return str(value)
+        return fromisoformat(value)
+    except ValueError:
+        import dateutil.parser
+        return dateutil.parser.parse(value)
+
+
+def date_stat(value):
+    d = parse_temporal(datetime.date.fromisoformat, value)
+    return d.strftime('%d %b, %Y'), (d.toordinal() - EPOCH.toordinal()) * 86400.0
+
+
+def time_stat(value):
+    t = parse_temporal(datetime.time.fromisoformat, value)
+    return t.strftime('%I:%M%p'), t.hour*3600.0 + t.minute*60 + t.second + t.microsecond/1e6
+
+
+def datetime_stat(value):
+    d = parse_temporal(datetime.datetime.fromisoformat, value)
+    stamp = (d if d.tzinfo is not None else d.replace(tzinfo=datetime.timezone.utc)) - EPOCH
+    return d.strftime('%I:%M%p on %d %b, %Y'), stamp.total_seconds()
+
+
+def boolean_stat(value):
+    # xsd:boolean is written as true, false, 1 or 0, so "false" is a non-empty string that still means No
+    truth = value.strip().lower() in ('true', '1')
+    return ('Yes' if truth else 'No'), float(truth)
+
+
+def number_stat():
+    # 'n' formatting looks the locale up on every call. Without grouping or an unusual decimal point it comes out
+    # the same as 'g', which is much quicker.
+    conv = locale.localeconv()
+    if conv['decimal_point'] == '.' and not conv['thousands_sep']:
+        fmt = '{:g}'.format
+    else:
+        fmt = '{:n}'.format
+
+    def parse(value):
+        number = float(value)
+        return fmt(number), number
+    return parse
+
+
+STAT_PARSERS = {
+    XSD+'date': date_stat,
+    XSD+'time': time_stat,
+    XSD+'datetime': datetime_stat,
+    XSD+'boolean': boolean_stat,
+}
+
+
+def format_stat_column(datatype, values):
+    # Formats one statistic's values for a whole deck, with the parser for its datatype picked once. Returns the
+    # display strings, and the values as an array of floats with NaN where they are unknown.
+    parse = STAT_PARSERS.get(datatype) or number_stat()
+    strings, numbers = [], array.array('d')
+    for value in values:
+        if value is None or value == "":
+            strings.append("Unknown")
+            numbers.append(math.nan)
+            continue
+        try:
+            string, number = parse(value)
+        except (ValueError, OverflowError):
+            logging.warn("Failed to parse \"{}\" as {}".format(value, datatype))
+            string, number = str(value), math.nan
+        strings.append(string)
+        numbers.append(number)
+    return strings, numbers
+
+
+def format_stat(datatype, value):
+    return format_stat_column(datatype, [value])[0][0]
     
                 
-def get_category():
-    if not os.path.exists(CACHE_FILE):
-        # Fetch possible categories
-        logging.info('Fetching categories')
-        results = query("""SELECT ?c COUNT(?o)
-                           WHERE
-                           {
-                               ?c a owl:Class
-                               . ?o a ?c
-                           }
-                           GROUP BY ?c
-                           HAVING ( COUNT(?o) >= %(min-deck-size)d 
-                                    && COUNT(?o) < %(max-cat-size)d )""" % {
-                                'min-deck-size': MIN_DECK_SIZE,
-                                'max-cat-size': MAX_CAT_SIZE })
-        categories = [r['c'] for r in results]
-        random.shuffle(categories)
-        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(categories, f)
-
-    with open(CACHE_FILE, 'r') as f:
-        categories = json.load(f)
-
-    logging.info('{} categories'.format(len(categories)))    
-    if len(categories) == 0:
-        return None
+def refresh_categories(config):
+    # Fills the category store a page of classes at a time, a few pages at once. Each page is recorded as it comes
+    # in, so an interrupted refresh picks up where it stopped, and failed pages are left for the next run.
+    store = config[FetchVars.CATEGORY_STORE]
+    dump = config[FetchVars.DUMP]
+    with trace.span('refresh_categories') as span:
+        if dump is not None:
+            store.begin_refresh(1)
+            store.add_page(0, ((r['c'], int(r['n'])) for r in query_dump('categories', dump.categories, 
+                                                                            MIN_DECK_SIZE, MAX_CAT_SIZE)))
+            return
+        numpages, done = store.refresh_progress()
+        if numpages is None:
+            try:
+                numclasses = int(next(iter(query_class_count(config)))['n'])
+            except CacheMiss:
+                raise Exception("Category list is not cached")
+            numpages = -(-numclasses // CATEGORY_PAGE_SIZE)
+            store.begin_refresh(numpages)
+        pages = [ p for p in range(numpages) if p not in done ]
+        logging.info('Fetching {} of {} pages of categories'.format(len(pages), numpages))
+        
+        def fetch_page(page):
+            # pages not yet started when the run ends are left for the next one
+            if config[FetchVars.REFRESH_STOP].is_set():
+                return False
+            # a page is small enough to hold, and is read in full before the store is locked
+            rows = [ (r['c'], int(r['n'])) for r in query_category_page(config, page) ]
+            store.add_page(page, rows)
+            logging.debug('Category page {}: {} categories'.format(page, len(rows)))
+            return True
+            
+        failed = 0
+        with ThreadPoolExecutor(REFRESH_WORKERS) as executor:
+            for future in as_completed([ executor.submit(fetch_page, p) for p in pages ]):
+                try:
+                    if not future.result():
+                        failed += 1
+                except (CacheMiss, HTTPError, URLError) as e:
+                    logging.warn("Failed to fetch page of categories: {}".format(e))
+                    failed += 1
+        span.set(pages=len(pages), failed=failed)
+    if failed > 0:
+        logging.warn("{} pages of categories left for next time".format(failed))
     
-    cat = categories.pop(0)
+                
+def get_category(config):
+    # Categories can be drawn as soon as the first page of them is in, while the rest of the list is fetched in the
+    # background
+    store = config[FetchVars.CATEGORY_STORE]
+    refresh = config[FetchVars.CATEGORY_REFRESH]
+    if refresh is None and not store.is_populated():
+        logging.info('Fetching categories')
+        executor = ThreadPoolExecutor(1)
+        refresh = executor.submit(refresh_categories, config)
+        # the worker thread exits once the refresh is done
+        executor.shutdown(wait=False)
+        config[FetchVars.CATEGORY_REFRESH] = refresh
+        
+    while True:
+        finished = refresh is None or refresh.done()
+        catname = store.draw()
+        if catname is not None:
+            break
+        if finished:
+            if refresh is not None:
+                refresh.result()
+            break
+        wait([refresh], REFRESH_POLL_TIME)
 
-    with open(CACHE_FILE, 'w') as f:
-        json.dump(categories, f)
+    logging.info('{} categories'.format(store.count_available()))    
+    return catname
 
-    return cat
+
+def stop_refresh(config):
+    # Lets the pages already being fetched finish, and leaves the rest for the next run
+    refresh = config[FetchVars.CATEGORY_REFRESH]
+    if refresh is None:
+        return
+    config[FetchVars.REFRESH_STOP].set()
+    try:
+        refresh.result()
+    except Exception as e:
+        logging.warn("Category refresh failed: {}".format(e))
+    config[FetchVars.CATEGORY_REFRESH] = None
 
 
 def uri_to_ascii(uri):
@@ -170,45 +401,105 @@ def prefix_declarations(lookup):
                       if p not in IMPLICIT_PREFIXES])
     
     
+def abbreviation_table(patterns):
+    # Maps every word the patterns match to the precedence of the first pattern matching it
+    table = {}
+    for rank, pattern in enumerate(patterns):
+        choices = [ string.ascii_uppercase if part == '[A-Z]' else part.strip('[]')
+                    for part in re.findall(r'\[A-Z\]|\[..\]|.', pattern) ]
+        for letters in itertools.product(*choices):
+            table.setdefault(''.join(letters), rank)
+    return table
+
+
+ABBREVIATIONS = abbreviation_table(ABBREVIATION_PATTERNS)
+ABBREVIATION_MAX_LEN = max(len(word) for word in ABBREVIATIONS)
+
+
+def abbreviation_end(para, pos, limit):
+    # Where the abbreviation starting at pos ends, after its full stop, or None if it would end past limit. Where
+    # several could be read, the highest precedence one wins.
+    best = None
+    for n in range(1, ABBREVIATION_MAX_LEN+1):
+        stop = pos + n
+        if stop >= limit:
+            break
+        if para[stop] != '.':
+            continue
+        word = para[pos:stop]
+        rank = ABBREVIATIONS.get(word)
+        if n == 3:
+            # the wildcard entries
+            wild = ABBREVIATIONS.get(word[0] + '.' + word[2])
+            if wild is not None and (rank is None or wild < rank):
+                rank = wild
+        if rank is not None and (best is None or rank < best[0]):
+            best = rank, stop+1
+    return best[1] if best is not None else None
+
+
+def sentence_ends(para, pos):
+    # Whether the end symbols before pos are followed by whitespace and then something other than a lowercase
+    # letter, or by nothing but whitespace
+    if pos == len(para):
+        return True
+    if not para[pos].isspace():
+        return False
+    return pos+1 == len(para) or not 'a' <= para[pos+1] <= 'z'
+
+
+def last_sentence_end(para, stop):
+    # The position of the last end symbol before stop that sentence_ends approves of, or None
+    for pos in range(stop-1, -1, -1):
+        char = para[pos]
+        if char == '.' and (pos == 0 or para[pos-1] != '.') and sentence_ends(para, pos+1):
+            return pos
+        if char in '!?' and sentence_ends(para, pos+1):
+            return pos
+    return None
+
+
 def first_sentence(para):
-    return re.match(r""" 
-        # content
-        (
-            ".*?"     # quote-delimited
-            | \(.*?\) # round-delimited
-            | \[.*?\] # square-delimited            
-            | \b(     # initial / abbreviation
-                [A-Z] 
-                | [Aa].[Bb] | [Aa]bbr | [Aa]cad | [Aa].[Dd] | [Aa]l | [Aa]lt | [Aa].[Mm] | [Aa]ssn | [Aa]ug | [Aa]ve 
-                | [Bb].[Aa] | [Bb].[Cc] | [Bb].[Pp] | [Bb].[Ss] | [Cc] | [Cc]al | [Cc]apt | [Cc]ent | [Cc]o | [Cc]ol 
-                | [Cc]omdr | [Cc]orp | [Cc]pl | [Cc]u | [Dd] | [Dd].[Cc] | [Dd]ec | [Dd]ept | [Dd]ist | [Dd]iv 
-                | [Dd]r | [Ee]d | [Ee].[Gg] | [Ee]st | [Ff]eb | [Ff]l | [Gg]al | [Gg]en | [Gg]ov | [Gg]rad | [Hh]on 
-                | [Ii].e | [Ii]n | [Ii]nc | [Ii]nst | [Jj]an | [Jj]r | [Ll]at | [Ll]b | [Ll]ib | [Ll]ong | [Ll]t 
-                | [Ll]td | [Mm].[Dd] | [Mm]r | [Mm]rs | [Mm]s | [Mm]sgr | [Mm]t | [Mm]ts | [Mm]us | [Nn]o | [Nn]ov 
-                | [Oo]ct | [Oo]p | [Pp]l | [Pp]op | [Pp]seud | [Pp]t | [Pp]ub | [Rr]ev | [Rr].[Nn] | [Ss]ept | [Ss]er 
-                | [Ss]gt | [Ss]r | [Ss]t | [Uu]ninc | [Uu]niv | [Uu].[Ss] | [Vv]ol | [Vv]s | [Vv] | [Ww]t
-              )\.
-            | .       # anything
-        )*?
-        # ending
-        (
-            # end symbols
-            (
-                # period, not prefixed with another period
-                (?<! \. ) \.                                    
-                # or one or more question/exclamation marks
-                | [!?]+                  
-            ) 
-            # suffixed by:
-            (?=(
-                \s+[^a-z]  # whitespace and non-lower
-                |\s*$      # or optional whitespace then EOI
-            ))
-            # alternatively just EOI
-            | $ 
-        )
-        """
-        , para, re.VERBOSE).group(0)
+    # A single pass from the left. Quoted and bracketed text and abbreviations are skipped whole, and the first
+    # full stop (not part of an ellipsis) or run of question or exclamation marks that sentence_ends approves of
+    # ends the sentence. Each character is looked at a bounded number of times, however the text is punctuated.
+    limit = len(para)
+    newline = para.find('\n')
+    if newline != -1 and newline < len(para)-1:
+        # The sentence can't run past a line break, so nothing is skipped beyond the last end symbol on the first
+        # line - an abbreviation's full stop before a line break ends the sentence. Without one, it's the line.
+        limit = last_sentence_end(para, newline)
+        if limit is None:
+            return para[:newline]
+    closers = {}
+    pos = 0
+    while True:
+        m = SENTENCE_TOKEN_RE.search(para, pos)
+        if m is None:
+            break
+        pos = m.start()
+        char = para[pos]
+        if char == '.':
+            if (pos == 0 or para[pos-1] != '.') and sentence_ends(para, pos+1):
+                return para[:pos+1]
+            pos += 1
+        elif char in '!?':
+            stop = m.end()
+            if sentence_ends(para, stop):
+                return para[:stop]
+            pos = stop
+        elif char in SENTENCE_DELIMITERS:
+            # the next closing delimiter is remembered, so unclosed ones don't make for repeated searches
+            close = closers.get(char)
+            if close is not None and close != -1 and close <= pos:
+                close = None
+            if close is None:
+                close = closers[char] = para.find(SENTENCE_DELIMITERS[char], pos+1)
+            pos = close+1 if close != -1 and close < limit else pos+1
+        else:
+            pos = abbreviation_end(para, pos, limit) or pos+1
+    # no end symbols, so it runs to the end of the text, less any final line break
+    return para[:-1] if para.endswith('\n') else para
     
 
 def pluralise(name):
@@ -229,248 +520,611 @@ def pluralise(name):
     return name+'s'
 
 
-def fetch_deck(input_dir):
+def query_class_count(config):
+    return query(config, """SELECT COUNT(?c) as ?n
+                    WHERE
+                    {
+                        ?c a owl:Class
+                    }""", 'class-count')
+    
+    
+def query_category_page(config, page):
+    return query(config, """SELECT ?c COUNT(?o) as ?n
+                    WHERE
+                    {
+                        {
+                            SELECT ?c WHERE { ?c a owl:Class }
+                            ORDER BY ?c LIMIT %(page-size)d OFFSET %(offset)d
+                        }
+                        ?o a ?c
+                    }
+                    GROUP BY ?c
+                    HAVING ( COUNT(?o) >= %(min-deck-size)d 
+                             && COUNT(?o) < %(max-cat-size)d )""" % {
+                         'page-size': CATEGORY_PAGE_SIZE,
+                         'offset': page*CATEGORY_PAGE_SIZE,
+                         'min-deck-size': MIN_DECK_SIZE,
+                         'max-cat-size': MAX_CAT_SIZE }, 'category-page')
+    
+    
+def query_stats(config, prefix_lookup, category):
+    dump = config[FetchVars.DUMP]
+    if dump is not None:
+        return query_dump('stats', dump.top_stats, category['name'], MAX_NUM_STATS+3)
+    return query(config, """%(prefixes)s
+                    SELECT 
+                        ?p 
+                        COUNT(DISTINCT ?o) as ?sn
+                        GROUP_CONCAT(DISTINCT datatype(?v), "|") as ?t
+                    WHERE
+                    {
+                        ?o a %(category)s
+                        . ?o ?p ?v
+                        . FILTER( %(stat-clause)s )
+                    }
+                    GROUP BY ?p
+                    ORDER BY DESC(COUNT(DISTINCT ?o)) ?p
+                    LIMIT %(max-num-stats)d""" % {
+                         'prefixes': prefix_declarations(prefix_lookup),
+                         'category': shorten_uri(prefix_lookup, category['name']), 
+                         'max-num-stats': MAX_NUM_STATS+3, # leeway for when we de-dup
+                         'stat-clause': STAT_VAL_CLAUSE }, 'stats')
 
-    prefix_lookup = dict(IMPLICIT_PREFIXES)
-        
-    # Loop until we get a category that works
-    while not input_dir:
+
+def query_members(config, prefix_lookup, category, statistics):
+    # Members are ranked on the statistics left after de-duping, so it takes a second request
+    dump = config[FetchVars.DUMP]
+    if dump is not None:
+        return query_dump('members', dump.top_members, category['name'], [p['name'] for p in statistics],
+                          MIN_NUM_STATS, MAX_DECK_SIZE)
+    return query(config, """%(prefixes)s
+                    SELECT ?o COUNT(DISTINCT ?p) as ?mn
+                    WHERE
+                    {
+                         ?o a %(category)s
+                         . ?o ?p ?v
+                         . FILTER( ( %(properties)s ) 
+                                   && %(numeric-clause)s )
+                     }
+                     GROUP BY ?o
+                     HAVING ( COUNT(DISTINCT ?p) >= %(min-num-stats)d )
+                     ORDER BY DESC(COUNT(DISTINCT ?p))
+                     LIMIT %(max-deck-size)d""" % {
+                        'prefixes': prefix_declarations(prefix_lookup),
+                        'category': shorten_uri(prefix_lookup, category['name']), 
+                        'properties': ' || '.join([
+                             '?p = {}'.format(shorten_uri(prefix_lookup, p['name'])) for p in statistics]),
+                        'min-num-stats': MIN_NUM_STATS,
+                        'max-deck-size': MAX_DECK_SIZE,
+                        'numeric-clause': NUMERIC_VAL_CLAUSE.format('?v') }, 'members')
+
+
+def query_deck_details(config, prefix_lookup, category, statistics):
+    # Returns the category's details, or None if it has none, and the statistics' labels, fetched together in one
+    # request
+    dump = config[FetchVars.DUMP]
+    if dump is not None:
+        details = query_dump('category-details', dump.details, category['name'])
+        labels = query_dump('stat-labels', dump.labels, [p['name'] for p in statistics])
+        return (details[0] if details else None), labels
+    details, labels = None, []
+    for result in query(config, """%(prefixes)s
+                    SELECT ?p ?name ?description ?image
+                    WHERE
+                    {
+                        {
+                            SELECT 
+                                GROUP_CONCAT(?l, "|") as ?name 
+                                GROUP_CONCAT(?c, "|") as ?description 
+                                GROUP_CONCAT(?t, "|") as ?image
+                            WHERE
+                            {
+                                OPTIONAL { %(category)s rdfs:label ?l }
+                                OPTIONAL { %(category)s rdfs:comment ?c }
+                                OPTIONAL { %(category)s dbo:thumbnail ?t }
+                                FILTER ( (langMatches(lang(?l), "EN") || lang(?l) = "") 
+                                          && (langMatches(lang(?c), "EN") || lang(?c) = "") )
+                            }
+                        }
+                        UNION
+                        {
+                            SELECT ?p GROUP_CONCAT(?l, "|") as ?name
+                            WHERE
+                            {
+                                ?p rdfs:label ?l                               
+                                . FILTER( ( %(properties)s )
+                                          && ( langMatches(lang(?l),"EN") || lang(?l) = "" ) )
+                            }
+                            GROUP BY ?p
+                        }
+                    }""" % {
+                        'prefixes': prefix_declarations(prefix_lookup),
+                        'category': shorten_uri(prefix_lookup, category['name']),
+                        'properties': ' || '.join([
+                             '?p = {}'.format(shorten_uri(prefix_lookup, p['name'])) for p in statistics]) }, 
+                 'deck-details'):
+        if result.get('p'):
+            labels.append(result)
+        elif details is None:
+            details = { k: result.get(k, '') for k in ('name', 'description', 'image') }
+    return details, labels
+
+
+def query_member_details(config, prefix_lookup, statistics, members):
+    dump = config[FetchVars.DUMP]
+    if dump is not None:
+        return query_dump('member-details', dump.member_details, members, [p['name'] for p in statistics])
+    return query(config, """%(prefixes)s
+                    SELECT 
+                        ?o 
+                        GROUP_CONCAT(DISTINCT ?label,"|") as ?name
+                        GROUP_CONCAT(DISTINCT ?comment,"|") as ?description
+                        GROUP_CONCAT(DISTINCT ?thumbnail,"|") as ?image
+                        %(property-projections)s
+                    WHERE
+                   {
+                        VALUES ?o { %(members)s }
+                        OPTIONAL { ?o rdfs:label ?label }
+                        OPTIONAL { ?o rdfs:comment ?comment }
+                        OPTIONAL { ?o dbo:thumbnail ?thumbnail }
+                        %(property-joins)s
+                        FILTER( ( langMatches(lang(?label), "EN") || lang(?label) = "" )
+                                 && ( langMatches(lang(?comment), "EN") || lang(?comment) = "" ) )
+                    }
+                    GROUP BY ?o""" % {
+                         'prefixes': prefix_declarations(prefix_lookup),
+                         'property-projections': '\n'.join([
+                             'GROUP_CONCAT(DISTINCT ?p{}, "|") as ?stat{}'.format(i, i) 
+                             for i,p in enumerate(statistics)]),
+                         'property-joins': '\n'.join([
+                             'OPTIONAL {{ ?o {} ?p{} . FILTER {} }}'.format(
+                                 shorten_uri(prefix_lookup, p['name']), i, 
+                                 NUMERIC_VAL_CLAUSE.format('?p{}'.format(i)))
+                             for i,p in enumerate(statistics)]), 
+                         'members': ' '.join([
+                             '{}'.format(shorten_uri(prefix_lookup, m))
+                             for m in members] )}, 'member-details')
+
+
+def download_image(url, output_dir, index):
+    logging.debug('Downloading {}'.format(url))
+    deadline = time.monotonic() + DOWNLOAD_TIMEOUT
+    try:
+        res = net.request('GET', uri_to_ascii(url), headers={'User-Agent': USER_AGENT}, timeout=DOWNLOAD_TIMEOUT)
+    except HTTPError as e:
+        if e.getcode() == 404:
+            logging.warn("404 for {}".format(url))
+            return None, 0, None
+        raise
+    except URLError as e:
+        if not isinstance(e.reason, socket.timeout):
+            raise
+        logging.warn("Timed out requesting {}".format(url))
+        return None, 0, None
+    contenttype = res.headers['Content-Type']
+    imagetype = IMAGE_TYPES.get(contenttype, None)
+    if imagetype is None:
+        logging.warn("Non-image response ({}) for {}".format(contenttype, url))
+        res.close()
+        return None, 0, None
+    imagename = 'card{:02d}.{}'.format(index, imagetype)
+    imagepath = os.path.join(output_dir, imagename)
+    # only complete images appear under their own name, so that a resumed deck can trust any it finds
+    partpath = imagepath + '.part'
+    size = 0
+    digest = hashlib.sha1()
+    try:
+        with open(partpath, 'wb') as f:
+            while True:
+                if time.monotonic() > deadline:
+                    raise socket.timeout()
+                buff = res.read(DOWNLOAD_BUFFER_SIZE)
+                if not buff:
+                    break
+                f.write(buff)
+                digest.update(buff)
+                size += len(buff)
+    except (socket.timeout, URLError) as e:
+        res.close()
+        os.remove(partpath)
+        if isinstance(e, URLError) and not isinstance(e.reason, socket.timeout):
+            raise
+        logging.warn("Timed out downloading {}".format(url))
+        return None, 0, None
+    os.replace(partpath, imagepath)
+    return imagename, size, digest.hexdigest()
+
+
+def read_image_progress(output_dir):
+    # Returns the outcome of each card's image download recorded by an earlier attempt, by card index
+    done = {}
+    try:
+        with open(os.path.join(output_dir, IMAGES_CHECKPOINT_FILE), 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # cut short while being written
+                    break
+                done[record['index']] = record
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def download_images(config, cards, output_dir):
+    # Yields copies of the cards in order as their images arrive, with only a few downloads in flight at once. Each
+    # outcome is recorded in the deck directory, and cards whose images an earlier attempt got are not fetched again.
+    if config[FetchVars.OFFLINE]:
+        logging.warn("Offline - not downloading card images")
+        for card in cards:
+            yield dict(card, image=None)
+        return
+    starttime = time.monotonic()
+    workers = config[FetchVars.DOWNLOAD_WORKERS]
+    done = read_image_progress(output_dir)
+    
+    def download(item):
+        i, card = item
+        if card['image'] is None:
+            return None, 0, None
+        with trace.span('download_image', url=card['image']) as span:
+            result = download_image(card['image'], output_dir, i)
+            span.set(bytes=result[1])
+        return result
+    
+    # cards with identical images (flags, placeholder icons and so on) all share the first copy
+    numimages, numbytes, numdupes = 0, 0, 0
+    seen = { r['digest']: r['image'] for r in done.values() if r['image'] }
+    pending = collections.deque()
+    
+    def resolve(i, result, progress):
+        nonlocal numimages, numbytes, numdupes
+        imagename, size, digest = result
+        if imagename is not None:
+            numimages += 1
+            numbytes += size
+            if digest in seen:
+                os.remove(os.path.join(output_dir, imagename))
+                imagename = seen[digest]
+                numdupes += 1
+            else:
+                seen[digest] = imagename
+        progress.write(json.dumps({ 'index': i, 'image': imagename, 'digest': digest })+'\n')
+        progress.flush()
+        return imagename
+    
+    def drain(limit, progress):
+        while len(pending) > limit:
+            i, card, future = pending.popleft()
+            if future is None:
+                yield dict(card, image=done[i]['image'])
+            else:
+                yield dict(card, image=resolve(i, future.result(), progress))
+    
+    with trace.span('download_images') as span, ThreadPoolExecutor(workers) as executor, \
+            open(os.path.join(output_dir, IMAGES_CHECKPOINT_FILE), 'a') as progress:
         try:
-        
-            # Choose at random
-            catname = get_category()
-            if catname is None:
-                raise Exception("No more categories")
-            
-            category = {
-                'name': catname,
-                'friendly': None,
-                'description': None,
-                'image': None,
-            }
-            logging.info('{} chosen'.format(category['name']))
-            shorten_uri(prefix_lookup, category['name'])
-            
-            # Fetch top numerical properties as the statistics
-            results = query("""%(prefixes)s
-                               SELECT 
-                                   ?p 
-                                   COUNT(DISTINCT ?o) 
-                                   GROUP_CONCAT(DISTINCT datatype(?v), "|") as ?t
-                               WHERE
-                               {
-                                   ?o a %(category)s
-                                   . ?o ?p ?v
-                                   . FILTER( %(numeric-clause)s
-                                             && ?p != dbo:wikiPageID 
-                                             && ?p != dbo:wikiPageRevisionID )
-                               }
-                               GROUP BY ?p
-                               ORDER BY DESC(COUNT(DISTINCT ?o))
-                               LIMIT %(max-num-stats)d""" % {
-                                    'prefixes': prefix_declarations(prefix_lookup),
-                                    'category': shorten_uri(prefix_lookup, category['name']), 
-                                    'max-num-stats': MAX_NUM_STATS+3, # leeway for when we de-dup
-                                    'numeric-clause': NUMERIC_VAL_CLAUSE.format('?v') })
+            for i, card in enumerate(cards):
+                # cards fetched by an earlier attempt wait their turn behind any downloads still in flight
+                pending.append((i, card, executor.submit(download, (i, card)) if i not in done else None))
+                yield from drain(workers*2, progress)
+            yield from drain(0, progress)
+        except Exception:
+            # whatever else arrives is kept for the retry
+            for i, card, future in pending:
+                if future is not None and future.exception() is None:
+                    resolve(i, future.result(), progress)
+            raise
+        span.set(images=numimages, bytes=numbytes, duplicates=numdupes, resumed=len(done))
             
-            statistics = []
-            unqual_seen = set()
-            for result in results:
-                types = set(result['t'].split('|')) - {''}
-                if len(types) == 0:
-                    continue
-                unqual = result['p'].split('/')[-1]
-                if unqual in unqual_seen:
-                    continue
-                unqual_seen.add(unqual)
-                statistics.append({
-                    'name': result['p'], 
-                    'type': next(iter(types)),
-                    'friendly': None,
-                })
-            statistics = statistics[:MAX_NUM_STATS]
-                
-            logging.info('{} stats'.format(len(statistics)))
-            for s in statistics:
-                shorten_uri(prefix_lookup, s['name'])
+    elapsed = max(time.monotonic() - starttime, 0.001)
+    logging.info('Downloaded {} images ({:.1f} KB, {} duplicates) in {:.1f}s: {:.1f} images/s, {:.1f} KB/s'.format(
+        numimages, numbytes/1024, numdupes, elapsed, numimages/elapsed, numbytes/1024/elapsed))
+
+
+def screen_category(config, catname):
+    store = config[FetchVars.CATEGORY_STORE]
+    prefix_lookup = dict(IMPLICIT_PREFIXES)
+    
+    category = {
+        'name': catname,
+        'friendly': None,
+        'description': None,
+        'image': None,
+    }
+    logging.info('Screening {}'.format(category['name']))
+    shorten_uri(prefix_lookup, category['name'])
+    
+    # Fetch top numerical properties as the statistics
+    results = query_stats(config, prefix_lookup, category)
+    
+    statistics = []
+    unqual_seen = set()
+    for result in results:
+        types = set(result['t'].split('|')) - {''}
+        if len(types) == 0:
+            continue
+        unqual = result['p'].split('/')[-1]
+        if unqual in unqual_seen:
+            continue
+        unqual_seen.add(unqual)
+        statistics.append({
+            'name': result['p'], 
+            'type': next(iter(types)),
+            'friendly': None,
+        })
+    statistics = statistics[:MAX_NUM_STATS]
+        
+    logging.info('{} stats for {}'.format(len(statistics), category['name']))
+    for s in statistics:
+        shorten_uri(prefix_lookup, s['name'])
+    
+    if len(statistics) < MIN_NUM_STATS:
+        logging.info("Insufficient stats for {}: {}".format(category['name'], len(statistics)))
+        store.record_screening(catname, Verdict.INSUFFICIENT_STATS, len(statistics))
+        return None
+    
+    # ids of top category members
+    members = [ b['o'] for b in query_members(config, prefix_lookup, category, statistics) ]
+    logging.info('{} members for {}'.format(len(members), category['name']))
+    for m in members:
+        shorten_uri(prefix_lookup, m)
+    
+    if len(members) < MIN_DECK_SIZE:
+        logging.info("Insufficient members for {}: {}".format(category['name'], len(members)))
+        store.record_screening(catname, Verdict.INSUFFICIENT_MEMBERS, len(statistics), len(members))
+        return None
+    
+    store.record_screening(catname, Verdict.VIABLE, len(statistics), len(members))
             
-            if len(statistics) < MIN_NUM_STATS:
-                logging.info("Insufficient stats: {}".format(len(statistics)))
+    return category, statistics, members, prefix_lookup
+
+
+def choose_category(config):
+    starttime = time.monotonic()
+    candidates = []
+    for i in range(config[FetchVars.CANDIDATES]):
+        catname = get_category(config)
+        if catname is None:
+            break
+        candidates.append(catname)
+    if len(candidates) == 0:
+        raise Exception("No more categories")
+
+    def keep_if_viable(future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            logging.debug('Keeping {} for later'.format(futures[future]))
+            config[FetchVars.CATEGORY_STORE].put_back(futures[future])
+    
+    # Screen candidates concurrently and go with the first that turns out to be viable. The others are put back
+    # on the list - their screening queries are cached so trying them again later costs nothing.
+    def screen(catname):
+        with trace.span('screen_category', category=catname) as span:
+            result = screen_category(config, catname)
+            span.set(viable=result is not None)
+        return result
+    
+    executor = ThreadPoolExecutor(len(candidates))
+    futures = { executor.submit(screen, c): c for c in candidates }
+    chosen, errors = None, []
+    try:
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except CacheMiss as e:
+                logging.info("Skipping {}: {}".format(futures[future], e))
+                config[FetchVars.CACHE_MISSES].append(futures[future])
                 continue
-            
-            # Fetch ids of top category members
-            results = query("""%(prefixes)s
-                               SELECT ?o COUNT(DISTINCT ?p)
-                               WHERE
-                               {
-                                    ?o a %(category)s
-                                    . ?o ?p ?v
-                                    . FILTER( ( %(properties)s ) 
-                                              && %(numeric-clause)s )
-                                }
-                                GROUP BY ?o
-                                HAVING ( COUNT(DISTINCT ?p) >= %(min-num-stats)d )
-                                ORDER BY DESC(COUNT(DISTINCT ?p))
-                                LIMIT %(max-deck-size)d""" % {
-                                   'prefixes': prefix_declarations(prefix_lookup),
-                                   'category': shorten_uri(prefix_lookup, category['name']), 
-                                   'properties': ' || '.join([
-                                        '?p = {}'.format(shorten_uri(prefix_lookup,p['name'])) for p in statistics]),
-                                   'min-num-stats': MIN_NUM_STATS,
-                                   'max-deck-size': MAX_DECK_SIZE,
-                                   'numeric-clause': NUMERIC_VAL_CLAUSE.format('?v') })
-            
-            members = [ b['o'] for b in results ]
-            logging.info('{} members'.format(len(members)))
-            for m in members:
-                shorten_uri(prefix_lookup, m)
-            
-            if len(members) < MIN_DECK_SIZE:
-                logging.info("Insufficient members: {}".format(len(members)))
+            except (HTTPError, URLError) as e:
+                logging.error("{}: {}".format(futures[future], e))
+                errors.append(e)
                 continue
-    
-            # fetch category details
-            results = query("""%(prefixes)s
-                               SELECT 
-                                   GROUP_CONCAT(?l, "|") as ?name 
-                                   GROUP_CONCAT(?c, "|") as ?description 
-                                   GROUP_CONCAT(?t, "|") as ?image
-                               WHERE
-                               {
-                                   OPTIONAL { %(category)s rdfs:label ?l }
-                                   OPTIONAL { %(category)s rdfs:comment ?c }
-                                   OPTIONAL { %(category)s dbo:thumbnail ?t }
-                                   FILTER ( (langMatches(lang(?l), "EN") || lang(?l) = "") 
-                                             && (langMatches(lang(?c), "EN") || lang(?c) = "") )
-                               }""" % { 'prefixes': prefix_declarations(prefix_lookup),
-                                        'category': shorten_uri(prefix_lookup, category['name'])})
-            if len(results) > 0:
-                result = results[0]
-                category['friendly'] = pluralise(result['name'].split('|')[0].title()
-                                                 if result['name'] else uri_to_friendly(category['name']))
-                category['description'] = first_sentence(result['description'].split('|')[0]) \
-                                            if result['description'] else None
-                category['image'] = result['image'].split('|')[0] \
-                                            if result['image'] else None
+            if result is not None:
+                chosen = future
+                break
+    finally:
+        for future, catname in futures.items():
+            if future is chosen:
+                continue
+            if future.cancel():
+                config[FetchVars.CATEGORY_STORE].put_back(catname)
             else:
-                category['friendly'] = pluralise(uri_to_friendly(category['name']))
-            
-            # fetch stat details
-            results = query("""%(prefixes)s
-                               SELECT ?p GROUP_CONCAT(?l, "|") as ?name
-                               WHERE
-                               {
-                                   ?p rdfs:label ?l                               
-                                   . FILTER( ( %(properties)s )
-                                             && ( langMatches(lang(?l),"EN") || lang(?l) = "" ) )
-                               }
-                               GROUP BY ?p""" % {
-                                   'prefixes': prefix_declarations(prefix_lookup),
-                                   'properties': ' || '.join([
-                                        '?p = {}'.format(shorten_uri(prefix_lookup, p['name'])) for p in statistics]) })
-                                   
-            lookup = { r['p']: r['name'].split('|')[0].title() for r in results if r['name'] }
-            for s in statistics:
-                s['friendly'] = lookup.get(s['name'], uri_to_friendly(s['name']))
-                               
-            # Fetch member details
-            results = query("""%(prefixes)s
-                               SELECT 
-                                   ?o 
-                                   GROUP_CONCAT(DISTINCT ?label,"|") as ?name
-                                   GROUP_CONCAT(DISTINCT ?comment,"|") as ?description
-                                   GROUP_CONCAT(DISTINCT ?thumbnail,"|") as ?image
-                                   %(property-projections)s
-                               WHERE
-                              {
-                                   VALUES ?o { %(members)s }
-                                   OPTIONAL { ?o rdfs:label ?label }
-                                   OPTIONAL { ?o rdfs:comment ?comment }
-                                   OPTIONAL { ?o dbo:thumbnail ?thumbnail }
-                                   %(property-joins)s
-                                   FILTER( ( langMatches(lang(?label), "EN") || lang(?label) = "" )
-                                            && ( langMatches(lang(?comment), "EN") || lang(?comment) = "" ) )
-                               }
-                               GROUP BY ?o""" % {
-                                    'prefixes': prefix_declarations(prefix_lookup),
-                                    'property-projections': '\n'.join([
-                                        'GROUP_CONCAT(DISTINCT ?p{}, "|") as ?stat{}'.format(i, i) 
-                                        for i,p in enumerate(statistics)]),
-                                    'property-joins': '\n'.join([
-                                        'OPTIONAL {{ ?o {} ?p{} . FILTER {} }}'.format(
-                                            shorten_uri(prefix_lookup, p['name']), i, 
-                                            NUMERIC_VAL_CLAUSE.format('?p{}'.format(i)))
-                                        for i,p in enumerate(statistics)]), 
-                                    'members': ' '.join([
-                                        '{}'.format(shorten_uri(prefix_lookup, m))
-                                        for m in members] )})
+                future.add_done_callback(keep_if_viable)
+        executor.shutdown(wait=False)
+    
+    if chosen is None:
+        if len(errors) > 0:
+            raise errors[0]
+        return None
+    logging.info('{} chosen after screening {} candidates for {:.1f}s'.format(
+        futures[chosen], len(candidates), time.monotonic()-starttime))
+    return chosen.result()
+
+
+def member_cards(statistics, results):
+    # Stats are formatted a column at a time. Their raw values are kept alongside, as numbers or None.
+    results = list(results)
+    columns = [ format_stat_column(stat['type'], [ (r.get('stat{}'.format(i)) or '').split('|')[0]
+                                                    for r in results ])
+                for i, stat in enumerate(statistics) ]
+    cards = []
+    for j, result in enumerate(results):
+        cards.append({
+            'name': result['name'].split('|')[0].title() if result['name'] else uri_to_friendly(result['o']),
+            'description': first_sentence(result['description'].split('|')[0])
+                           if result['description'] else None,
+            'image': result['image'].split('|')[0] if result['image'] else None,
+            'stats': [ strings[j] for strings, numbers in columns ],
+            'values': [ None if math.isnan(numbers[j]) else numbers[j] for strings, numbers in columns ],
+        })
+    return cards
+
+
+def retry_delay(attempt, error):
+    # Exponential backoff with full jitter, but never sooner than the server asked for
+    delay = random.uniform(0, min(MAX_RETRY_DELAY, ERROR_PAUSE_TIME * 2**attempt))
+    return max(delay, net.retry_after(error) or 0)
+
+
+def load_checkpoint(output_dir):
+    try:
+        with open(os.path.join(output_dir, CHECKPOINT_FILE), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(state):
+    path = os.path.join(state['output_dir'], CHECKPOINT_FILE)
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmppath, path)
+    
+    
+def make_deck_dir(name):
+    # A new deck never writes into an existing directory, finished or not - it takes the next free numbered name
+    base = os.path.abspath(os.path.join('.', 'deck_{}'.format(friendly_to_filename(name))))
+    path = base
+    for n in itertools.count(2):
+        try:
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            path = '{}_{}'.format(base, n)
+    if path != base:
+        logging.warn("{} already exists, writing to {}".format(base, path))
+    return path
+
+
+def build_deck(config, state):
+    # Works through fetching a screened category's deck, saving each stage's results to the deck directory so that a
+    # retry picks up at the stage that failed. Returns the deck directory once it's complete.
+    category, statistics, members, prefix_lookup = (state[k] for k in 
+                                                     ('category', 'statistics', 'members', 'prefix_lookup'))
+    if 'deck' not in state:
+        # fetch category details and stat labels
+        result, results = query_deck_details(config, prefix_lookup, category, statistics)
+        if result is not None:
+            category['friendly'] = pluralise(result['name'].split('|')[0].title()
+                                             if result['name'] else uri_to_friendly(category['name']))
+            category['description'] = first_sentence(result['description'].split('|')[0]) \
+                                        if result['description'] else None
+            category['image'] = result['image'].split('|')[0] \
+                                        if result['image'] else None
+        else:
+            category['friendly'] = pluralise(uri_to_friendly(category['name']))
+        
+        lookup = { r['p']: r['name'].split('|')[0].title() for r in results if r['name'] }
+        for s in statistics:
+            s['friendly'] = lookup.get(s['name'], uri_to_friendly(s['name']))
             
-            cards = []
-            for result in results:
-                cards.append({
-                    'name': result['name'].split('|')[0].title() if result['name'] else uri_to_friendly(result['o']),
-                    'description': first_sentence(result['description'].split('|')[0])
-                                   if result['description'] else None,
-                    'image': result['image'].split('|')[0] if result['image'] else None,
-                    'stats': [],
-                })
-                for k, v in result.items():        
-                    if not k.startswith('stat'):
+        state['deck'] = {
+            'name': category['friendly'],
+            'description': category['description'] if category['description'] else None,
+            'stats': [s['friendly'] for s in statistics],
+        }
+        state['output_dir'] = make_deck_dir(state['deck']['name'])
+        logging.info("Writing deck \"{}\" to {}".format(state['deck']['name'], state['output_dir']))
+        save_checkpoint(state)
+    output_dir = state['output_dir']
+    
+    if 'cards' not in state:
+        # Fetch member details
+        results = query_member_details(config, prefix_lookup, statistics, members)
+        state['cards'] = member_cards(statistics, results)
+        save_checkpoint(state)
+    
+    logging.debug("writing deck file")
+    with trace.span('write_deck', deck=state['deck']['name']):
+        deckfile.write_deck(os.path.join(output_dir, '{}.jsonl'.format(os.path.basename(output_dir))), 
+                            state['deck'], download_images(config, state['cards'], output_dir))
+    # an offline run downloads nothing, so has no image progress to clear up
+    for name in (IMAGES_CHECKPOINT_FILE, CHECKPOINT_FILE):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(output_dir, name))
+    return output_dir
+
+
+def fetch_deck(args, input_dir):
+
+    # a directory left part-way through by an earlier run carries on from where it stopped, while a finished one has
+    # nothing to fetch and leaves the caches alone
+    state = load_checkpoint(input_dir) if input_dir else None
+    if input_dir and state is None:
+        return input_dir
+    if state is not None:
+        logging.info("Resuming deck \"{}\" in {}".format(state['deck']['name'], input_dir))
+        state['output_dir'] = os.path.abspath(input_dir)
+        input_dir = None
+
+    # a local dump keeps its own category list alongside the data, and needs no query cache
+    dump = DumpStore(args.dump) if args.dump else None
+    config = {
+        FetchVars.DOWNLOAD_WORKERS: max(args.downloadworkers, 1),
+        FetchVars.QUERY_CACHE: QueryCache(QUERY_CACHE_DIR, offline=args.offline) if dump is None else None,
+        FetchVars.OFFLINE: args.offline,
+        FetchVars.CANDIDATES: max(args.candidates, 1),
+        FetchVars.CATEGORY_STORE: CategoryStore(CATEGORY_DB) if dump is None else CategoryStore(args.dump),
+        FetchVars.DUMP: dump,
+        FetchVars.CATEGORY_REFRESH: None,
+        FetchVars.REFRESH_STOP: threading.Event(),
+        FetchVars.ROUND_TRIPS: collections.Counter(),
+        FetchVars.CACHE_MISSES: [],
+    }
+    if dump is None:
+        config[FetchVars.CATEGORY_STORE].migrate(CACHE_FILE)
+    attempts = 0
+        
+    # Loop until we get a category that works. Categories skipped for want of cached queries are only put back once
+    # the run is over, so that it doesn't draw them again.
+    try:
+        while not input_dir:
+            try:
+        
+                # Choose at random
+                if state is None:
+                    with trace.span('choose_category'):
+                        screened = choose_category(config)
+                    if screened is None:
                         continue
-                    idx = int(re.sub(r'[^0-9]', '', k))
-                    stat = statistics[idx]
-                    cards[-1]['stats'].append(format_stat(stat['type'], v.split('|')[0]))
-                    
-            deck = {
-                'name': category['friendly'],
-                'description': category['description'] if category['description'] else None,
-                'stats': [s['friendly'] for s in statistics],
-                'cards': cards,
-            }
-    
-            output_name = 'deck_{}'.format(friendly_to_filename(deck['name']))
-            output_dir = os.path.abspath(os.path.join('.', output_name))
-            logging.info("Writing deck \"{}\" to {}".format(deck['name'], output_dir))
-            os.mkdir(output_dir)
+                    state = dict(zip(('category', 'statistics', 'members', 'prefix_lookup'), screened))
+                    attempts = 0
             
-            for i, card in enumerate(deck['cards']):
-                if card['image'] is None:
-                    continue
-                logging.debug('Downloading {}'.format(card['image']))
-                try:
-                    res = urlopen(Request(uri_to_ascii(card['image']), headers={'User-Agent': USER_AGENT}))
-                except HTTPError as e:
-                    if e.getcode() == 404:
-                        logging.warn("404 for {}".format(card['image']))
-                        card['image'] = None
-                        continue
-                    raise
-                contenttype = res.headers['Content-Type']
-                imagetype = IMAGE_TYPES.get(contenttype, None)
-                if imagetype is None:
-                    logging.warn("Non-image response ({}) for {}".format(contenttype, card['image']))
-                    card['image'] = None
-                    continue
-                imagename = 'card{:02d}.{}'.format(i, imagetype)
-                with open(os.path.join(output_dir, imagename), 'wb') as f:
-                    while True:
-                        buff = res.read(1024)
-                        if not buff:
-                            break
-                        f.write(buff)
-                card['image'] = imagename
-               
-            logging.debug("writing json file")         
-            with open(os.path.join(output_dir, '{}.json'.format(output_name)), 'w') as f:
-                json.dump(deck, f, indent=2)
+                # exit condition - we're done
+                input_dir = build_deck(config, state)
             
-            # exit condition - we're done
-            input_dir = output_dir
+            except CacheMiss as e:
+                logging.info("Skipping category: {}".format(e))
+                if state is not None:
+                    config[FetchVars.CACHE_MISSES].append(state['category']['name'])
+                state = None
+                continue
             
-        except (HTTPError, URLError) as e:
-            logging.error(e)
-            logging.debug("Pausing for {}s".format(ERROR_PAUSE_TIME))
-            time.sleep(ERROR_PAUSE_TIME)
-            continue
+            except (HTTPError, URLError) as e:
+                logging.error(e)
+                attempts += 1
+                if state is not None and attempts >= MAX_ATTEMPTS:
+                    logging.warn("Giving up on {} after {} attempts{}".format(state['category']['name'], attempts, 
+                                 " - resume it with --datadir {}".format(state['output_dir']) 
+                                 if 'output_dir' in state else ''))
+                    state = None
+                    attempts = 0
+                delay = retry_delay(attempts, e)
+                logging.info("Retrying in {:.1f}s".format(delay))
+                time.sleep(delay)
+                continue
+    finally:
+        stop_refresh(config)
+        for catname in config[FetchVars.CACHE_MISSES]:
+            config[FetchVars.CATEGORY_STORE].put_back(catname)
 
+    round_trips = config[FetchVars.ROUND_TRIPS]
+    logging.info('{} SPARQL round trips for the deck{}'.format(sum(round_trips.values()), ''.join(
+        ', {} {}'.format(n, label) for label, n in sorted(round_trips.items()))))
+    net.log_stats()
+    cache = config[FetchVars.QUERY_CACHE]
+    if cache is not None:
+        logging.info('Query cache: {} hits, {} misses'.format(cache.hits, cache.misses))
     return input_dir
@@ -0,0 +1,103 @@
+import os
+import os.path
+import hashlib
+import logging
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+
+POINTS_PER_INCH = 72.0
+JPEG_QUALITY = 90
+NORMALISED_TYPES = 'jpg', 'png'
+HASH_BLOCK_SIZE = 64*1024
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def image_digests(input_dir, imagenames):
+    return { n: file_digest(os.path.join(input_dir, n)) for n in set(imagenames) }
+
+
+def dedupe_images(input_dir, imagenames, digests=None):
+    # Returns a lookup of image name to the first image name with identical content
+    if digests is None:
+        digests = image_digests(input_dir, imagenames)
+    lookup = {}
+    seen = {}
+    for imagename in sorted(set(imagenames)):
+        lookup[imagename] = seen.setdefault(digests[imagename], imagename)
+    return lookup
+
+
+def normalised_name(imagename, dpi, imagetype):
+    return '{}-{}dpi.{}'.format(os.path.splitext(imagename)[0], dpi, imagetype)
+
+
+def cached_image(input_dir, imagename, dpi):
+    srctime = os.path.getmtime(os.path.join(input_dir, imagename))
+    for imagetype in NORMALISED_TYPES:
+        name = normalised_name(imagename, dpi, imagetype)
+        path = os.path.join(input_dir, name)
+        if os.path.exists(path) and os.path.getmtime(path) >= srctime:
+            return name
+    return None
+
+
+def normalise_image(input_dir, imagename, box, dpi):
+    # Shrinks the image to fit its box at the given resolution. Anything with transparency is stored as png and
+    # everything else as jpeg.
+    src = os.path.join(input_dir, imagename)
+    with Image.open(src) as img:
+        hasalpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+        imagetype = 'png' if hasalpha else 'jpg'
+        boxpx = [max(int(round(d / POINTS_PER_INCH * dpi)), 1) for d in box]
+        if img.size[0] <= boxpx[0] and img.size[1] <= boxpx[1] and img.format == ('PNG' if hasalpha else 'JPEG'):
+            return imagename
+        img.draft('RGB', boxpx)
+        img = img.convert('RGBA' if hasalpha else 'RGB')
+        img.thumbnail(boxpx, Image.LANCZOS)
+        name = normalised_name(imagename, dpi, imagetype)
+        tmppath = os.path.join(input_dir, '{}.{}.tmp'.format(name, os.getpid()))
+        if imagetype == 'png':
+            img.save(tmppath, 'PNG', optimize=True)
+        else:
+            img.save(tmppath, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmppath, os.path.join(input_dir, name))
+    return name
+
+
+def normalise_worker(input_dir, imagename, box, dpi):
+    try:
+        return normalise_image(input_dir, imagename, box, dpi)
+    except (OSError, ValueError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        # the original is embedded as it is
+        logging.warn("Failed to normalise {}: {}".format(imagename, e))
+        return imagename
+
+
+def normalise_images(input_dir, imagenames, box, dpi, workers=None):
+    # Returns a lookup of original image name to the name of the version to embed. Results are kept alongside the
+    # originals and reused until the original changes.
+    lookup = {}
+    todo = []
+    for imagename in set(imagenames):
+        cached = cached_image(input_dir, imagename, dpi)
+        if cached is not None:
+            lookup[imagename] = cached
+        else:
+            todo.append(imagename)
+    logging.info('Normalising {} images to {}dpi ({} cached)'.format(len(todo), dpi, len(lookup)))
+    if len(todo) > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = executor.map(normalise_worker, *zip(*[(input_dir, n, box, dpi) for n in todo]))
+            lookup.update(zip(todo, results))
+    elif len(todo) == 1:
+        lookup[todo[0]] = normalise_worker(input_dir, todo[0], box, dpi)
+    return lookup
@@ -0,0 +1,237 @@
+import io
+import zlib
+import email.utils
+import logging
+import threading
+import http.client
+
+from datetime import datetime, timezone
+
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urlunsplit, urljoin, quote
+
+
+MAX_IDLE_PER_HOST = 8
+MAX_REDIRECTS = 5
+READ_SIZE = 64*1024
+ACCEPT_ENCODING = 'gzip, deflate'
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+URL_SAFE_CHARS = ":/?#[]@!$&'()*+,;=%~"
+
+
+class Response:
+
+    def __init__(self, pool, key, conn, res, url):
+        self.status = res.status
+        self.reason = res.reason
+        self.headers = res.headers
+        self.url = url
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._res = res
+        self._buffer = b''
+        self._eof = False
+        self.bytes_received = 0
+        encoding = (res.getheader('Content-Encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            self._decoder = None
+        self._first_chunk = True
+
+    def _decode(self, chunk):
+        if self._decoder is None:
+            return chunk
+        try:
+            data = self._decoder.decompress(chunk)
+        except zlib.error:
+            # some servers send raw deflate data without the zlib wrapper
+            if not self._first_chunk:
+                raise
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self._decoder.decompress(chunk)
+        self._first_chunk = False
+        return data
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            try:
+                chunk = self._res.read(READ_SIZE)
+            except (http.client.HTTPException, OSError) as e:
+                self.close()
+                raise URLError(e)
+            if not chunk:
+                self._eof = True
+                if self._decoder is not None:
+                    self._buffer += self._decoder.flush()
+                self._release()
+                break
+            self._pool._count('bytes_received', len(chunk))
+            self.bytes_received += len(chunk)
+            try:
+                data = self._decode(chunk)
+            except zlib.error as e:
+                self.close()
+                raise URLError(e)
+            self._pool._count('bytes_decoded', len(data))
+            self._buffer += data
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _release(self):
+        if self._conn is not None:
+            self._pool._release(self._key, self._conn, self._res)
+            self._conn = None
+
+    def close(self):
+        # connections with unread data on them can't be reused
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._eof = True
+        self._buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+
+    COUNTERS = ('requests', 'connections_opened', 'connections_reused', 'bytes_received', 'bytes_decoded')
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._counters = { n: 0 for n in self.COUNTERS }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['bytes_saved'] = max(stats['bytes_decoded'] - stats['bytes_received'], 0)
+        return stats
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            self._count('connections_reused')
+            return conn, True
+        scheme, netloc = key
+        conncls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self._count('connections_opened')
+        return conncls(netloc, timeout=timeout), False
+
+    def _release(self, key, conn, res):
+        if res.will_close or conn.sock is None:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, method, url, body, headers, timeout):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise URLError('Unsupported scheme for {}'.format(url))
+        key = parts.scheme, parts.netloc
+        path = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        conn, reused = self._acquire(key, timeout)
+        try:
+            try:
+                conn.request(method, path, body, headers)
+                res = conn.getresponse()
+            except STALE_ERRORS:
+                # server dropped an idle keep-alive connection - try again on a fresh one
+                if not reused:
+                    raise
+                conn.close()
+                self._count('connections_opened')
+                conn.request(method, path, body, headers)
+                res = conn.getresponse()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise URLError(e)
+        self._count('requests')
+        return Response(self, key, conn, res, url)
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+        for i in range(MAX_REDIRECTS+1):
+            res = self._send(method, url, body, headers, timeout)
+            location = res.headers.get('Location')
+            if res.status in REDIRECT_CODES and location:
+                res.read()
+                url = urljoin(url, quote(location, safe=URL_SAFE_CHARS))
+                if res.status == 303 or (res.status in (301, 302) and method == 'POST'):
+                    method, body = 'GET', None
+                    headers.pop('Content-Type', None)
+                continue
+            if res.status >= 400:
+                raise HTTPError(url, res.status, res.reason, res.headers, io.BytesIO(res.read()))
+            return res
+        raise URLError('Too many redirects for {}'.format(url))
+
+
+default_pool = ConnectionPool()
+
+
+def request(method, url, body=None, headers=None, timeout=None):
+    return default_pool.request(method, url, body, headers, timeout)
+
+
+def log_stats(pool=None):
+    stats = (pool or default_pool).stats()
+    logging.info('HTTP: {} requests, {} connections opened, {} reused, {:.1f} KB received, '
+                 '{:.1f} KB saved by compression'.format(
+                     stats['requests'], stats['connections_opened'], stats['connections_reused'],
+                     stats['bytes_received']/1024, stats['bytes_saved']/1024))
+
+
+def retry_after(error):
+    # Returns the number of seconds an error response asked the client to wait before retrying, or None
+    headers = getattr(error, 'headers', None)
+    value = (headers.get('Retry-After') or '').strip() if headers is not None else ''
+    if value.isdigit():
+        return int(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
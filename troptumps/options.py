@@ -0,0 +1,33 @@
+import os
+import os.path
+import enum
+
+
+# Defaults and choices for the command line, kept apart from the modules that use them so that building the
+# argument parser doesn't import reportlab and the rest
+
+
+class BacksType(enum.Enum):
+    LONG_FLIP = enum.auto()
+    SHORT_FLIP = enum.auto()
+    NONE = enum.auto()
+
+
+# the sizes in reportlab.lib.pagesizes, lowercased
+PAGE_SIZES = (
+    'a0', 'a1', 'a2', 'a3', 'a4', 'a5', 'a6', 'a7', 'a8', 'a9', 'a10',
+    'b0', 'b1', 'b2', 'b3', 'b4', 'b5', 'b6', 'b7', 'b8', 'b9', 'b10',
+    'c0', 'c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8', 'c9', 'c10',
+    'elevenseventeen', 'gov_legal', 'gov_letter', 'half_letter', 'junior_legal', 'ledger', 'legal', 'letter',
+    'tabloid',
+)
+DEFAULT_PAGE_SIZE = 'a4'
+DEFAULT_PAGE_MARGIN_MM = 9
+DEFAULT_BLEED_MARGIN_MM = 3
+DEFAULT_BACKS_TYPE = BacksType.LONG_FLIP.name.lower()
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_CANDIDATES = 1
+DEFAULT_SERVE_HOST = 'localhost'
+DEFAULT_SERVE_QUEUE = 8
+CACHE_FILE = os.path.expanduser(os.path.join('~', '.cache', 'troptumps'))
+DUMP_DB = CACHE_FILE + '-dump.sqlite'
@@ -1,11 +1,25 @@
 import os
 import os.path
-import json
 import logging
 import colorsys
 import enum
 import re
+import copy
+import json
+import time
 import random
+import shutil
+import bisect
+import pickle
+import hashlib
+import functools
+import threading
+import weakref
+import tempfile
+import itertools
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+import reportlab
 from reportlab.pdfgen import canvas
 from reportlab import platypus
 from reportlab.lib import pagesizes
@@ -15,6 +29,11 @@ from reportlab.lib import colors
 from reportlab.pdfbase import ttfonts
 from reportlab.pdfbase import pdfmetrics
 
+from . import images
+from . import deckfile
+from . import trace
+from .options import BacksType
+
 
 class PdfVars(enum.Enum):
     BLEED_MARGIN = enum.auto()
@@ -27,16 +46,13 @@ class PdfVars(enum.Enum):
     BACKS_TYPE = enum.auto()
 
 
-class BacksType(enum.Enum):
-    LONG_FLIP = enum.auto()
-    SHORT_FLIP = enum.auto()
-    NONE = enum.auto()
-
-
 FONT_DIR = os.path.join(os.path.dirname(__file__), 'fonts')
+FONT_CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'troptumps-fonts'))
+FONT_CACHE_VERSION = 1
 DEFAULT_FONT = 'DejaVuSans'
 FONT_FALLBACK_REGEX = r'[^\u0000-\u01ff]+'
 FONT_FALLBACK_ORDER = ['DejaVuSans', 'FreeSerif', 'KaiGenGothicCN']
+FONT_FALLBACK_MEMO_SIZE = 4096
 FONT_B_SUFFIX = '-Bold'
 FONT_I_SUFFIX = '-Oblique'
 FONT_BI_SUFFIX = '-BoldOblique'
@@ -63,12 +79,18 @@ DECK_CREDITS = "Generated using data from http://wiki.dbpedia.org"
 CARD_STAT_SPACING = 1.3
 CARD_CORNER_RAD = 4*mm
 
-DEFAULT_PAGE_SIZE = 'a4'
-DEFAULT_PAGE_MARGIN_MM = 9
-DEFAULT_BLEED_MARGIN_MM = 3
+SHEET_CACHE_DIR = '.sheets'
+SHEET_MANIFEST = 'manifest.json'
+SHEET_CACHE_VERSION = 1
+
 DEFAULT_PRIMARY_S = 0.5
 DEFAULT_PRIMARY_L_RANGE = 0.1, 0.8
-DEFAULT_BACKS_TYPE = BacksType.LONG_FLIP.name.lower()    
+
+_font_families = {}
+_font_coverage = None
+_font_set = None
+_font_lock = threading.RLock()
+_font_fallback_re = re.compile(FONT_FALLBACK_REGEX)
 
 
 def adjacent_h(hsl, amount):
@@ -96,10 +118,37 @@ def grid_size(config):
     return int(avail_page_w / total_card_w), int(avail_page_h / total_card_h)
     
     
-def card_canv_itr(c, config):
-    backstype = config[PdfVars.BACKS_TYPE]
+def card_form(c, name, bbox, draw):
+    # Identical drawing is captured once per document as a form XObject, and each use just references it
+    if not c.hasForm(name):
+        c.beginForm(name, *bbox)
+        draw()
+        c.endForm()
+    c.doForm(name)
+    
+    
+def draw_card_back(c, config):
     text_hsl = contrasting_l(config[PdfVars.PRIMARY_HSL], TEXT_LUM_CONTRAST)
     facesize = CARD_SIZE[0]-CARD_MARGIN*2, CARD_SIZE[1]-CARD_MARGIN*2
+    
+    def draw():
+        c.setFillColorRGB(*colors.hsl2rgb(*text_hsl))
+        c.setFont(DEFAULT_FONT+FONT_I_SUFFIX, DECK_TITLE_SIZE)
+        c.drawCentredString(facesize[0]/2, -facesize[1]*(1-GOLDEN_RATIO), "Trop Tumps")
+    card_form(c, 'card-back', (0, -facesize[1], facesize[0], 0), draw)
+    
+    
+def draw_card_backs(c, config, upsidedown, cardcount, showpage=True):
+    backs_itr = card_canv_itr_page(c, config, True, upsidedown, showpage) 
+    for i in range(cardcount):
+        next(backs_itr)
+        draw_card_back(c, config)
+    halt_card_itr(backs_itr)
+    
+
+def card_canv_itr(c, config):
+    backstype = config[PdfVars.BACKS_TYPE]
+    gridsize = grid_size(config)
     endnow = False
     while True:
         # fronts        
@@ -122,18 +171,18 @@ def card_canv_itr(c, config):
             """
             pagesize = config[PdfVars.PAGE_SIZE]
             upsidedown = (pagesize[1] > pagesize[0]) == (backstype == BacksType.SHORT_FLIP)
-            backs_itr = card_canv_itr_page(c,config, True, upsidedown) 
-            for i in range(cardcount):
-                next(backs_itr)
-                c.setFillColorRGB(*colors.hsl2rgb(*text_hsl))
-                c.setFont(DEFAULT_FONT+FONT_I_SUFFIX, DECK_TITLE_SIZE)
-                c.drawCentredString(facesize[0]/2, -facesize[1]*(1-GOLDEN_RATIO), "Trop Tumps")
-            halt_card_itr(backs_itr)
+            # a full page of backs is the same every time
+            if cardcount == gridsize[0]*gridsize[1]:
+                card_form(c, 'backs-page', (0, 0, pagesize[0], pagesize[1]), 
+                          lambda: draw_card_backs(c, config, upsidedown, cardcount, False))
+                c.showPage()
+            else:
+                draw_card_backs(c, config, upsidedown, cardcount)
         if endnow:
             break
 
 
-def card_canv_itr_page(c, config, rtl, upsidedown):
+def card_canv_itr_page(c, config, rtl, upsidedown, showpage=True):
     gridsize = grid_size(config)
     pagesize = config[PdfVars.PAGE_SIZE]
     pmargin = config[PdfVars.PAGE_MARGIN]
@@ -144,6 +193,22 @@ def card_canv_itr_page(c, config, rtl, upsidedown):
     card_space = CARD_SIZE[0]+bleed*2, CARD_SIZE[1]+bleed*2
     xstart = pagesize[0]-pmargin*2-card_space[0] if rtl else 0
     xdir = -1 if rtl else 1
+    
+    def draw_frame():
+        # draw background colour over whole bleed area
+        c.setFillColorRGB(*colors.hsl2rgb(*primary_hsl))
+        c.rect(0.0, 0.0, card_space[0], -card_space[1], stroke=0, fill=1)
+        # draw card outline
+        c.translate(bleed, -bleed)
+        c.setStrokeColorRGB(*colors.hsl2rgb(*outline_hsl))
+        c.setLineWidth(CARD_OUTLINE_WIDTH)
+        if rounded:
+            c.roundRect(0.0, -CARD_SIZE[1], CARD_SIZE[0], CARD_SIZE[1], CARD_CORNER_RAD, stroke=1, fill=0)
+        else:
+            c.rect(0.0, 0.0, CARD_SIZE[0], -CARD_SIZE[1], stroke=1, fill=0)
+    # outline can overhang the bleed area by half its width
+    frame_bbox = -CARD_OUTLINE_WIDTH, -card_space[1]-CARD_OUTLINE_WIDTH, \
+                 card_space[0]+CARD_OUTLINE_WIDTH, CARD_OUTLINE_WIDTH
 
     c.translate(pagesize[0]/2, pagesize[1]/2)
     c.rotate(180 if upsidedown else 0)   
@@ -152,27 +217,18 @@ def card_canv_itr_page(c, config, rtl, upsidedown):
     for j in range(gridsize[1]):
         for i in range(gridsize[0]):
             c.saveState()
-            # draw background colour over whole bleed area
             c.translate(card_space[0]*i*xdir, -card_space[1]*j)
-            c.setFillColorRGB(*colors.hsl2rgb(*primary_hsl))
-            c.rect(0.0, 0.0, card_space[0], -card_space[1], stroke=0, fill=1)
-            # draw card outline
-            c.translate(bleed, -bleed)
-            c.setStrokeColorRGB(*colors.hsl2rgb(*outline_hsl))
-            c.setLineWidth(CARD_OUTLINE_WIDTH)
-            if rounded:
-                c.roundRect(0.0, -CARD_SIZE[1], CARD_SIZE[0], CARD_SIZE[1], CARD_CORNER_RAD, stroke=1, fill=0)
-            else:
-                c.rect(0.0, 0.0, CARD_SIZE[0], -CARD_SIZE[1], stroke=1, fill=0)
+            card_form(c, 'card-frame', frame_bbox, draw_frame)
             # move to card design area
-            c.translate(CARD_MARGIN, -CARD_MARGIN)
+            c.translate(bleed+CARD_MARGIN, -bleed-CARD_MARGIN)
             endnow = yield
             c.restoreState()
             if endnow: 
                 break
         if endnow: 
             break            
-    c.showPage()
+    if showpage:
+        c.showPage()
 
 
 def halt_card_itr(itr):
@@ -182,44 +238,206 @@ def halt_card_itr(itr):
         pass
 
 
-def tag_font_fallbacks(text):
-    def repl(match):
-        out = ""
-        prev = None
-        fnum = 0
-        for c in match.group(0):
-            while fnum < len(FONT_FALLBACK_ORDER):
-                if ord(c) in pdfmetrics.getFont(FONT_FALLBACK_ORDER[fnum]).face.charWidths:
-                    if fnum != prev:
-                        if prev is not None:
-                            out += '</font>'
-                        out += '<font face="{}">'.format(FONT_FALLBACK_ORDER[fnum])
-                        prev = fnum
-                    out += c
-                    break
-                fnum += 1
+class SharedImage(platypus.Image):
+    # Always draws by filename rather than from decoded image data, so that every card using the same file refers
+    # to one image XObject in the PDF and the image is only decoded once
+    
+    def draw(self):
+        self.canv.drawImage(self.filename, getattr(self, '_offs_x', 0), getattr(self, '_offs_y', 0), 
+                            self.drawWidth, self.drawHeight, mask=self._mask)
+
+
+class FontCoverage:
+    # Index of which fallback fonts cover which codepoints, as sorted ranges of codepoints sharing the same bitmask
+    # of covering fonts. Fonts are only loaded into the index once a character isn't covered by those before them.
+
+    def __init__(self, families):
+        self.families = families
+        self.loaded = 0
+        self.codepoints = {}
+        self.starts, self.ends, self.masks = [], [], []
+        self._last = 1, 0, 0
+
+    def _extend(self):
+        fontfam = self.families[self.loaded]
+        bit = 1 << self.loaded
+        self.loaded += 1
+        if not register_font_family(fontfam):
+            return
+        for cp in pdfmetrics.getFont(fontfam).face.charWidths:
+            self.codepoints[cp] = self.codepoints.get(cp, 0) | bit
+        self.starts, self.ends, self.masks = [], [], []
+        for cp in sorted(self.codepoints):
+            mask = self.codepoints[cp]
+            if len(self.starts) > 0 and self.ends[-1] == cp-1 and self.masks[-1] == mask:
+                self.ends[-1] = cp
             else:
-                logging.warn('No font for character {}'.format(hex(ord(c))))
-                out += c
-                fnum = 0
-        if prev is not None:
-            out += '</font>'
-        logging.debug('Fallback replacement: "{}" -> "{}"'.format(match.group(0), out))
-        return out
-                
-    return re.sub(FONT_FALLBACK_REGEX, repl, text)
+                self.starts.append(cp)
+                self.ends.append(cp)
+                self.masks.append(mask)
+        self._last = 1, 0, 0
 
+    def mask(self, cp):
+        # neighbouring characters tend to fall in the same range, so try the last one first
+        last = self._last
+        if last[0] <= cp <= last[1]:
+            return last[2]
+        i = bisect.bisect_right(self.starts, cp) - 1
+        if i >= 0 and cp <= self.ends[i]:
+            self._last = self.starts[i], self.ends[i], self.masks[i]
+            return self.masks[i]
+        return 0
 
-def create_pdf(args, input_dir):
+    def first_font(self, cp, start=0):
+        # index of the first font at or after start which covers the codepoint, or None
+        while True:
+            mask = self.mask(cp) >> start
+            if mask:
+                return start + (mask & -mask).bit_length() - 1
+            if self.loaded == len(self.families):
+                return None
+            self._extend()
 
-    # read deck data
-    input_name = os.path.basename(input_dir)
-    with open(os.path.join(input_dir, '{}.json'.format(input_name)), 'r') as f:
-        deck = json.load(f)
+
+def font_coverage():
+    global _font_coverage
+    with _font_lock:
+        if _font_coverage is None:
+            _font_coverage = FontCoverage(FONT_FALLBACK_ORDER)
+        return _font_coverage
+
+
+def tag_fallback_run(coverage, run):
+    # Once a run has switched to a fallback font it stays on it for as long as that font has the characters, to
+    # avoid switching back and forth
+    out = []
+    missing = []
+    prev = None
+    fnum = 0
+    for c in run:
+        found = coverage.first_font(ord(c), fnum)
+        if found is None:
+            missing.append(c)
+            out.append(c)
+            fnum = 0
+            continue
+        if found != prev:
+            if prev is not None:
+                out.append('</font>')
+            out.append('<font face="{}">'.format(FONT_FALLBACK_ORDER[found]))
+            prev = found
+        out.append(c)
+        fnum = found
+    if prev is not None:
+        out.append('</font>')
+    out = ''.join(out)
+    if len(missing) > 0:
+        logging.warn('No font for characters {}'.format(' '.join(sorted({hex(ord(c)) for c in missing}))))
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Fallback replacement: "{}" -> "{}"'.format(run, out))
+    return out
+
+
+@functools.lru_cache(maxsize=FONT_FALLBACK_MEMO_SIZE)
+def tag_font_fallbacks(text):
+    if not _font_fallback_re.search(text):
+        return text
+    coverage = font_coverage()
+    with _font_lock:
+        return _font_fallback_re.sub(lambda m: tag_fallback_run(coverage, m.group(0)), text)
+
+
+def font_cache_file(data):
+    return os.path.join(FONT_CACHE_DIR, 'rl{}-v{}-{}.pickle'.format(
+        reportlab.Version, FONT_CACHE_VERSION, hashlib.sha1(data).hexdigest()))
+
+
+def load_font(fname, ffile):
+    # Parsing a TTF file is slow for the larger fonts, so the parsed metrics and face data are pickled to disk,
+    # keyed by a hash of the font file. The raw font data and scale function aren't stored - they're cheap to
+    # recreate.
+    with open(ffile, 'rb') as f:
+        data = f.read()
+    cachefile = font_cache_file(data)
+    try:
+        with open(cachefile, 'rb') as f:
+            font_state, face_state = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+        font = ttfonts.TTFont(fname, ffile)
+        font_state = { k: v for k, v in vars(font).items() if k not in ('face', 'state') }
+        face_state = { k: v for k, v in vars(font.face).items() if k not in ('_ttf_data', '_pdfScale') }
+        try:
+            os.makedirs(FONT_CACHE_DIR, exist_ok=True)
+            tmpfile = '{}.{}.tmp'.format(cachefile, os.getpid())
+            with open(tmpfile, 'wb') as f:
+                pickle.dump((font_state, face_state), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cachefile)
+        except OSError as e:
+            logging.warn("Failed to cache font {}: {}".format(fname, e))
+        return font
     
-    logging.info("Generating PDF")
-    output_dir = input_dir
-    output_name = input_name
+    face = ttfonts.TTFontFace.__new__(ttfonts.TTFontFace)
+    vars(face).update(face_state)
+    face._ttf_data = data
+    unitscale = 1000 / face.unitsPerEm
+    face._pdfScale = (lambda x: x) if face.unitsPerEm == 1000 else (lambda x: x*unitscale)
+    font = ttfonts.TTFont.__new__(ttfonts.TTFont)
+    vars(font).update(font_state)
+    font.fontName = fname
+    font.face = face
+    font.state = weakref.WeakKeyDictionary()
+    return font
+
+
+def register_font_family(fontfam):
+    # Returns whether the family is available, registering it on first use
+    with _font_lock:
+        if fontfam in _font_families:
+            return _font_families[fontfam]
+        fargs = {}
+        for fontext in ('.ttf', '.otf'):
+            for fsuff,arg in [('','normal'), (FONT_B_SUFFIX,'bold'), (FONT_I_SUFFIX,'italic'), 
+                              (FONT_BI_SUFFIX,'boldItalic')]:
+                fname = fontfam + fsuff
+                ffile = os.path.join(FONT_DIR, fname + fontext)
+                if not os.path.exists(ffile):
+                    continue
+                with trace.span('register_font', font=fname):
+                    pdfmetrics.registerFont(load_font(fname, ffile))
+                fargs[arg] = fname
+    
+            if len(fargs) > 0:
+                logging.debug('Registered font family {}'.format(fontfam))
+                pdfmetrics.registerFontFamily(fontfam, **fargs)
+                break
+        _font_families[fontfam] = len(fargs) > 0
+        return _font_families[fontfam]
+
+
+def register_fonts():
+    # Fallback fonts are registered lazily, only when a character needs them. If the fonts on offer have changed
+    # since the last call, everything worked out from the old ones is forgotten.
+    global _font_coverage, _font_set
+    fontset = FONT_DIR, tuple(FONT_FALLBACK_ORDER)
+    with _font_lock:
+        if _font_set is not None and _font_set != fontset:
+            _font_families.clear()
+            _font_coverage = None
+            tag_font_fallbacks.cache_clear()
+        _font_set = fontset
+    register_font_family(DEFAULT_FONT)
+
+
+def preload_fonts():
+    # For long-running processes: registers and indexes every fallback font now rather than on first use
+    register_fonts()
+    coverage = font_coverage()
+    with _font_lock:
+        while coverage.loaded < len(coverage.families):
+            coverage._extend()
+
+
+def page_config(args):
     primary_hsl = args.color if args.color is not None \
                              else (random.random(),
                                    DEFAULT_PRIMARY_S,
@@ -256,23 +474,10 @@ def create_pdf(args, input_dir):
     else:
         pdf_config[PdfVars.PAGE_SIZE] = pagesizes.landscape(pdf_config[PdfVars.PAGE_SIZE])
     
-    # load fonts
-    for fontfam in FONT_FALLBACK_ORDER:
-        for fontext in ('.ttf', '.otf'):
-            fargs = {}
-            for fsuff,arg in [('','normal'), (FONT_B_SUFFIX,'bold'), (FONT_I_SUFFIX,'italic'), 
-                              (FONT_BI_SUFFIX,'boldItalic')]:
-                fname = fontfam + fsuff
-                ffile = os.path.join(FONT_DIR, fname + fontext)
-                if not os.path.exists(ffile):
-                    continue
-                pdfmetrics.registerFont(ttfonts.TTFont(fname, ffile))
-                fargs[arg] = fname
+    return pdf_config
     
-            if len(fargs) > 0:
-                pdfmetrics.registerFontFamily(fontfam, **fargs)
-                break
     
+def card_styles(pdf_config):
     prefront_style = styles.ParagraphStyle('prefront-style', fontName=DEFAULT_FONT, fontSize=DECK_PRETITLE_SIZE,
                                             alignment=styles.TA_CENTER, textColor=colors.Color(
                                                 *colors.hsl2rgb(*pdf_config[PdfVars.TEXT_HSL])))
@@ -329,48 +534,327 @@ def create_pdf(args, input_dir):
                                           ('BOTTOMPADDING',(0,0),(-1,-1),0),
                                           ('VALIGN',(0,0),(-1,-1),'MIDDLE'),
                                           ('LEADING',(0,0),(-1,-1),CARD_STAT_SIZE)])
-        
-    canv = canvas.Canvas(os.path.join(output_dir, '{}.pdf'.format(output_name)), pagesize=pdf_config[PdfVars.PAGE_SIZE])
+    
+    return {
+        'prefront': prefront_style,
+        'front': front_style,
+        'title': title_style,
+        'desc': desc_style,
+        'creds': creds_style,
+        'stat': stat_style,
+        'front-tbl': front_tbl_style,
+        'tbl': tbl_style,
+        'stat-tbl': stat_tbl_style,
+    }
+    
+    
+def card_face_size():
+    facesize = CARD_SIZE[0]-CARD_MARGIN*2, CARD_SIZE[1]-CARD_MARGIN*2
+    imagesize = facesize[0]-6*mm, facesize[1]*(CARD_SECTION_PROPS[1]/sum(CARD_SECTION_PROPS))
+    return facesize, imagesize
+    
+    
+def render_cards(pdf_config, input_dir, deck, image_files, numcards, output_file, start=0, stop=None):
+    # Draws the deck to output_file, from card position start up to stop. Position 0 is the title card, so the deck's
+    # cards are at 1 to numcards.
+    
+    register_fonts()
+    sty = card_styles(pdf_config)
+    facesize, imagesize = card_face_size()
+    stop = numcards+1 if stop is None else stop
+    
+    canv = canvas.Canvas(output_file, pagesize=pdf_config[PdfVars.PAGE_SIZE])
     canv.setTitle('Trop Tumps '+deck['name'])
     canv_itr = card_canv_itr(canv, pdf_config)
-    facesize = CARD_SIZE[0]-CARD_MARGIN*2, CARD_SIZE[1]-CARD_MARGIN*2
     
     # title card
-    next(canv_itr)
-    pretitle = platypus.Paragraph('<i>Trop Tumps</i>', prefront_style)
-    title = platypus.Paragraph(tag_font_fallbacks(deck['name']), front_style)
-    desc  = platypus.Paragraph(tag_font_fallbacks(deck['description']), desc_style) if deck['description'] else None
-    creds = platypus.Paragraph(DECK_CREDITS, creds_style)
-    tbl = platypus.Table([[pretitle],[title],[desc],[creds]])
-    tbl.setStyle(front_tbl_style)
-    tblsize = tbl.wrap(*facesize)
-    tbl.wrapOn(canv, *facesize)
-    tbl.drawOn(canv, 0,-facesize[1]*(1-GOLDEN_RATIO)-tblsize[1]/2)
+    if start == 0:
+        next(canv_itr)
+        with trace.span('layout', card=0):
+            pretitle = platypus.Paragraph('<i>Trop Tumps</i>', sty['prefront'])
+            title = platypus.Paragraph(tag_font_fallbacks(deck['name']), sty['front'])
+            desc  = platypus.Paragraph(tag_font_fallbacks(deck['description']), sty['desc']) \
+                                                                                if deck['description'] else None
+            creds = platypus.Paragraph(DECK_CREDITS, sty['creds'])
+            tbl = platypus.Table([[pretitle],[title],[desc],[creds]])
+            tbl.setStyle(sty['front-tbl'])
+            tblsize = tbl.wrap(*facesize)
+        with trace.span('draw', card=0):
+            tbl.wrapOn(canv, *facesize)
+            tbl.drawOn(canv, 0,-facesize[1]*(1-GOLDEN_RATIO)-tblsize[1]/2)
     
     # cards
-    for card_idx, card in enumerate(deck['cards']):
+    first = max(start-1, 0)
+    cards = itertools.islice(deckfile.read_cards(deckfile.deck_file(input_dir)), first, stop-1)
+    for card_idx, card in enumerate(cards, first):
         next(canv_itr)
-        title = platypus.Paragraph(tag_font_fallbacks(card['name']), title_style)
-        img = platypus.Image(os.path.join(output_dir, card['image']), facesize[0]-6*mm, 
-                             facesize[1]*(CARD_SECTION_PROPS[1]/sum(CARD_SECTION_PROPS)), 
-                             kind='proportional') if card['image'] else None
-        desc = platypus.Paragraph(tag_font_fallbacks(card['description']), desc_style) if card['description'] else None
-        stattbl = platypus.Table([ [platypus.Paragraph(tag_font_fallbacks(deck['stats'][i]), stat_style), 
-                                    platypus.Paragraph(tag_font_fallbacks(card['stats'][i]), stat_style)]
-                                   for i in range(len(deck['stats'])) ], 
-                                 rowHeights=CARD_TEXT_SIZE*CARD_STAT_SPACING, colWidths=(None, facesize[0]/3.0),
-                                 spaceBefore=0, spaceAfter=0)
-        stattbl.setStyle(stat_tbl_style)
-        tbl = platypus.Table([[title],[img],[desc],[stattbl]], 
-                             rowHeights=[facesize[1]*(p/sum(CARD_SECTION_PROPS)) for p in CARD_SECTION_PROPS])
-        tbl.setStyle(tbl_style)
-        tblsize = tbl.wrap(*facesize)
-        tbl.wrapOn(canv, *facesize)
-        tbl.drawOn(canv, 0, -tblsize[1])
-        
-        canv.setFillColorRGB(*colors.hsl2rgb(*contrasting_l(pdf_config[PdfVars.PRIMARY_HSL], TEXT_LUM_CONTRAST)))
-        canv.setFont(DEFAULT_FONT, CARD_SMALLPRINT_SIZE)
-        canv.drawRightString(facesize[0], -facesize[1], "{0} / {1}".format(card_idx+1, len(deck['cards'])))
+        with trace.span('layout', card=card_idx+1):
+            title = platypus.Paragraph(tag_font_fallbacks(card['name']), sty['title'])
+            img = SharedImage(os.path.join(input_dir, image_files[card['image']]), *imagesize, 
+                              kind='proportional', lazy=2) if card['image'] else None
+            desc = platypus.Paragraph(tag_font_fallbacks(card['description']), sty['desc']) \
+                                                                                if card['description'] else None
+            stattbl = platypus.Table([ [platypus.Paragraph(tag_font_fallbacks(deck['stats'][i]), sty['stat']), 
+                                        platypus.Paragraph(tag_font_fallbacks(card['stats'][i]), sty['stat'])]
+                                       for i in range(len(deck['stats'])) ], 
+                                     rowHeights=CARD_TEXT_SIZE*CARD_STAT_SPACING, colWidths=(None, facesize[0]/3.0),
+                                     spaceBefore=0, spaceAfter=0)
+            stattbl.setStyle(sty['stat-tbl'])
+            tbl = platypus.Table([[title],[img],[desc],[stattbl]], 
+                                 rowHeights=[facesize[1]*(p/sum(CARD_SECTION_PROPS)) for p in CARD_SECTION_PROPS])
+            tbl.setStyle(sty['tbl'])
+            tblsize = tbl.wrap(*facesize)
+        with trace.span('draw', card=card_idx+1):
+            tbl.wrapOn(canv, *facesize)
+            tbl.drawOn(canv, 0, -tblsize[1])
+            
+            canv.setFillColorRGB(*colors.hsl2rgb(*contrasting_l(pdf_config[PdfVars.PRIMARY_HSL], TEXT_LUM_CONTRAST)))
+            canv.setFont(DEFAULT_FONT, CARD_SMALLPRINT_SIZE)
+            canv.drawRightString(facesize[0], -facesize[1], "{0} / {1}".format(card_idx+1, numcards))
     halt_card_itr(canv_itr)
                             
-    canv.save()
+    with trace.span('save', start=start, stop=stop):
+        canv.save()
+    
+    
+def render_chunks(pdf_config, input_dir, deck, image_files, numcards, output_file, jobs):
+    # Renders runs of whole sheets in worker processes and stitches the results together. Each sheet (a page of
+    # fronts and its page of backs) only depends on its own cards, so the pages come out as they would serially.
+    gridsize = grid_size(pdf_config)
+    sheet_cards = gridsize[0]*gridsize[1]
+    numsheets = -(-(numcards+1) // sheet_cards)
+    bounds = [ round(numsheets*i/jobs)*sheet_cards for i in range(jobs+1) ]
+    chunks = [ (a, b) for a, b in zip(bounds, bounds[1:]) if b > a ]
+    logging.info("Rendering {} sheets in {} chunks".format(numsheets, len(chunks)))
+    
+    with tempfile.TemporaryDirectory(prefix='troptumps-') as tempdir:
+        parts = [ os.path.join(tempdir, 'part{:03d}.pdf'.format(i)) for i in range(len(chunks)) ]
+        with ProcessPoolExecutor(len(chunks)) as executor:
+            futures = [ executor.submit(render_cards, pdf_config, input_dir, deck, image_files, numcards, part, 
+                                        start, stop) 
+                        for part, (start, stop) in zip(parts, chunks) ]
+            for future in futures:
+                future.result()
+        merge_parts([ (part, None) for part in parts ], deck, output_file)
+
+
+def merge_parts(ranges, deck, output_file):
+    # Joins (part file, page numbers) pairs in order - None takes the whole part. Identical objects across the 
+    # parts - shared images, font programs and so on - are only written once.
+    with trace.span('merge', ranges=len(ranges)):
+        import pypdf
+        writer = pypdf.PdfWriter()
+        readers = {}
+        for part, pages in ranges:
+            if part not in readers:
+                readers[part] = pypdf.PdfReader(part)
+            writer.append(readers[part], pages=pages)
+        writer.compress_identical_objects()
+        writer.add_metadata({ '/Title': 'Trop Tumps '+deck['name'], 
+                              '/Producer': 'ReportLab PDF Library + pypdf' })
+        tmpfile = '{}.{}.tmp'.format(output_file, os.getpid())
+        with open(tmpfile, 'wb') as f:
+            writer.write(f)
+        os.replace(tmpfile, output_file)
+
+
+def sheet_keys(pdf_config, imagedpi, deck, numcards, cards, digests):
+    # Keys each sheet by everything drawn on it: the render options, the stat names and card count shown on every
+    # card, the deck's title card on the first sheet, and the sheet's own cards with the contents of their images.
+    # cards holds a digest and image name for each card.
+    gridsize = grid_size(pdf_config)
+    sheet_cards = gridsize[0]*gridsize[1]
+    options = { k.name: v.name if isinstance(v, enum.Enum) else v for k, v in pdf_config.items() }
+    common = json.dumps([SHEET_CACHE_VERSION, reportlab.Version, options, imagedpi, numcards, deck['stats']], 
+                        sort_keys=True).encode('utf-8')
+    keys = []
+    for sheet in range(-(-(numcards+1) // sheet_cards)):
+        digest = hashlib.sha1(common)
+        digest.update(str(sheet).encode('utf-8'))
+        if sheet == 0:
+            digest.update(json.dumps([deck['name'], deck['description']]).encode('utf-8'))
+        for carddigest, image in cards[max(sheet*sheet_cards-1, 0):(sheet+1)*sheet_cards-1]:
+            digest.update(carddigest)
+            digest.update(digests[image].encode('utf-8') if image else b'-')
+        keys.append(digest.hexdigest())
+    return keys
+
+
+def render_sheets(pdf_config, input_dir, deck, image_files, numcards, part_file, start, stop):
+    tmpfile = '{}.{}.tmp'.format(part_file, os.getpid())
+    try:
+        render_cards(pdf_config, input_dir, deck, image_files, numcards, tmpfile, start, stop)
+        os.replace(tmpfile, part_file)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def render_changed(pdf_config, input_dir, deck, image_files, numcards, output_file, keys, cached, jobs):
+    # Redraws only the sheets whose keys aren't in the deck's sheet cache, then stitches them together with the 
+    # cached ones. Each run of changed sheets is drawn into one part file, so the parts share their fonts and images
+    # and there are few of them to merge. cached maps sheet keys to their part file and position in it, and the 
+    # same for the deck's current sheets is returned. Parts no longer used are removed.
+    gridsize = grid_size(pdf_config)
+    sheet_cards = gridsize[0]*gridsize[1]
+    sheet_pages = 1 if pdf_config[PdfVars.BACKS_TYPE] == BacksType.NONE else 2
+    cache_dir = os.path.join(input_dir, SHEET_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    sheets = { key: cached[key] for key in keys 
+               if key in cached and os.path.exists(os.path.join(cache_dir, cached[key][0])) }
+    
+    # runs of missing sheets, split further to give every job some
+    missing = [ i for i, key in enumerate(keys) if key not in sheets ]
+    runlen = -(-len(missing) // jobs) if jobs > 1 else len(missing)
+    runs = []
+    for i in missing:
+        if len(runs) > 0 and runs[-1][1] == i and runs[-1][1]-runs[-1][0] < runlen:
+            runs[-1][1] = i+1
+        else:
+            runs.append([i, i+1])
+    logging.info("Rendering {} of {} sheets".format(len(missing), len(keys)))
+    
+    with trace.span('render_sheets', sheets=len(missing), runs=len(runs)):
+        parts = [ '{}.pdf'.format(hashlib.sha1(''.join(keys[a:b]).encode('utf-8')).hexdigest()) for a, b in runs ]
+        tasks = [ (pdf_config, input_dir, deck, image_files, numcards, os.path.join(cache_dir, part), 
+                   a*sheet_cards, b*sheet_cards) for part, (a, b) in zip(parts, runs) ]
+        if jobs > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(min(jobs, len(tasks))) as executor:
+                futures = [ executor.submit(render_sheets, *task) for task in tasks ]
+                for future in futures:
+                    future.result()
+        else:
+            for task in tasks:
+                render_sheets(*task)
+        for part, (a, b) in zip(parts, runs):
+            for i in range(a, b):
+                sheets[keys[i]] = [part, i-a]
+    
+    # consecutive sheets from the same part are taken together
+    ranges = []
+    for key in keys:
+        part, index = sheets[key]
+        if len(ranges) > 0 and ranges[-1][0] == part and ranges[-1][2] == index:
+            ranges[-1][2] = index+1
+        else:
+            ranges.append([part, index, index+1])
+    merge_parts([ (os.path.join(cache_dir, part), list(range(a*sheet_pages, b*sheet_pages))) for part, a, b in ranges ],
+                deck, output_file)
+    
+    # the merged deck becomes the one part the next render starts from, so parts don't pile up edit after edit
+    if len(ranges) > 1:
+        part = '{}.pdf'.format(hashlib.sha1(''.join(keys).encode('utf-8')).hexdigest())
+        shutil.copyfile(output_file, os.path.join(cache_dir, part))
+        sheets = { key: [part, i] for i, key in enumerate(keys) }
+    
+    used = { part for part, index in sheets.values() }
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pdf') and name not in used:
+            os.remove(os.path.join(cache_dir, name))
+    return sheets
+
+
+def load_manifest(input_dir):
+    try:
+        with open(os.path.join(input_dir, SHEET_CACHE_DIR, SHEET_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(input_dir, manifest):
+    path = os.path.join(input_dir, SHEET_CACHE_DIR, SHEET_MANIFEST)
+    tmpfile = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpfile, path)
+
+
+def output_stamp(output_file):
+    # tells whether the output is still the file last written
+    try:
+        stat = os.stat(output_file)
+    except FileNotFoundError:
+        return None
+    return [os.path.abspath(output_file), stat.st_size, stat.st_mtime_ns]
+    
+
+def create_pdf(args, input_dir, output_file=None, incremental=False):
+    # With incremental, rendered sheets are cached in the deck's directory and only the sheets which have changed
+    # since the last render are redrawn
+
+    starttime = time.monotonic()
+    
+    # read deck header - cards are streamed from the file as they are drawn
+    input_name = os.path.basename(input_dir)
+    deck = deckfile.read_header(deckfile.deck_file(input_dir))
+    
+    logging.info("Generating PDF")
+    output_dir = input_dir
+    output_name = input_name
+    if output_file is None:
+        output_file = os.path.join(output_dir, '{}.pdf'.format(output_name))
+    # pypdf is optional, and slow enough to import that it's left until the parts are merged
+    has_pypdf = importlib.util.find_spec('pypdf') is not None
+    if incremental and not has_pypdf:
+        logging.warn("pypdf is not installed - rendering every sheet")
+        incremental = False
+    
+    # a re-render keeps the colours the deck was last rendered with, random or not, unless new ones are given
+    manifest = load_manifest(input_dir) if incremental else {}
+    if args.color is None and args.seccolor is None and 'colours' in manifest:
+        args = copy.copy(args)
+        args.color, args.seccolor = [ tuple(c) for c in manifest['colours'] ]
+    pdf_config = page_config(args)
+    
+    # first pass over the cards for the card count and image list
+    numcards = 0
+    imagenames = set()
+    cards = []
+    with trace.span('scan_deck') as span:
+        for card in deckfile.read_cards(deckfile.deck_file(input_dir)):
+            numcards += 1
+            if card['image']:
+                imagenames.add(card['image'])
+            if incremental:
+                cards.append((hashlib.sha1(json.dumps(card, sort_keys=True).encode('utf-8')).digest(), 
+                              card['image']))
+        span.set(cards=numcards, images=len(imagenames))
+    
+    # identical images are embedded once, and downscaled to the print resolution if requested
+    imagesize = card_face_size()[1]
+    with trace.span('dedupe_images', images=len(imagenames)):
+        digests = images.image_digests(output_dir, imagenames)
+        image_files = images.dedupe_images(output_dir, imagenames, digests)
+    
+    if incremental:
+        keys = sheet_keys(pdf_config, args.imagedpi, deck, numcards, cards, digests)
+        deck_key = hashlib.sha1(''.join(keys).encode('utf-8')).hexdigest()
+        if manifest.get('deck') == deck_key and manifest.get('output') == output_stamp(output_file):
+            logging.info("{} is up to date".format(output_file))
+            return
+    
+    if args.imagedpi:
+        with trace.span('normalise_images', dpi=args.imagedpi):
+            normalised = images.normalise_images(output_dir, set(image_files.values()), imagesize, args.imagedpi)
+        image_files = { n: normalised[f] for n, f in image_files.items() }
+        
+    jobs = getattr(args, 'renderjobs', 1)
+    if jobs > 1 and not has_pypdf:
+        logging.warn("pypdf is not installed - rendering on a single core")
+        jobs = 1
+    with trace.span('render_cards', cards=numcards, jobs=jobs):
+        if incremental:
+            sheets = render_changed(pdf_config, input_dir, deck, image_files, numcards, output_file, keys, 
+                                    manifest.get('sheets', {}), jobs)
+        elif jobs > 1:
+            render_chunks(pdf_config, input_dir, deck, image_files, numcards, output_file, jobs)
+        else:
+            render_cards(pdf_config, input_dir, deck, image_files, numcards, output_file)
+    if incremental:
+        save_manifest(input_dir, { 'colours': [pdf_config[PdfVars.PRIMARY_HSL], pdf_config[PdfVars.SECONDARY_HSL]],
+                                   'deck': deck_key, 'output': output_stamp(output_file), 'sheets': sheets })
+        
+    logging.info("Wrote {} ({:.1f} KB) in {:.1f}s".format(output_file, os.path.getsize(output_file)/1024, 
+                                                         time.monotonic()-starttime))
@@ -0,0 +1,260 @@
+import os
+import os.path
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+import contextlib
+import collections
+import http.server
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from . import pdf
+from . import fetch
+from . import batch
+from . import deckfile
+
+
+# the command line options a job can set - the rest are the server's own
+JOB_OPTIONS = ('pagesize', 'pagemargin', 'bleedmargin', 'backs', 'color', 'seccolor', 'sqcorners', 'imagedpi',
+               'downloadworkers', 'candidates')
+# the options that change how a deck renders, and so which cached render it gets
+RENDER_OPTIONS = ('pagesize', 'pagemargin', 'bleedmargin', 'backs', 'color', 'seccolor', 'sqcorners', 'imagedpi')
+RENDER_CACHE_DIR = '.renders'
+RETRY_AFTER = 5
+STREAM_BUFFER_SIZE = 64*1024
+
+
+class JobError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def init_worker(loglevel):
+    batch.init_worker(loglevel)
+    # a worker lives for many jobs, so any fallback font a deck might need is worth loading up front
+    pdf.preload_fonts()
+
+
+def warm_up():
+    return os.getpid()
+
+
+def render_file(input_dir, args):
+    # Renders are cached in the deck's directory, keyed by the deck file's contents and the render options. A deck
+    # finished or re-fetched since gets rendered afresh.
+    digest = hashlib.sha256()
+    with open(deckfile.deck_file(input_dir), 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    digest.update(json.dumps({ k: getattr(args, k) for k in RENDER_OPTIONS }, sort_keys=True).encode('utf-8'))
+    return os.path.join(input_dir, RENDER_CACHE_DIR, '{}.pdf'.format(digest.hexdigest()))
+
+
+def run_job(args, input_dir):
+    # Runs in a worker: fetches a deck, or finishes an interrupted one, then renders it unless that's cached.
+    # A worker runs one job at a time, so jobs never share reportlab's global font and document registries.
+    input_dir = fetch.fetch_deck(args, input_dir)
+    output_file = render_file(input_dir, args)
+    if os.path.exists(output_file):
+        return input_dir, output_file, True
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    tmpfile = '{}.{}.tmp'.format(output_file, os.getpid())
+    try:
+        pdf.create_pdf(args, input_dir, tmpfile)
+        os.replace(tmpfile, output_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmpfile)
+        raise
+    return input_dir, output_file, False
+
+
+def job_args(parser, server_args, options):
+    # Reads a job's options as the command line would, so they're checked and converted the same way. Anything the
+    # job doesn't set is as the server was started with.
+    argv = []
+    for name, value in options.items():
+        if name not in JOB_OPTIONS:
+            raise JobError(400, "Unknown option: {}".format(name))
+        if value is True:
+            argv.append('--{}'.format(name))
+        elif value is not False and value is not None:
+            argv.append('--{}={}'.format(name, value))
+    try:
+        parsed, extra = parser.parse_known_args(argv)
+    except argparse.ArgumentError as e:
+        raise JobError(400, str(e))
+    except SystemExit:
+        raise JobError(400, "Invalid options")
+    if extra:
+        raise JobError(400, "Invalid options: {}".format(' '.join(extra)))
+    args = argparse.Namespace(**vars(server_args))
+    for name in options:
+        setattr(args, name, getattr(parsed, name))
+    # jobs run in parallel across the workers rather than within them
+    args.renderjobs = 1
+    return args
+
+
+class DeckServer:
+    # Runs jobs on a pool of worker processes kept ready with reportlab loaded, turning jobs away once every worker
+    # is busy and the queue is full
+
+    def __init__(self, args, parser, root='.'):
+        self.args = args
+        self.parser = parser
+        self.root = os.path.abspath(root)
+        self.slots = threading.BoundedSemaphore(args.jobs + args.queue)
+        self.lock = threading.Lock()
+        self.running = collections.Counter()
+        self.stats = collections.Counter()
+        self.executor = self.start_pool()
+
+    def start_pool(self):
+        executor = ProcessPoolExecutor(self.args.jobs, initializer=init_worker, initargs=(self.args.loglevel,))
+        # start every worker now, rather than making the first jobs wait for them
+        wait([ executor.submit(warm_up) for i in range(self.args.jobs) ])
+        return executor
+
+    def deck_dir(self, deck):
+        # only deck directories directly in the server's directory can be named
+        path = os.path.join(self.root, deck)
+        if os.path.basename(deck) != deck or deck in ('', '.', '..') or not os.path.isdir(path) or not (
+                os.path.exists(deckfile.deck_file(path)) or fetch.load_checkpoint(path) is not None):
+            raise JobError(404, "No such deck: {}".format(deck))
+        return path
+
+    def run(self, options):
+        options = dict(options)
+        deck = options.pop('deck', None)
+        args = job_args(self.parser, self.args, options)
+        input_dir = self.deck_dir(str(deck)) if deck is not None else None
+        unfinished = input_dir is not None and fetch.load_checkpoint(input_dir) is not None
+        # a finished deck's cached render needs no worker
+        if input_dir is not None and not unfinished:
+            output_file = render_file(input_dir, args)
+            if os.path.exists(output_file):
+                with self.lock:
+                    self.stats['hits'] += 1
+                return input_dir, output_file, True
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.stats['rejected'] += 1
+            raise JobError(503, "Too many jobs queued")
+        try:
+            with self.lock:
+                # two jobs finishing the same deck's fetch would trip over each other
+                if unfinished and self.running[input_dir] > 0:
+                    raise JobError(409, "Deck is already being fetched: {}".format(deck))
+                self.running[input_dir] += 1
+                executor = self.executor
+            try:
+                result = executor.submit(run_job, args, input_dir).result()
+            finally:
+                with self.lock:
+                    self.running[input_dir] -= 1
+        except BrokenProcessPool:
+            # a worker died and took the pool with it, so later jobs get a new one
+            with self.lock:
+                self.stats['failed'] += 1
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = self.start_pool()
+            raise JobError(500, "Worker process died")
+        except JobError:
+            raise
+        except Exception as e:
+            logging.error("Job failed: {!r}".format(e))
+            with self.lock:
+                self.stats['failed'] += 1
+            raise JobError(500, repr(e))
+        finally:
+            self.slots.release()
+        with self.lock:
+            self.stats['hits' if result[2] else 'rendered'] += 1
+        return result
+
+    def status(self):
+        with self.lock:
+            return { 'workers': self.args.jobs, 'queue': self.args.queue,
+                     'running': sum(self.running.values()), **self.stats }
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class DeckHandler(http.server.BaseHTTPRequestHandler):
+    # POST /decks takes a JSON object of job options and answers with the PDF. GET /status reports on the server.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, { 'error': "Not found" })
+        self.send_json(200, self.server.deck_server.status())
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path != '/decks':
+            return self.send_json(404, { 'error': "Not found" })
+        starttime = time.monotonic()
+        try:
+            options = json.loads(body or b'{}')
+            if not isinstance(options, dict):
+                raise ValueError("Expected a JSON object")
+            input_dir, output_file, hit = self.server.deck_server.run(options)
+        except ValueError as e:
+            return self.send_json(400, { 'error': str(e) })
+        except JobError as e:
+            headers = { 'Retry-After': str(RETRY_AFTER) } if e.status == 503 else {}
+            return self.send_json(e.status, { 'error': str(e) }, headers)
+        # the file is opened before replying, so a render replacing it meanwhile can't cut it short
+        with open(output_file, 'rb') as f:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.send_header('X-Deck', os.path.basename(os.path.normpath(input_dir)))
+            self.send_header('X-Cache', 'hit' if hit else 'miss')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, STREAM_BUFFER_SIZE)
+        logging.info("Sent {} in {:.1f}s ({})".format(os.path.basename(os.path.normpath(input_dir)),
+                                                     time.monotonic()-starttime, 'cached' if hit else 'rendered'))
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('{} {}'.format(self.address_string(), format % args))
+
+
+def start_server(args, parser, root='.'):
+    httpd = http.server.ThreadingHTTPServer(args.serve, DeckHandler)
+    httpd.deck_server = DeckServer(args, parser, root)
+    return httpd
+
+
+def serve(args, parser):
+    httpd = start_server(args, parser)
+    logging.info("Serving decks on http://{}:{}/decks with {} workers".format(*httpd.server_address[:2], args.jobs))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        httpd.deck_server.close()
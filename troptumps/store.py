@@ -0,0 +1,154 @@
+import os
+import os.path
+import enum
+import json
+import time
+import random
+import logging
+import sqlite3
+import contextlib
+
+
+LOCK_TIMEOUT = 30
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS categories (
+        uri TEXT PRIMARY KEY,
+        rank REAL NOT NULL,
+        size INTEGER,
+        status TEXT NOT NULL DEFAULT 'available',
+        verdict TEXT,
+        stat_count INTEGER,
+        member_count INTEGER,
+        screened_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS categories_draw ON categories (status, rank);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS refresh_pages (
+        page INTEGER PRIMARY KEY
+    );
+"""
+
+
+class Verdict(enum.Enum):
+    VIABLE = 'viable'
+    INSUFFICIENT_STATS = 'insufficient-stats'
+    INSUFFICIENT_MEMBERS = 'insufficient-members'
+
+
+class CategoryStore:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    @contextlib.contextmanager
+    def _connect(self, write=False):
+        db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+        try:
+            # take the write lock up front so that concurrent draws can't hand out the same category
+            db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            yield db
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+
+    def _get_meta(self, db, key):
+        row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, db, key, value):
+        db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def is_populated(self):
+        with self._connect() as db:
+            return self._get_meta(db, 'populated') is not None
+
+    def populate(self, categories):
+        # a random rank per category stands in for shuffling the whole list
+        with self._connect(True) as db:
+            db.executemany('INSERT OR IGNORE INTO categories (uri, rank, size) VALUES (?, ?, ?)',
+                           ((uri, random.random(), size) for uri, size in categories))
+            self._set_meta(db, 'populated', str(time.time()))
+
+    def refresh_progress(self):
+        # Returns the number of pages in the refresh under way, or None if there isn't one, and the pages done so far
+        with self._connect() as db:
+            numpages = self._get_meta(db, 'refresh_pages')
+            done = { r[0] for r in db.execute('SELECT page FROM refresh_pages') }
+        return (int(numpages) if numpages is not None else None), done
+
+    def begin_refresh(self, numpages):
+        with self._connect(True) as db:
+            db.execute('DELETE FROM refresh_pages')
+            self._set_meta(db, 'refresh_pages', str(numpages))
+
+    def add_page(self, page, categories):
+        # The page's categories and its place in the refresh are recorded together, and the list counts as populated
+        # once every page is in. Returns whether it is.
+        with self._connect(True) as db:
+            db.executemany('INSERT OR IGNORE INTO categories (uri, rank, size) VALUES (?, ?, ?)',
+                           ((uri, random.random(), size) for uri, size in categories))
+            db.execute('INSERT OR IGNORE INTO refresh_pages (page) VALUES (?)', (page,))
+            numpages = self._get_meta(db, 'refresh_pages')
+            done = db.execute('SELECT COUNT(*) FROM refresh_pages').fetchone()[0]
+            if numpages is None or done < int(numpages):
+                return False
+            db.execute('DELETE FROM refresh_pages')
+            db.execute("DELETE FROM meta WHERE key = 'refresh_pages'")
+            self._set_meta(db, 'populated', str(time.time()))
+            return True
+
+    def migrate(self, cache_file):
+        # import the category list from the old JSON cache file, keeping its shuffled order
+        if not os.path.isfile(cache_file):
+            return
+        with open(cache_file, 'r') as f:
+            try:
+                categories = json.load(f)
+            except ValueError:
+                logging.warn("Ignoring unreadable category cache {}".format(cache_file))
+                categories = None
+        if isinstance(categories, list):
+            logging.info('Importing {} categories from {}'.format(len(categories), cache_file))
+            with self._connect(True) as db:
+                db.executemany('INSERT OR IGNORE INTO categories (uri, rank) VALUES (?, ?)',
+                               ((uri, i / max(len(categories), 1)) for i, uri in enumerate(categories)))
+                self._set_meta(db, 'populated', str(time.time()))
+        os.remove(cache_file)
+
+    def count_available(self):
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM categories WHERE status = 'available'").fetchone()[0]
+
+    def draw(self):
+        with self._connect(True) as db:
+            row = db.execute("SELECT uri FROM categories WHERE status = 'available' ORDER BY rank LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE categories SET status = 'drawn' WHERE uri = ?", row)
+            return row[0]
+
+    def put_back(self, uri):
+        # returned categories go to the front of the queue
+        with self._connect(True) as db:
+            db.execute("UPDATE categories SET status = 'available', "
+                       "rank = (SELECT COALESCE(MIN(rank), 0) FROM categories) - 1 WHERE uri = ?", (uri,))
+
+    def record_screening(self, uri, verdict, stat_count, member_count=None):
+        # categories that failed screening are never drawn again
+        with self._connect(True) as db:
+            db.execute('UPDATE categories SET verdict = ?, stat_count = ?, member_count = ?, screened_at = ? '
+                       'WHERE uri = ?', (verdict.value, stat_count, member_count, time.time(), uri))
+            if verdict != Verdict.VIABLE:
+                db.execute("UPDATE categories SET status = 'rejected' WHERE uri = ?", (uri,))
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import logging
+import threading
+import tracemalloc
+
+
+PROFILERS = 'cprofile', 'tracemalloc'
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 30
+
+# the active recorder, or None when tracing is off
+_recorder = None
+
+
+class NullSpan:
+    # Stands in for a span when tracing is off, so instrumented code costs next to nothing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+
+    __slots__ = 'recorder', 'name', 'args', 'start', 'tid'
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.recorder.enter(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        end = time.perf_counter_ns()
+        # a generator closed before it finished isn't an error
+        if exctype is not None and not issubclass(exctype, GeneratorExit):
+            self.args['error'] = exctype.__name__
+        self.recorder.exit(self, end)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Recorder:
+    # Collects completed spans as Chrome trace events, optionally profiling every occurrence of one stage in this
+    # process and adding the results together
+
+    def __init__(self, stage=None, profiler=None):
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.stage = stage
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        # cProfile only follows the thread it's enabled on, so each thread gets its own, merged when written
+        self.profiles = []
+        # tracemalloc covers every thread at once, so it runs while any occurrence is open, and the allocations left
+        # at the end of each such window are added up
+        self.tracing = 0
+        self.snapshots = []
+        # each thread's nesting of the stage and its profile
+        self.local = threading.local()
+
+    def enter(self, span):
+        span.tid = threading.get_ident()
+        if span.name != self.stage:
+            return
+        self.local.depth = getattr(self.local, 'depth', 0) + 1
+        if self.local.depth > 1:
+            return
+        if self.profiler == 'cprofile':
+            profile = getattr(self.local, 'profile', None)
+            if profile is None:
+                # the profilers are only imported when used, to keep startup quick
+                import cProfile
+                profile = self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(profile)
+            profile.enable()
+        elif self.profiler == 'tracemalloc':
+            with self.lock:
+                self.tracing += 1
+                if self.tracing == 1:
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def exit(self, span, end):
+        self.events.append({
+            'name': span.name,
+            'ph': 'X',
+            'ts': (span.start - self.origin) / 1000,
+            'dur': (end - span.start) / 1000,
+            'pid': self.pid,
+            'tid': span.tid,
+            'args': span.args,
+        })
+        if span.name != self.stage:
+            return
+        self.local.depth = getattr(self.local, 'depth', 1) - 1
+        if self.local.depth > 0:
+            return
+        if self.profiler == 'cprofile':
+            profile = getattr(self.local, 'profile', None)
+            if profile is not None:
+                profile.disable()
+        elif self.profiler == 'tracemalloc':
+            with self.lock:
+                self.tracing -= 1
+                if self.tracing > 0:
+                    return
+                self.snapshots.append(tracemalloc.take_snapshot())
+                span.args['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+                tracemalloc.stop()
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({ 'traceEvents': self.events, 'displayTimeUnit': 'ms' }, f)
+        logging.info('Wrote trace of {} spans to {}'.format(len(self.events), filename))
+        base = os.path.splitext(filename)[0]
+        if len(self.profiles) > 0:
+            import pstats
+            stats = pstats.Stats(*self.profiles)
+            stats.dump_stats(base+'.prof')
+            with open(base+'.prof.txt', 'w') as f:
+                stats.stream = f
+                stats.sort_stats('cumulative').print_stats()
+            logging.info('Wrote profile of {} on {} threads to {}.prof'.format(self.stage, len(self.profiles), base))
+        if len(self.snapshots) > 0:
+            totals = {}
+            for snapshot in self.snapshots:
+                for stat in snapshot.statistics('lineno'):
+                    size, count = totals.get(stat.traceback, (0, 0))
+                    totals[stat.traceback] = size + stat.size, count + stat.count
+            with open(base+'.tracemalloc.txt', 'w') as f:
+                for tb, (size, count) in sorted(totals.items(), key=lambda t: -t[1][0])[:TRACEMALLOC_TOP]:
+                    f.write('{}: size={:.1f} KiB, count={}\n'.format(tb, size/1024, count))
+            logging.info('Wrote allocations of {} over {} windows to {}.tracemalloc.txt'.format(
+                self.stage, len(self.snapshots), base))
+
+
+def span(name, **args):
+    if _recorder is None:
+        return NULL_SPAN
+    return Span(_recorder, name, args)
+
+
+def enabled():
+    return _recorder is not None
+
+
+def start(stage=None, profiler=None):
+    global _recorder
+    _recorder = Recorder(stage, profiler)
+
+
+def finish(filename):
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.write(filename)